@@ -18,7 +18,7 @@ powershell -Command "$existing = Get-Process | Where-Object { $_.ProcessName -li
 if %ERRORLEVEL% EQU 100 (
     echo [INFO] llama-server is already running. Skipping startup.
 ) else (
-    start "llama-server" "%SERVER%" --port %PORT% -m "%MODEL_PATH%" --mmproj "%MMPROJ_PATH%" -fa -ngl %gpu-layers% --keep %keep% --ctx-size %ctx-size% --temp %temperature% --top-k %top-k% --top-p %top-p% --repeat-penalty %repeat-penalty%
+    start "llama-server" "%SERVER%" --port %PORT% -m "%MODEL_PATH%" --mmproj "%MMPROJ_PATH%" -fa -ngl %gpu-layers% --keep %keep% --ctx-size %ctx-size% --parallel %parallel% --temp %temperature% --top-k %top-k% --top-p %top-p% --repeat-penalty %repeat-penalty%
     powershell -Command "$p = Get-Process | Where-Object { $_.MainWindowTitle -eq 'llama-server' }; if ($p) { Add-Type -Namespace Native -Name Win32 -MemberDefinition '[DllImport(\"user32.dll\")]public static extern bool ShowWindowAsync(IntPtr hWnd, int nCmdShow);'; [void][Native.Win32]::ShowWindowAsync($p.MainWindowHandle, 2); }"
 )
 
@@ -0,0 +1,188 @@
+'''
+批量简报生成：对目录或清单中的田间图像逐一（或成对）生成简报，多份简报同时在llama-server的并行slot上运行。
+大幅 GeoTIFF 正射影像自动切分为分块，每个分块各生成一份简报（见 utils/geotiff.py）。
+用法：
+    python batch_inference.py path/to/images_dir [更多目录或清单...] [-j 并发数]
+清单文件（.txt / .json）：
+    .txt  每行一个任务，1~2个图像路径，用逗号分隔；'#'开头为注释。相对路径相对于清单所在目录
+    .json ["a.png", ["b_1.png", "b_2.png"], ...]
+'''
+import sys, os
+import json
+import time
+import argparse
+import numpy as np
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from tqdm import tqdm
+from solutions.llama_server import briefing, prepare_images, build_img_message, http_stats, LLM_SLOTS
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from utils import CONFIG_AND_SETTINGS, SERVER_CONFIG, LOGGER
+from utils.monitor import performance_monitor, wait_for_server
+from utils.img_handler import handle_files, SUPPORTED_FORMATS
+from utils.info_extractor import image_records, scan_images
+from utils.geotiff import GeoTile, plan_tiles, LARGE_RASTER_PIXELS, RASTERIO_AVAILABLE
+from retrieval.embedding import preload_embedding_model
+
+
+def _manifest_jobs(manifest: Path) -> list:
+    base = manifest.parent
+    if manifest.suffix.lower() == '.json':
+        with open(manifest, 'r', encoding='utf-8') as f:
+            entries = json.load(f)
+        lines = [e if isinstance(e, list) else [e] for e in entries]
+    else:
+        with open(manifest, 'r', encoding='utf-8') as f:
+            lines = [[p for p in line.split(',')] for line in f
+                     if line.strip() and not line.lstrip().startswith('#')]
+
+    jobs = []
+    for parts in lines:
+        paths = [str(base / p.strip().strip('\"').strip("\'")) for p in parts if str(p).strip()]
+        try:
+            jobs.append(handle_files(paths))
+        except FileNotFoundError:
+            continue  # handle_files 已记录错误，跳过该任务
+    return jobs
+
+
+def collect_jobs(inputs: list) -> list:
+    """
+    将目录与清单展开为任务列表，每个任务为1~2个图像路径。
+    目录中的每张图像各为一个任务；同名的 .json/.txt 文件视为图像元数据（见 find_metadata），不作为图像处理。
+    """
+    jobs = []
+    for item in inputs:
+        path = Path(item)
+        if path.is_dir():
+            # 并行读取目录中全部图像的文件头与 EXIF，并报告吞吐量
+            records, _ = scan_images(path.resolve())
+            jobs.extend([Path(r.path)] for r in records)
+        elif path.is_file() and path.suffix.lower() in SUPPORTED_FORMATS:
+            jobs.append([path.resolve()])
+        elif path.is_file():
+            jobs.extend(_manifest_jobs(path))
+        else:
+            LOGGER.error(f"文件不存在: {path}")
+
+    for job in jobs:
+        if len(job) > 2:
+            LOGGER.error(f"简报模式支持最多2张图像输入，已截取前2张：{[str(p) for p in job]}")
+            del job[2:]
+
+    # 每张图像在此建立 ImageRecord（一次 stat、一次文件头解析），之后的任务直接复用
+    # 与元数据配对，缺少元数据的图像仍会诊断，只是缺少作物类型、拍摄坐标等先验信息
+    records = image_records([p for job in jobs for p in job], revalidate=False)
+    paired = sum(bool(r.metadata) for r in records)
+    LOGGER.info(f"共{len(jobs)}个简报任务，{sum(len(j) for j in jobs)}张图像，其中{paired}张找到了元数据。")
+
+    # 大幅 GeoTIFF 单独成为任务时切分为分块，每个分块一个任务；分块在执行到时才读取像素
+    by_path = {Path(r.path): r for r in records}
+    expanded = []
+    for job in jobs:
+        record = by_path.get(Path(os.path.abspath(job[0])))
+        if (len(job) == 1 and RASTERIO_AVAILABLE and record is not None and record.width
+                and record.ext in ('.tif', '.tiff') and record.width * record.height > LARGE_RASTER_PIXELS):
+            expanded.extend([tile] for tile in plan_tiles(record.path, source_meta=record.metadata))
+        else:
+            expanded.append(job)
+    if len(expanded) != len(jobs):
+        LOGGER.info(f"大幅影像切分后共{len(expanded)}个简报任务。")
+    return expanded
+
+
+def _run_job(img_paths: list) -> float:
+    start = time.perf_counter()
+    img_paths = [p.materialize() if isinstance(p, GeoTile) else p for p in img_paths]
+
+    system_message = CONFIG_AND_SETTINGS['raw_messages'][0]
+    messages = [system_message, {"role": "user", "content": []}]
+    # 复用收集任务时建立的记录；重新校验元数据与检测结果文件，它们可能在收集任务之后才生成或更新
+    records = image_records(img_paths)
+    # 在本任务的线程中编码图像，多个任务的图像预处理并发进行
+    prefetched = prepare_images(messages, img_paths, records=records, modes=("briefing",))
+    for i, img_path in enumerate(img_paths):
+        messages = build_img_message(
+            messages, img_path, clean=(i == 0),
+            data_uri=prefetched["data_uris"]["briefing"].get(img_path), mode="briefing"
+        )
+
+    briefing(messages, img_paths, show_process=None, prefetched=prefetched,
+             progress=False, report_name="+".join(Path(p).stem for p in img_paths))
+    return time.perf_counter() - start
+
+
+def run_batch(jobs: list, concurrency: int = LLM_SLOTS + 1) -> dict:
+    """
+    并发执行简报任务。同时进行的简报数量为 concurrency；各简报的LLM阶段共享llama-server的slot池，
+    因此并发数略大于slot数时，一份简报做知识检索的同时其他简报可以占满全部slot。
+
+    Returns:
+        dict: 吞吐量与单任务耗时分位数统计
+    """
+    latencies, failed = [], []
+    n_images = 0
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max(1, concurrency), thread_name_prefix="batch") as executor:
+        futures = {executor.submit(_run_job, job): job for job in jobs}
+        for future in tqdm(as_completed(futures), total=len(futures), desc="批量简报生成中", ncols=100):
+            job = futures[future]
+            try:
+                latency = future.result()
+            except Exception as e:
+                LOGGER.error(f"简报生成失败：{[str(p) for p in job]}。{e}")
+                failed.append(job)
+                continue
+            latencies.append(latency)
+            n_images += len(job)
+    elapsed = time.perf_counter() - start
+
+    stats = {
+        "jobs": len(jobs),
+        "succeeded": len(latencies),
+        "failed": len(failed),
+        "images": n_images,
+        "elapsed_s": elapsed,
+        "images_per_hour": n_images / elapsed * 3600 if elapsed > 0 else 0.0,
+    }
+    if latencies:
+        p50, p90, p99 = np.percentile(latencies, [50, 90, 99])
+        stats.update({"latency_p50_s": p50, "latency_p90_s": p90, "latency_p99_s": p99,
+                      "latency_max_s": max(latencies)})
+    return stats
+
+
+@performance_monitor()
+def main():
+    parser = argparse.ArgumentParser(description="QwenIA 批量简报生成")
+    parser.add_argument("inputs", nargs="+", help="图像目录、图像文件或清单文件（.txt/.json）")
+    parser.add_argument("-j", "--concurrency", type=int,
+                        default=CONFIG_AND_SETTINGS.get("batch_concurrency") or LLM_SLOTS + 1,
+                        help="同时进行的简报数量，默认为llama-server并行slot数+1")
+    args = parser.parse_args()
+
+    jobs = collect_jobs(args.inputs)
+    if not jobs:
+        LOGGER.error("没有可处理的图像。")
+        return
+
+    preload_embedding_model()
+    wait_for_server(port=SERVER_CONFIG['PORT'])
+
+    stats = run_batch(jobs, args.concurrency)
+    LOGGER.info(
+        f"批量简报完成：成功{stats['succeeded']}/{stats['jobs']}，共{stats['images']}张图像，"
+        f"耗时{stats['elapsed_s']:.1f}s，吞吐量{stats['images_per_hour']:.1f}张/小时。"
+    )
+    if stats["succeeded"]:
+        LOGGER.info(
+            f"单任务耗时：p50 {stats['latency_p50_s']:.1f}s，p90 {stats['latency_p90_s']:.1f}s，"
+            f"p99 {stats['latency_p99_s']:.1f}s，max {stats['latency_max_s']:.1f}s。"
+        )
+    http = http_stats()
+    LOGGER.info(f"llama-server请求：最近{http['calls']}次调用共重试{http['retries']}次，"
+                f"连接复用率{http['connection_reuse_rate']:.0%}。")
+
+if __name__ == "__main__":
+    main()
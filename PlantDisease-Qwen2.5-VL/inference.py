@@ -2,11 +2,15 @@
 $lhm 251019
 '''
 import sys, os
-from solutions.llama_server import chat, briefing, build_img_message, build_text_message
+import re
+from solutions.llama_server import chat, briefing, prefetch, build_img_message, build_text_message
+from solutions.token_budget import keep_m_tokens
+from solutions.compaction import ChatCompactor
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 from utils import CONFIG_AND_SETTINGS, SERVER_CONFIG, LOGGER
 from utils.monitor import performance_monitor, wait_for_server
 from utils.img_handler import handle_files
+from retrieval.embedding import preload_embedding_model
 
 # Debug Only
 IMG_PATH = ["assets/1_1.png", "assets/1_2.png"]
@@ -14,15 +18,31 @@ IMG_PATH = ["assets/1_1.png", "assets/1_2.png"]
 @performance_monitor()
 def main():
 
+    # 等待llama-server启动的同时，在后台加载向量模型
+    preload_embedding_model()
     wait_for_server(port=SERVER_CONFIG['PORT'])
     messages = CONFIG_AND_SETTINGS['raw_messages']
     file_paths = []
+    # 长对话滚动摘要（可选），摘要在两轮对话之间于后台生成
+    compactor = ChatCompactor() if CONFIG_AND_SETTINGS.get("chat_compaction", False) else None
+    # 上一轮使用的模式，预取时优先为该模式预填充（只有一个 slot 时只能预填充一种模式）
+    last_mode = "briefing"
     LOGGER.info("QwenIA初始化完成，在提示词中键入'--h'(help)获取帮助。")
 
     while True:
         print("\n------QwenIA Standby😎------")
 
         img_path_input = input("图像路径：")
+
+        # 图像路径通过检查后立即在后台预处理（base64编码、元数据提取等），与键入问题的时间重叠
+        img_paths, prefetched = [], None
+        if img_path_input.strip() and not re.search(r"--[qch]", img_path_input.lower()):
+            try:
+                img_paths = handle_files([img_path_input.replace('--f', '')])
+                prefetched = prefetch(messages, img_paths,
+                                      modes=(last_mode, "chat" if last_mode == "briefing" else "briefing"))
+            except Exception as e: LOGGER.error(e); continue
+
         text_input = input("询问任何问题：")
 
         query = f"<image>{img_path_input}<image> {text_input}"
@@ -62,26 +82,32 @@ def main():
             except Exception as e: LOGGER.error(e); continue
 
         # 如果有新的图像输入，则会替换掉旧的图像输入，这对所有模式都是一样的。如果想处理多个图像，则作为列表一次性输入进来。
-        if img_path_input:
+        if img_paths:
             try:
-                img_path_input = handle_files([img_path_input])
-
-                for img_path in img_path_input:
-                    messages = build_img_message(messages, img_path, clean=True)
+                prefetched = prefetched.result()
+                # 仅在第一张图像时清除旧图像，否则多图输入只会保留最后一张
+                # 无文本提示时进入简报模式，两种模式的图像像素预算不同
+                mode = "chat" if text_input else "briefing"
+                for i, img_path in enumerate(img_paths):
+                    messages = build_img_message(
+                        messages, img_path, clean=(i == 0),
+                        data_uri=prefetched["data_uris"][mode].get(img_path), mode=mode
+                    )
             except Exception as e: LOGGER.error(e); continue
 
         # 文本输入对应了对话模式。这里clean=False意味着历史聊天内容不会被删除，token会积累。
         if text_input:
             messages = build_text_message(messages, text_input, clean=False)
-        elif not img_path_input: continue # 没有任何输入
+        elif not img_paths: continue # 没有任何输入
 
         print("\n------QwenIA Running🤔------")
+        last_mode = "chat" if text_input else "briefing"
 
         # $wxy: To Debug, comment try...except statement.
         #       To override KeyboardInterrupt, uncomment it.
         # try:
         if not text_input:
-            if len(img_path_input) > 2:
+            if len(img_paths) > 2:
                 LOGGER.error("简报模式支持最多2张图像输入")
                 continue
             # clean一次messages内容，简报模式不需要历史消息。
@@ -90,11 +116,15 @@ def main():
                 content for content in messages[-1]['content']
                 if content["type"] == "image_url"
             ]
-            briefing(messages, img_path_input, show_process=CONFIG_AND_SETTINGS['briefing_process'])
+            briefing(messages, img_paths, show_process=CONFIG_AND_SETTINGS['briefing_process'], prefetched=prefetched)
         else:
-            # TODO: 检查一下token数是否超限。因为llama-server多模态推理时不会启用ctx_shift
-            # messages = keep_m_tokens(messages) 
-            chat(messages, img_path_input, file_paths)
+            if compactor:
+                messages = compactor.apply(messages)
+            # 检查token数是否超限。因为llama-server多模态推理时不会启用ctx_shift，超限后请求会直接失败
+            messages = keep_m_tokens(messages, img_paths)
+            chat(messages, img_paths, file_paths)
+            if compactor:
+                compactor.schedule(messages)
 
         # except (Exception, KeyboardInterrupt) as e:
         #     if isinstance(e, KeyboardInterrupt):
@@ -8,6 +8,7 @@ import os
 import json
 import re
 import time
+import hashlib
 from pathlib import Path
 from typing import List, Sequence
 
@@ -19,6 +20,27 @@ sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 from utils import LOGGER, CACHE_DIR
 
 
+# ==================================================
+# 文本块 ID 与哈希
+# ==================================================
+def chunk_hash(text: str) -> str:
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+
+def make_document(chunk_id: str, text: str) -> Document:
+    """
+    以稳定 ID 构造文本块文档。记录 ID 与文本哈希写入 metadata，但不参与向量化与提示词，
+    索引增量更新时据此判断文本块是否变化。
+    """
+    return Document(
+        id_=chunk_id,
+        text=text,
+        metadata={"chunk_id": chunk_id, "chunk_hash": chunk_hash(text)},
+        excluded_embed_metadata_keys=["chunk_id", "chunk_hash"],
+        excluded_llm_metadata_keys=["chunk_id", "chunk_hash"],
+    )
+
+
 # ==================================================
 # JSON 知识库切分（农业专用）
 # ==================================================
@@ -37,79 +59,85 @@ class JSONSplitter:
     # --------------------------------------------------
     def split_diseases(self, max_words=512, save=False) -> List[Document]:
         chunks = []
+        self._seen_ids = {}
 
         for disease in self.data:
             name = disease.get("病害名称", "未知病害")
             crop = disease.get("作物", "未知作物")
+            record_id = self._record_id(f"disease:{name}@{crop}")
 
             for key, value in disease.items():
                 if key in ["病害名称", "作物"]:
                     continue
 
                 text = self._format_value(value)
-                for piece in self._cut_into_pieces(
+                for i, piece in enumerate(self._cut_into_pieces(
                     text,
                     prefix=f"病害名称:{name} 作物:{crop} {key}",
                     max_words=max_words
-                ):
-                    chunks.append(piece)
+                )):
+                    chunks.append((f"{record_id}#{key}#{i}", piece))
 
         if save:
-            self._save_json(chunks)
+            self._save_json([c for _, c in chunks])
 
-        return [Document(text=c) for c in chunks if c.strip()]
+        return self._to_documents(chunks)
 
     # --------------------------------------------------
     # 作物知识切分
     # --------------------------------------------------
     def split_crops(self, max_words=512, save=False) -> List[Document]:
         chunks = []
+        self._seen_ids = {}
 
         for crop in self.data:
             name = crop.get("作物名称", "未知作物")
+            record_id = self._record_id(f"crop:{name}")
 
             for key, value in crop.items():
                 if key == "作物名称":
                     continue
 
                 text = self._format_value(value)
-                for piece in self._cut_into_pieces(
+                for i, piece in enumerate(self._cut_into_pieces(
                     text,
                     prefix=f"作物:{name} {key}",
                     max_words=max_words
-                ):
-                    chunks.append(piece)
+                )):
+                    chunks.append((f"{record_id}#{key}#{i}", piece))
 
         if save:
-            self._save_json(chunks)
+            self._save_json([c for _, c in chunks])
 
-        return [Document(text=c) for c in chunks if c.strip()]
+        return self._to_documents(chunks)
 
     # --------------------------------------------------
     # 防治措施切分
     # --------------------------------------------------
     def split_treatments(self, max_words=512, save=False) -> List[Document]:
         chunks = []
+        self._seen_ids = {}
 
         for item in self.data:
             disease = item.get("病害名称", "未知病害")
+            record_id = self._record_id(f"treatment:{disease}")
 
             for key, value in item.items():
                 if key == "病害名称":
                     continue
 
                 text = self._format_value(value)
-                for piece in self._cut_into_pieces(
+                for i, piece in enumerate(self._cut_into_pieces(
                     text,
                     prefix=f"病害名称:{disease} 防治:{key}",
                     max_words=max_words
-                ):
-                    chunks.append(piece)
+                )):
+                    chunks.append((f"{record_id}#{key}#{i}", piece))
 
         if save:
-            self._save_json(chunks)
+            self._save_json([c for _, c in chunks])
 
-        return [Document(text=c) for c in chunks if c.strip()]
+        return self._to_documents(chunks)
 
     # --------------------------------------------------
     # 统一入口
@@ -127,6 +155,20 @@ class JSONSplitter:
     # ==================================================
     # 内部工具函数
     # ==================================================
+    def _record_id(self, base: str) -> str:
+        """
+        生成记录的稳定 ID。同名记录按出现顺序追加序号，保证 ID 唯一。
+        """
+        count = self._seen_ids.get(base, 0)
+        self._seen_ids[base] = count + 1
+        return base if count == 0 else f"{base}~{count}"
+
+    def _to_documents(self, chunks) -> List[Document]:
+        return [
+            make_document(chunk_id, text)
+            for chunk_id, text in chunks if text.strip()
+        ]
+
     def _format_value(self, value) -> str:
         if isinstance(value, dict):
             return "；".join(f"{k}:{self._format_value(v)}" for k, v in value.items())
@@ -186,13 +228,19 @@ class AutoSplitter:
         pipeline = IngestionPipeline(transformations=[self.text_splitter])
         nodes = pipeline.run(documents=documents)
 
-        return [
-            Document(
-                text=node.text,
-                metadata={"file_name": node.metadata.get("file_name", "")}
-            )
-            for node in nodes
-        ]
+        # 通用文档没有记录结构，以 文件名 + 文本哈希 作为稳定 ID
+        documents, seen = [], {}
+        for node in nodes:
+            file_name = node.metadata.get("file_name", "")
+            base = f"{file_name}#{chunk_hash(node.text)[:16]}"
+            count = seen.get(base, 0)
+            seen[base] = count + 1
+
+            document = make_document(base if count == 0 else f"{base}~{count}", node.text)
+            document.metadata["file_name"] = file_name
+            documents.append(document)
+
+        return documents
 
 
 # Debug
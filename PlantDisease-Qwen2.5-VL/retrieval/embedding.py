@@ -0,0 +1,77 @@
+'''
+进程级向量模型管理：每个 (后端, 模型, 设备) 只加载一次，并支持在后台线程中预加载。
+'''
+import sys, os
+import threading
+from concurrent.futures import Future
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from utils import CONFIG_AND_SETTINGS, LOGGER
+
+# (backend, model_name, device) -> Future[embedding model]
+_MODELS = {}
+_LOCK = threading.Lock()
+
+
+def _load(backend: str, model_name: str, device: str):
+    if backend == "langchain":
+        from langchain_community.embeddings import HuggingFaceEmbeddings
+        return HuggingFaceEmbeddings(
+            model_name=model_name,
+            model_kwargs={"device": device}
+        )
+    elif backend == "llama_index":
+        from llama_index.embeddings.huggingface import HuggingFaceEmbedding
+        return HuggingFaceEmbedding(model_name=model_name, device=device)
+    else:
+        raise ValueError(f"未知的向量模型后端: {backend}")
+
+
+def _worker(key, future: Future):
+    backend, model_name, device = key
+    try:
+        LOGGER.debug(f"正在加载向量模型：{model_name}（{backend}, {device}）")
+        future.set_result(_load(backend, model_name, device))
+    except BaseException as e:
+        # 加载失败时移除记录，允许下次调用重试
+        with _LOCK:
+            _MODELS.pop(key, None)
+        future.set_exception(e)
+
+
+def _submit(key, background: bool) -> Future:
+    with _LOCK:
+        future = _MODELS.get(key)
+        if future is not None:
+            return future
+        future = Future()
+        _MODELS[key] = future
+
+    if background:
+        threading.Thread(target=_worker, args=(key, future), name="embedding-preload", daemon=True).start()
+    else:
+        _worker(key, future)
+    return future
+
+
+def preload_embedding_model(model_name=CONFIG_AND_SETTINGS["embedding_model"],
+                            device=CONFIG_AND_SETTINGS["embedding_device"],
+                            backend="llama_index") -> Future:
+    """
+    在后台线程中开始加载向量模型，立即返回。适合在等待 llama-server 启动时调用。
+    """
+    return _submit((backend, model_name, device), background=True)
+
+
+def get_embedding_model(model_name=CONFIG_AND_SETTINGS["embedding_model"],
+                        device=CONFIG_AND_SETTINGS["embedding_device"],
+                        backend="llama_index"):
+    """
+    获取进程内共享的向量模型。若正在后台预加载则等待其完成；若从未加载则在当前线程加载。
+
+    Args:
+        model_name (str): HuggingFace 模型名称
+        device (str): "cuda", "cpu", ...
+        backend (str): "llama_index"（HuggingFaceEmbedding）或 "langchain"（HuggingFaceEmbeddings）
+    """
+    return _submit((backend, model_name, device), background=False).result()
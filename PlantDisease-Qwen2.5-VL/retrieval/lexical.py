@@ -0,0 +1,142 @@
+"""
+Lexical Name Matcher
+基于 Aho-Corasick 自动机的作物 / 病害名称匹配：一次扫描找出查询中出现的全部名称与别名
+"""
+
+import re
+from collections import deque
+
+# 记录中可能存放别名的字段（含英文名，如 assets 元数据中的 "Apple"）
+ALIAS_KEYS = ("别名", "俗名", "英文名", "英文名称", "学名", "aliases", "alias", "name_en", "english_name")
+
+# 规范名称与别名的置信度。过短的名称（如单字“梨”）误命中率高，置信度较低
+NAME_CONFIDENCE = 1.0
+ALIAS_CONFIDENCE = 0.8
+SHORT_NAME_CONFIDENCE = 0.5
+
+_ASCII_WORD = re.compile(r"[0-9a-z]")
+
+
+class AhoCorasick:
+    """
+    多模式串匹配自动机。构建 O(模式总长度)，匹配 O(文本长度 + 命中数)。
+    英文模式不区分大小写，并要求单词边界完整（"pear" 不会命中 "spear"）。
+    """
+
+    def __init__(self):
+        self.goto = [{}]
+        self.fail = [0]
+        self.output = [[]]  # 状态 -> [(模式长度, value), ...]
+        self._built = False
+
+    def add(self, pattern: str, value):
+        pattern = pattern.lower()
+        state = 0
+        for ch in pattern:
+            nxt = self.goto[state].get(ch)
+            if nxt is None:
+                nxt = len(self.goto)
+                self.goto[state][ch] = nxt
+                self.goto.append({})
+                self.fail.append(0)
+                self.output.append([])
+            state = nxt
+        self.output[state].append((len(pattern), value))
+        self._built = False
+
+    def build(self):
+        queue = deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for ch, nxt in self.goto[state].items():
+                queue.append(nxt)
+                f = self.fail[state]
+                while f and ch not in self.goto[f]:
+                    f = self.fail[f]
+                self.fail[nxt] = self.goto[f].get(ch, 0)
+                self.output[nxt] = self.output[nxt] + self.output[self.fail[nxt]]
+        self._built = True
+        return self
+
+    def find_all(self, text: str) -> list:
+        """
+        Returns:
+            list[tuple[int, int, Any]]: (起始位置, 结束位置, value)，按结束位置排序
+        """
+        if not self._built:
+            self.build()
+
+        text = text.lower()
+        hits = []
+        state = 0
+        for i, ch in enumerate(text):
+            while state and ch not in self.goto[state]:
+                state = self.fail[state]
+            state = self.goto[state].get(ch, 0)
+
+            for length, value in self.output[state]:
+                start = i - length + 1
+                if self._is_word(text, start, i + 1):
+                    hits.append((start, i + 1, value))
+        return hits
+
+    @staticmethod
+    def _is_word(text: str, start: int, end: int) -> bool:
+        # 中文没有单词边界；英文 / 数字模式要求两侧不是字母数字
+        if not _ASCII_WORD.match(text[start]) and not _ASCII_WORD.match(text[end - 1]):
+            return True
+        before = text[start - 1] if start > 0 else " "
+        after = text[end] if end < len(text) else " "
+        return not (_ASCII_WORD.match(before) or _ASCII_WORD.match(after))
+
+
+class NameMatcher:
+    """
+    知识库记录名称匹配器，对一组记录的名称字段与别名字段建立一个自动机
+
+    Args:
+        records (list[dict]): 知识库记录
+        name_key (str): 名称字段，如 "作物名称"、"病害名称"
+    """
+
+    def __init__(self, records: list, name_key: str):
+        self.records = records
+        self.automaton = AhoCorasick()
+
+        for idx, record in enumerate(records):
+            name = str(record.get(name_key, "") or "")
+            if name:
+                confidence = NAME_CONFIDENCE if self._usable(name) else SHORT_NAME_CONFIDENCE
+                self.automaton.add(name, (idx, confidence))
+            for key in ALIAS_KEYS:
+                for alias in self._aliases(record.get(key)):
+                    self.automaton.add(alias, (idx, ALIAS_CONFIDENCE))
+
+        self.automaton.build()
+
+    @staticmethod
+    def _aliases(value) -> list:
+        if not value:
+            return []
+        if isinstance(value, str):
+            value = re.split(r"[,，、;；/]+", value)
+        return [str(v).strip() for v in value if NameMatcher._usable(str(v).strip())]
+
+    @staticmethod
+    def _usable(name) -> bool:
+        # 中文至少 2 字，英文至少 3 个字符
+        if not name:
+            return False
+        name = str(name)
+        return len(name) >= (3 if name.isascii() else 2)
+
+    def match(self, query: str) -> list:
+        """
+        Returns:
+            list[tuple[int, float]]: 命中的 (记录下标, 置信度)，按首次出现的位置排序，同一记录只保留最高置信度
+        """
+        best = {}
+        for start, _, (idx, confidence) in sorted(self.automaton.find_all(query)):
+            if idx not in best or confidence > best[idx]:
+                best[idx] = confidence
+        return list(best.items())
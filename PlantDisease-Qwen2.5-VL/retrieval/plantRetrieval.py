@@ -3,12 +3,12 @@ Plant Disease Knowledge Retrieval Module
 基于 RAG 的农业病害诊断知识检索模块
 """
 
-import os
 import json
 import re
 
 from .RAGHandler import JSONSplitter
-from .retrieval import Retrieval
+from .retrieval import BatchRetrieval
+from .lexical import NameMatcher
 from utils import CONFIG_AND_SETTINGS, LOGGER
 
 
@@ -24,20 +24,169 @@ def _load_json(filepath, name):
         return []
 
 
-CROP_DB = _load_json(
-    CONFIG_AND_SETTINGS.get("crop_knowledge_filepath", ""),
-    "作物"
-)
+def _cfg_path(*keys):
+    """按顺序返回第一个在配置文件中出现的知识库路径"""
+    for key in keys:
+        if CONFIG_AND_SETTINGS.get(key):
+            return CONFIG_AND_SETTINGS[key]
+    return ""
 
-DISEASE_DB = _load_json(
-    CONFIG_AND_SETTINGS.get("disease_knowledge_filepath", ""),
-    "病害"
-)
 
-TREATMENT_DB = _load_json(
-    CONFIG_AND_SETTINGS.get("treatment_knowledge_filepath", ""),
-    "防治"
-)
+CROP_FILEPATH = _cfg_path("crop_knowledge_filepath")
+DISEASE_FILEPATH = _cfg_path("disease_knowledge_filepath", "plant_disease_filepath")
+TREATMENT_FILEPATH = _cfg_path("treatment_knowledge_filepath", "treatment_filepath")
+
+CROP_DB = _load_json(CROP_FILEPATH, "作物")
+
+DISEASE_DB = _load_json(DISEASE_FILEPATH, "病害")
+
+TREATMENT_DB = _load_json(TREATMENT_FILEPATH, "防治")
+
+
+# ==================================================
+# 知识集合定义
+# ==================================================
+def _clean_coords(query: str) -> str:
+    # 去除坐标等无关符号，降低噪声
+    return re.sub(r"\[.*?\]", "", query)
+
+
+# collection -> 检索所需的全部信息
+#   filepath:  知识库文件
+#   text_type: JSONSplitter 切分方式
+#   title:     检索结果标题
+#   db:        规则匹配所用的记录列表
+#   name_key:  规则匹配所用的名称字段
+#   top_k:     默认检索数量
+#   clean:     查询预处理函数
+COLLECTIONS = {
+    "crop": {
+        "filepath": CROP_FILEPATH,
+        "text_type": "crop",
+        "title": "【作物背景知识】\n",
+        "db": CROP_DB,
+        "name_key": "作物名称",
+        "top_k": 5,
+        "clean": None,
+    },
+    "disease": {
+        "filepath": DISEASE_FILEPATH,
+        "text_type": "disease",
+        "title": "【植物病害知识】\n",
+        "db": DISEASE_DB,
+        "name_key": "病害名称",
+        "top_k": 8,
+        "clean": _clean_coords,
+    },
+    "treatment": {
+        "filepath": TREATMENT_FILEPATH,
+        "text_type": "treatment",
+        "title": "【病害防治与管理建议】\n",
+        "db": TREATMENT_DB,
+        "name_key": "病害名称",
+        "top_k": 10,
+        "clean": None,
+    },
+}
+
+
+# ==================================================
+# 名称匹配（Aho-Corasick，一次扫描匹配全部名称与别名）
+# ==================================================
+_MATCHERS = {}
+
+
+def _matcher(collection: str) -> NameMatcher:
+    if collection not in _MATCHERS:
+        spec = COLLECTIONS[collection]
+        _MATCHERS[collection] = NameMatcher(spec["db"], spec["name_key"])
+    return _MATCHERS[collection]
+
+
+def _matched(collection: str, query: str) -> list:
+    """
+    查询中出现的、置信度不低于 lexical_min_confidence 的记录，按知识库中的顺序排列
+    """
+    threshold = CONFIG_AND_SETTINGS.get("lexical_min_confidence", 0.8)
+    return sorted(h for h in _matcher(collection).match(query) if h[1] >= threshold)
+
+
+def _format_records(collection: str, hits) -> str:
+    retrieval = ""
+    for idx, _ in hits:
+        for k, v in COLLECTIONS[collection]["db"][idx].items():
+            retrieval += f"{k}: {v}\n"
+    return retrieval
+
+
+def _rule_match(collection: str, query: str) -> str:
+    return _format_records(collection, _matched(collection, query))
+
+
+def _lexical_fast_path(collection: str, query: str) -> str:
+    """
+    查询中出现高置信度的名称时直接返回对应记录，跳过向量检索；否则返回空字符串
+    """
+    if not CONFIG_AND_SETTINGS.get("lexical_fast_path", True):
+        return ""
+    return _format_records(collection, _matched(collection, query))
+
+
+# ==================================================
+# 知识检索入口
+# ==================================================
+def retrieve_many(pairs, eager=True) -> list:
+    """
+    检索一个或多个知识集合，retrieve_crop / retrieve_disease / retrieve_treatment 均经由此处。
+    查询中明确出现知识库记录名称（或别名）时，直接使用对应记录，不再进行向量检索；
+    其余查询交给 BatchRetrieval，未命中缓存的查询向量在同一次调用中计算。
+    简报流程中各项检索依赖不同阶段的模型输出，分别单独调用。
+
+    Args:
+        pairs (list): [(collection, query), ...]，collection 为 "crop" / "disease" / "treatment"
+        eager (bool | dict): 是否启用向量检索（RAG）。可按集合分别指定，如 {"crop": False}
+
+    Returns:
+        list[str]: 与 pairs 一一对应的知识文本
+    """
+    results = [""] * len(pairs)
+    requests, slots = [], []
+
+    for i, (collection, query) in enumerate(pairs):
+        if collection not in COLLECTIONS:
+            raise ValueError(f"未知的知识集合: {collection}")
+        if not query:
+            continue
+
+        spec = COLLECTIONS[collection]
+        results[i] = spec["title"]
+        use_rag = eager.get(collection, True) if isinstance(eager, dict) else eager
+
+        if not use_rag:
+            # 非 RAG：基于规则匹配
+            results[i] += _rule_match(collection, query)
+            continue
+
+        clean_query = spec["clean"](query) if spec["clean"] else query
+        exact = _lexical_fast_path(collection, clean_query)
+        if exact:
+            results[i] += exact
+            continue
+
+        filepath = spec["filepath"]
+        requests.append((
+            # 文档延迟切分：持久化索引命中时不会重新切分
+            lambda filepath=filepath, text_type=spec["text_type"]: JSONSplitter(filepath).split(text_type=text_type),
+            clean_query,
+            CONFIG_AND_SETTINGS.get("vector_search_top_k", spec["top_k"]),
+            filepath,
+        ))
+        slots.append(i)
+
+    for i, text in zip(slots, BatchRetrieval(requests)):
+        results[i] += text
+
+    return results
 
 
 # ==================================================
@@ -54,31 +203,7 @@ def retrieve_crop(query: str, eager: bool = False) -> str:
     Returns:
         str: 作物相关知识文本
     """
-    if not query:
-        return ""
-
-    retrieval = "【作物背景知识】\n"
-
-    if eager:
-        documents = JSONSplitter(
-            CONFIG_AND_SETTINGS.get("crop_knowledge_filepath", "")
-        ).split(text_type="agriculture")
-
-        retrieval += Retrieval(
-            documents,
-            query,
-            top_k=CONFIG_AND_SETTINGS.get("vector_search_top_k", 5)
-        )
-        return retrieval
-
-    # 非 RAG：基于规则匹配
-    for crop in CROP_DB:
-        name = crop.get("作物名称", "")
-        if name and name in query:
-            for k, v in crop.items():
-                retrieval += f"{k}: {v}\n"
-
-    return retrieval
+    return retrieve_many([("crop", query)], eager=eager)[0]
 
 
 # ==================================================
@@ -95,34 +220,7 @@ def retrieve_disease(query: str, eager: bool = False) -> str:
     Returns:
         str: 病害知识文本
     """
-    if not query:
-        return ""
-
-    retrieval = "【植物病害知识】\n"
-
-    if eager:
-        documents = JSONSplitter(
-            CONFIG_AND_SETTINGS.get("disease_knowledge_filepath", "")
-        ).split(text_type="agriculture")
-
-        # 去除坐标等无关符号，降低噪声
-        clean_query = re.sub(r"\[.*?\]", "", query)
-
-        retrieval += Retrieval(
-            documents,
-            clean_query,
-            top_k=CONFIG_AND_SETTINGS.get("vector_search_top_k", 8)
-        )
-        return retrieval
-
-    # 规则匹配（fallback）
-    for disease in DISEASE_DB:
-        name = disease.get("病害名称", "")
-        if name and name in query:
-            for k, v in disease.items():
-                retrieval += f"{k}: {v}\n"
-
-    return retrieval
+    return retrieve_many([("disease", query)], eager=eager)[0]
 
 
 # ==================================================
@@ -139,28 +237,4 @@ def retrieve_treatment(query: str, eager: bool = True) -> str:
     Returns:
         str: 防治建议文本
     """
-    if not query:
-        return ""
-
-    retrieval = "【病害防治与管理建议】\n"
-
-    if eager:
-        documents = JSONSplitter(
-            CONFIG_AND_SETTINGS.get("treatment_knowledge_filepath", "")
-        ).split(text_type="agriculture")
-
-        retrieval += Retrieval(
-            documents,
-            query,
-            top_k=CONFIG_AND_SETTINGS.get("vector_search_top_k", 10)
-        )
-        return retrieval
-
-    # 规则兜底
-    for item in TREATMENT_DB:
-        name = item.get("病害名称", "")
-        if name and name in query:
-            for k, v in item.items():
-                retrieval += f"{k}: {v}\n"
-
-    return retrieval
+    return retrieve_many([("treatment", query)], eager=eager)[0]
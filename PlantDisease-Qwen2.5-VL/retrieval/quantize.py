@@ -0,0 +1,192 @@
+'''
+知识库向量量化存储：
+- int8：每个向量按最大绝对值缩放到 [-127, 127]，保存 int8 码与 float32 缩放系数，内存约为 float32 的 1/4
+- pq：乘积量化，向量切分为 m 段，每段用 256 个聚类中心编码为 1 字节，内存约为 float32 的 4/(D/m)
+量化分数只用于粗排，候选集再用 mmap 中的 float16 原始向量精排（只会读取候选行对应的页）。
+'''
+import numpy as np
+
+# 粗排分块大小：分块转换为 float32 计算，避免临时矩阵随知识库规模增长
+SCAN_BLOCK = 8192
+
+
+class Int8Quantizer:
+    kind = "int8"
+
+    def __init__(self, codes=None, scales=None):
+        self.codes = codes
+        self.scales = scales
+
+    def fit(self, vectors: np.ndarray):
+        vectors = np.asarray(vectors, dtype=np.float32)
+        self.scales = (np.abs(vectors).max(axis=1) / 127.0).astype(np.float32)
+        safe = np.where(self.scales > 0, self.scales, 1.0)[:, None]
+        self.codes = np.clip(np.rint(vectors / safe), -127, 127).astype(np.int8)
+        return self
+
+    def scores(self, queries: np.ndarray) -> np.ndarray:
+        """(B, D) 查询与全部向量的近似内积，返回 (B, N)"""
+        out = np.empty((len(queries), len(self.codes)), dtype=np.float32)
+        for start in range(0, len(self.codes), SCAN_BLOCK):
+            block = self.codes[start:start + SCAN_BLOCK].astype(np.float32)
+            out[:, start:start + SCAN_BLOCK] = (queries @ block.T) * self.scales[start:start + SCAN_BLOCK]
+        return out
+
+    def state(self) -> dict:
+        return {"codes": self.codes, "scales": self.scales}
+
+    @classmethod
+    def from_state(cls, state) -> "Int8Quantizer":
+        return cls(state["codes"], state["scales"])
+
+    @property
+    def nbytes(self) -> int:
+        return self.codes.nbytes + self.scales.nbytes
+
+
+class ProductQuantizer:
+    kind = "pq"
+
+    def __init__(self, m: int = 64, ks: int = 256, centroids=None, codes=None):
+        self.m = m
+        self.ks = ks
+        self.centroids = centroids  # (m, ks, D/m)
+        self.codes = codes          # (N, m) uint8
+
+    def fit(self, vectors: np.ndarray, iters: int = 10, sample: int = 20000, seed: int = 0):
+        vectors = np.asarray(vectors, dtype=np.float32)
+        n, dim = vectors.shape
+        if dim % self.m:
+            raise ValueError(f"向量维度 {dim} 不能被子空间数量 m={self.m} 整除")
+        sub = dim // self.m
+        ks = min(self.ks, n)
+
+        rng = np.random.default_rng(seed)
+        train = vectors[rng.choice(n, size=min(sample, n), replace=False)]
+
+        self.centroids = np.zeros((self.m, ks, sub), dtype=np.float32)
+        for j in range(self.m):
+            self.centroids[j] = _kmeans(np.ascontiguousarray(train[:, j * sub:(j + 1) * sub]), ks, iters, rng)
+
+        self.codes = np.empty((n, self.m), dtype=np.uint8)
+        for j in range(self.m):
+            self.codes[:, j] = _assign(vectors[:, j * sub:(j + 1) * sub], self.centroids[j])
+        return self
+
+    def scores(self, queries: np.ndarray) -> np.ndarray:
+        """
+        非对称距离计算（ADC）：先算全部查询各子段与聚类中心的内积表，再按编码查表求和。
+        查表按子段循环（m 次），每次对全部查询同时取值，不随查询数量增加 Python 循环
+        """
+        queries = np.asarray(queries, dtype=np.float32)
+        sub = self.centroids.shape[2]
+        tables = np.einsum("mkd,bmd->bmk", self.centroids, queries.reshape(len(queries), self.m, sub))  # (B, m, ks)
+        out = np.zeros((len(queries), len(self.codes)), dtype=np.float32)
+        for start in range(0, len(self.codes), SCAN_BLOCK):
+            # 转置为 (m, n)，每个子段的编码连续存放
+            block = np.ascontiguousarray(self.codes[start:start + SCAN_BLOCK].T)
+            acc = out[:, start:start + SCAN_BLOCK]
+            for j in range(self.m):
+                acc += tables[:, j].take(block[j], axis=1)
+        return out
+
+    def state(self) -> dict:
+        return {"centroids": self.centroids, "codes": self.codes}
+
+    @classmethod
+    def from_state(cls, state) -> "ProductQuantizer":
+        centroids = state["centroids"]
+        return cls(m=centroids.shape[0], ks=centroids.shape[1], centroids=centroids, codes=state["codes"])
+
+    @property
+    def nbytes(self) -> int:
+        return self.codes.nbytes + self.centroids.nbytes
+
+
+def _kmeans(x: np.ndarray, k: int, iters: int, rng) -> np.ndarray:
+    centroids = x[rng.choice(len(x), size=k, replace=False)].copy()
+    for _ in range(iters):
+        labels = _assign(x, centroids)
+        onehot = np.zeros((len(x), k), dtype=np.float32)
+        onehot[np.arange(len(x)), labels] = 1.0
+        sums = onehot.T @ x
+        counts = np.bincount(labels, minlength=k)
+        filled = counts > 0
+        centroids[filled] = sums[filled] / counts[filled, None]
+        # 空簇重新随机取点，避免聚类中心退化
+        empty = np.flatnonzero(~filled)
+        centroids[empty] = x[rng.integers(len(x), size=len(empty))]
+    return centroids
+
+
+def _assign(x: np.ndarray, centroids: np.ndarray) -> np.ndarray:
+    # argmin ||x - c||^2 = argmax (x·c - ||c||^2 / 2)
+    return np.argmax(x @ centroids.T - 0.5 * (centroids ** 2).sum(axis=1), axis=1)
+
+
+QUANTIZERS = {
+    "int8": Int8Quantizer,
+    "pq": ProductQuantizer,
+}
+
+
+def quant_name(kind: str, **kwargs) -> str:
+    """
+    量化编码的文件名标识，包含影响编码的全部参数：修改 m 或 ks 后不会误用旧的码本
+    """
+    if kind == "pq":
+        m, ks = kwargs.get("m", 64), kwargs.get("ks", 256)
+        return f"pq_m{m}_b{int(np.ceil(np.log2(ks)))}"
+    return kind
+
+
+def build_quantizer(kind: str, vectors: np.ndarray, **kwargs):
+    if kind not in QUANTIZERS:
+        raise ValueError(f"未知的量化方式: {kind}")
+    return QUANTIZERS[kind](**kwargs).fit(vectors)
+
+
+def recall_at_k(exact: list, approx: list, k: int) -> float:
+    """
+    Recall@k：近似检索的前 k 个结果中，包含精确检索前 k 个结果的比例
+
+    Args:
+        exact, approx (list[list[int]]): 每个查询的结果下标（降序）
+    """
+    total, hit = 0, 0
+    for e, a in zip(exact, approx):
+        truth = set(e[:k])
+        total += len(truth)
+        hit += len(truth & set(a[:k]))
+    return hit / total if total else 1.0
+
+
+if __name__ == "__main__":
+    # 粗排耗时对比：python -m retrieval.quantize [向量数] [维度] [查询数]
+    import sys
+    import time
+    args = [int(v) for v in sys.argv[1:4]]
+    n, dim, batch = args + [100000, 512, 8][len(args):]
+    rng = np.random.default_rng(0)
+    vectors = rng.normal(size=(n, dim)).astype(np.float16)
+    queries = rng.normal(size=(batch, dim)).astype(np.float32)
+
+    def exact_scores(queries):
+        # 与 NumpyVectorStore._exact_scores 相同：float16 原始向量分块转换为 float32
+        out = np.empty((len(queries), n), dtype=np.float32)
+        for start in range(0, n, SCAN_BLOCK):
+            out[:, start:start + SCAN_BLOCK] = queries @ vectors[start:start + SCAN_BLOCK].astype(np.float32).T
+        return out
+
+    def bench(fn, repeat=3):
+        fn(queries)
+        start = time.perf_counter()
+        for _ in range(repeat):
+            fn(queries)
+        return (time.perf_counter() - start) / repeat * 1000
+
+    report = {"float16": {"scan_ms": bench(exact_scores), "mb": vectors.nbytes / 1024 ** 2}}
+    for kind, kwargs in (("int8", {}), ("pq", {"m": 64})):
+        quantizer = build_quantizer(kind, vectors, **kwargs)
+        report[quant_name(kind, **kwargs)] = {"scan_ms": bench(quantizer.scores), "mb": quantizer.nbytes / 1024 ** 2}
+    print(report)
@@ -2,18 +2,25 @@
 $lhm 251020
 '''
 import sys, os
-from typing import Sequence, Any
+import json
+import hashlib
+import threading
+import unicodedata
+from typing import Sequence, Any, Callable
 from pathlib import Path
-from llama_index.core import VectorStoreIndex, BasePromptTemplate
-from llama_index.core import Settings, get_response_synthesizer
-from llama_index.core.postprocessor import SimilarityPostprocessor, LongContextReorder
-from llama_index.core.response_synthesizers import ResponseMode
-from llama_index.core.schema import Document
-from llama_index.embeddings.huggingface import HuggingFaceEmbedding
+from llama_index.core import VectorStoreIndex
+from llama_index.core import StorageContext, load_index_from_storage
+from llama_index.core import Settings
+from llama_index.core.postprocessor import SimilarityPostprocessor
+from llama_index.core.schema import Document, QueryBundle, MetadataMode
 
 from .RAGHandler import JSONSplitter, AutoSplitter
+from .embedding import get_embedding_model
+from .vector_store import NumpyVectorStore, long_context_reorder
+from .sparse import NgramBM25Index, reciprocal_rank_fusion
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
-from utils import CONFIG_AND_SETTINGS, LOGGER
+from utils import CONFIG_AND_SETTINGS, LOGGER, CACHE_DIR
+from utils.cache import LRUCache
 
 
 # Test Only
@@ -24,42 +31,479 @@ EMBEDDING_MODELS = {
         "gte-l": "thenlper/gte-large",
     }
 
-def Retrieval(documents: Sequence[Document] | Any,
-              query,
-              model_name=CONFIG_AND_SETTINGS["embedding_model"],
-              top_k: int = 10) -> str:
+# 持久化向量索引存放目录
+INDEX_DIR = os.path.join(CACHE_DIR, "index")
+
+# 向量检索后端："llama_index"（VectorStoreIndex）或 "numpy"（内存映射暴力检索，适合小型知识库）
+VECTOR_BACKEND = CONFIG_AND_SETTINGS.get("vector_backend", "llama_index")
+# numpy 后端的向量量化方式："none"、"int8"、"pq"
+VECTOR_QUANTIZATION = CONFIG_AND_SETTINGS.get("vector_quantization", "none")
+
+# 混合检索：字符 n-gram BM25 与稠密检索结果按倒数排名融合（RRF）
+HYBRID_SEARCH = CONFIG_AND_SETTINGS.get("hybrid_search", False)
+RRF_K = CONFIG_AND_SETTINGS.get("rrf_k", 60)
+
+# 进程内已加载的索引：slot -> (key, index)
+_INDEX_POOL = {}
+# 进程内已加载的 BM25 索引：key -> NgramBM25Index
+_SPARSE_POOL = {}
+# 源文件摘要缓存：path -> ((mtime_ns, size), sha256)，文件未变化时无需重新读取
+_DIGEST_MEMO = {}
+# 诊断流程中多个检索节点可能并发执行，索引的加载 / 构建串行化，避免同一索引被重复构建
+_LOAD_LOCK = threading.Lock()
+
+# 查询向量缓存：(model_name, 规范化查询) -> embedding
+QUERY_EMBEDDING_CACHE = LRUCache(
+    max_bytes=int(CONFIG_AND_SETTINGS.get("query_cache_mb", 32) * 1024 ** 2),
+    sizeof=lambda v: 64 + 32 * len(v)  # list[float] 的近似内存占用
+)
+# 检索结果缓存：(索引版本, 查询哈希, top_k, cutoff) -> 检索文本
+RESULT_CACHE = LRUCache(
+    max_bytes=int(CONFIG_AND_SETTINGS.get("result_cache_mb", 16) * 1024 ** 2)
+)
+
+
+# ==================================================
+# 索引键计算
+# ==================================================
+def _file_digest(path) -> str:
     """
-    Domain-agnostic knowledge retrieval function.
-    Used for retrieving plant disease, crop, and treatment knowledge
-    in the diagnosis pipeline.
+    计算知识库源文件（JSON/docx）的内容摘要。以 (mtime, size) 作为快速判定，未变化时直接复用。
     """
+    path = os.path.abspath(path)
+    stat = os.stat(path)
+    sig = (stat.st_mtime_ns, stat.st_size)
 
-    Settings.llm = None
-    Settings.embed_model = HuggingFaceEmbedding(
-        model_name=model_name,
-        device=CONFIG_AND_SETTINGS["embedding_device"]
-    )
+    memo = _DIGEST_MEMO.get(path)
+    if memo and memo[0] == sig:
+        return memo[1]
 
-    index = VectorStoreIndex.from_documents(
-        documents,
-        embed_model=Settings.embed_model,
-    )
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    digest = h.hexdigest()
+    _DIGEST_MEMO[path] = (sig, digest)
+    return digest
 
-    query_engine = index.as_query_engine(
-        similarity_top_k=top_k,
-        node_postprocessors=[
-            SimilarityPostprocessor(similarity_cutoff=0.35),
-            LongContextReorder(),
-        ],
-        # CONTEXT_ONLY: return evidence only, reasoning handled downstream
-        response_synthesizer=get_response_synthesizer(
-            response_mode=ResponseMode.CONTEXT_ONLY,
-            text_qa_template=BasePromptTemplate
+
+def _as_sources(source) -> list:
+    if not source:
+        return []
+    if isinstance(source, (str, Path)):
+        return [str(source)]
+    return [str(s) for s in source]
+
+
+def index_key(documents, model_name: str, chunk_size: int, source=None) -> tuple:
+    """
+    计算索引的 (slot, key)。
+    - slot：索引在磁盘上的位置，由源文件路径、向量模型和切分长度决定；
+    - key：索引内容版本，额外包含源文件的内容摘要。key 变化时才需要重建索引。
+    未提供源文件时，直接对文档文本做摘要，此时 slot 与 key 相同。
+    """
+    sources = _as_sources(source)
+    head = hashlib.sha256(f"{model_name}|{chunk_size}".encode("utf-8"))
+    content = hashlib.sha256()
+
+    if sources:
+        for src in sources:
+            head.update(os.path.abspath(src).encode("utf-8"))
+            content.update(_file_digest(src).encode("utf-8"))
+    else:
+        for doc in documents:
+            content.update(doc.text.encode("utf-8"))
+        head.update(content.digest())
+
+    slot = head.hexdigest()[:16]
+    key = hashlib.sha256(head.digest() + content.digest()).hexdigest()[:16]
+    return slot, key
+
+
+# ==================================================
+# 查询缓存
+# ==================================================
+def normalize_query(query: str) -> str:
+    """全角/半角统一、折叠空白、英文小写，使几乎相同的查询命中同一缓存条目"""
+    query = unicodedata.normalize("NFKC", query)
+    return " ".join(query.split()).lower()
+
+
+def cache_stats() -> dict:
+    """查询向量缓存与检索结果缓存的命中统计"""
+    return {
+        "query_embedding": QUERY_EMBEDDING_CACHE.stats(),
+        "result": RESULT_CACHE.stats(),
+    }
+
+
+# ==================================================
+# 持久化索引加载 / 构建
+# ==================================================
+def load_or_build_index(documents: Sequence[Document] | Callable[[], Sequence[Document]],
+                        embed_model,
+                        model_name: str = CONFIG_AND_SETTINGS["embedding_model"],
+                        chunk_size: int = 512,
+                        source=None) -> VectorStoreIndex:
+    """
+    获取向量索引：优先使用进程内缓存，其次从 INDEX_DIR 加载，最后才重新向量化构建并持久化。
+    同一 slot 的源文件内容变化时，对已有索引做增量更新而不是整体重建。
+
+    Args:
+        documents: 文档列表，或返回文档列表的函数（提供 source 时可延迟切分，命中缓存时不会调用）
+        embed_model: 向量模型
+        model_name (str): 向量模型名称，参与索引键计算
+        chunk_size (int): 文本切分长度，参与索引键计算
+        source: 知识库源文件路径（或路径列表），其内容摘要参与索引键计算
+    """
+    return _load_index(documents, embed_model, model_name, chunk_size, source)[1]
+
+
+def _load_index(documents, embed_model, model_name, chunk_size, source=None) -> tuple:
+    """
+    返回 (索引版本 key, 索引)。
+    """
+    if callable(documents) and not source:
+        documents = documents()
+
+    slot, key = index_key(documents, model_name, chunk_size, source)
+
+    cached = _INDEX_POOL.get(slot)
+    if cached:
+        if cached[0] == key:
+            return cached
+        # 知识库文件已变化：旧版本索引的检索结果全部失效
+        RESULT_CACHE.evict(lambda k: k[0] == cached[0])
+
+    persist_dir = os.path.join(INDEX_DIR, slot)
+    meta_path = os.path.join(persist_dir, "meta.json")
+    index = None
+
+    if os.path.isfile(meta_path):
+        try:
+            with open(meta_path, "r", encoding="utf-8") as f:
+                meta = json.load(f)
+            storage_context = StorageContext.from_defaults(persist_dir=persist_dir)
+            index = load_index_from_storage(storage_context, embed_model=embed_model)
+
+            if meta.get("key") == key:
+                LOGGER.debug(f"已加载持久化索引：{persist_dir}")
+            else:
+                # 同一知识库文件内容有变化：只对变化的文本块重新向量化
+                if callable(documents):
+                    documents = documents()
+                _update_index(index, documents)
+                _persist_index(index, persist_dir, key, model_name, chunk_size, source)
+        except Exception as e:
+            LOGGER.warning(f"持久化索引加载失败，将重新构建：{persist_dir}。{e}")
+            index = None
+
+    if index is None:
+        if callable(documents):
+            documents = documents()
+        LOGGER.info(f"正在构建知识库向量索引（{len(documents)}个文本块）···")
+        index = VectorStoreIndex.from_documents(documents, embed_model=embed_model)
+        _persist_index(index, persist_dir, key, model_name, chunk_size, source)
+
+    _ensure_sparse(persist_dir, key, documents)
+    _INDEX_POOL[slot] = (key, index)
+    return key, index
+
+
+def _load_numpy_store(documents, embed_model, model_name, chunk_size, source=None) -> tuple:
+    """
+    返回 (索引版本 key, NumpyVectorStore)。与 _load_index 使用相同的 slot / key，
+    源文件变化时复用哈希未变的文本块向量。
+    """
+    if callable(documents) and not source:
+        documents = documents()
+
+    slot, key = index_key(documents, model_name, chunk_size, source)
+
+    cached = _INDEX_POOL.get((slot, "numpy"))
+    if cached:
+        if cached[0] == key:
+            return cached
+        RESULT_CACHE.evict(lambda k: k[0] == cached[0])
+
+    persist_dir = os.path.join(INDEX_DIR, f"{slot}_numpy")
+    meta_path = os.path.join(persist_dir, "meta.json")
+    store, previous = None, None
+
+    if os.path.isfile(meta_path):
+        try:
+            with open(meta_path, "r", encoding="utf-8") as f:
+                meta = json.load(f)
+            previous = NumpyVectorStore.load(persist_dir, meta["key"])
+            if meta.get("key") == key:
+                store = previous
+                LOGGER.debug(f"已加载持久化向量矩阵：{persist_dir}")
+        except Exception as e:
+            LOGGER.warning(f"持久化向量矩阵加载失败，将重新构建：{persist_dir}。{e}")
+
+    if store is None:
+        if callable(documents):
+            documents = documents()
+        chunks = [
+            {
+                "id": doc.doc_id,
+                "hash": doc.hash,
+                "text": doc.get_content(metadata_mode=MetadataMode.LLM),
+                "embed_text": doc.get_content(metadata_mode=MetadataMode.EMBED),
+            }
+            for doc in documents
+        ]
+        store = NumpyVectorStore.build(
+            persist_dir, key, chunks,
+            embed_fn=lambda texts: embed_model.get_text_embedding_batch(texts),
+            previous=previous,
         )
+        LOGGER.info(f"知识库向量矩阵已更新：共{len(store)}个文本块，复用{store.reused}个。")
+        _write_meta(persist_dir, key, model_name, chunk_size, source)
+
+    if VECTOR_QUANTIZATION != "none":
+        _quantize_store(store, persist_dir, key)
+
+    _ensure_sparse(persist_dir, key, documents)
+    _INDEX_POOL[(slot, "numpy")] = (key, store)
+    return key, store
+
+
+def _quantize_store(store: NumpyVectorStore, persist_dir, key):
+    """
+    启用量化粗排 + float 精排。新训练编码时报告相对 float 精确检索的 Recall@k 与内存占用。
+    """
+    kwargs = {"m": CONFIG_AND_SETTINGS.get("pq_subspaces", 64)} if VECTOR_QUANTIZATION == "pq" else {}
+    trained = store.quantize(
+        VECTOR_QUANTIZATION, persist_dir, key,
+        rerank=CONFIG_AND_SETTINGS.get("rerank_factor", 4),
+        **kwargs
     )
+    if trained:
+        k = CONFIG_AND_SETTINGS.get("vector_search_top_k", 10)
+        recall = store.evaluate_recall(k=k)
+        ratio = len(store) * store.embeddings.shape[1] * 4 / max(store.quantizer.nbytes, 1)
+        LOGGER.info(
+            f"向量量化（{VECTOR_QUANTIZATION}）完成：内存为 float32 的 1/{ratio:.1f}，Recall@{k}={recall:.3f}"
+        )
 
-    response = query_engine.query(query)
-    return response.response
+
+def _ensure_sparse(persist_dir, key, documents):
+    """
+    混合检索开启时，加载或构建与向量索引同版本的 BM25 索引。BM25 不需要向量化，变化时直接整体重建。
+    """
+    if not HYBRID_SEARCH or key in _SPARSE_POOL:
+        return
+
+    sparse = None
+    try:
+        sparse = NgramBM25Index.load(persist_dir, key)
+    except Exception as e:
+        LOGGER.warning(f"BM25 索引加载失败，将重新构建：{persist_dir}。{e}")
+
+    if sparse is None:
+        if callable(documents):
+            documents = documents()
+        sparse = NgramBM25Index(
+            [doc.doc_id for doc in documents],
+            [doc.get_content(metadata_mode=MetadataMode.LLM) for doc in documents],
+        )
+        sparse.save(persist_dir, key)
+
+    _SPARSE_POOL[key] = sparse
+
+
+def _update_index(index: VectorStoreIndex, documents: Sequence[Document]):
+    """
+    增量更新索引。文档 id 由 JSONSplitter / AutoSplitter 按记录稳定生成，
+    docstore 中记录了每个文档的内容哈希，因此只有新增、变化、删除的文本块会被处理，
+    更新开销与改动量成正比，而与知识库大小无关。
+    """
+    new_ids = {doc.doc_id for doc in documents}
+    old_ids = set(index.ref_doc_info.keys())
+
+    removed = old_ids - new_ids
+    for doc_id in removed:
+        index.delete_ref_doc(doc_id, delete_from_docstore=True)
+
+    # refresh_ref_docs 按文档哈希比较：新文档插入，哈希变化的文档删除后重新插入
+    refreshed = index.refresh_ref_docs(documents)
+    updated = sum(1 for doc, r in zip(documents, refreshed) if r and doc.doc_id in old_ids)
+    added = sum(refreshed) - updated
+
+    LOGGER.info(f"知识库增量更新：新增{added}，更新{updated}，删除{len(removed)}个文本块。")
+
+
+def _persist_index(index, persist_dir, key, model_name, chunk_size, source):
+    os.makedirs(persist_dir, exist_ok=True)
+    index.storage_context.persist(persist_dir=persist_dir)
+    _write_meta(persist_dir, key, model_name, chunk_size, source)
+
+
+def _write_meta(persist_dir, key, model_name, chunk_size, source):
+    # meta.json 最后写入：中途失败时旧 key 保留，下次仍会触发更新
+    with open(os.path.join(persist_dir, "meta.json"), "w", encoding="utf-8") as f:
+        json.dump({
+            "key": key,
+            "model_name": model_name,
+            "chunk_size": chunk_size,
+            "source": _as_sources(source),
+        }, f, ensure_ascii=False, indent=2)
+
+
+def BatchRetrieval(requests: Sequence[tuple],
+                   model_name=CONFIG_AND_SETTINGS["embedding_model"],
+                   chunk_size: int = 512,
+                   similarity_cutoff: float = 0.35) -> list:
+    """
+    批量知识检索：所有查询在一次前向计算中完成向量化，再分别在各自的索引中检索。
+    查询向量与检索结果均有 LRU 缓存，知识库文件变化后旧结果自动失效。
+
+    Args:
+        requests: [(documents, query, top_k, source), ...]，含义同 Retrieval 的同名参数
+        model_name (str): 向量模型名称
+        chunk_size (int): 文本切分长度
+        similarity_cutoff (float): 相似度阈值，低于该值的文本块会被丢弃
+
+    Returns:
+        list[str]: 与 requests 一一对应的检索结果（仅包含证据文本，推理交由下游模型）
+    """
+    if not requests:
+        return []
+
+    Settings.llm = None
+    # 向量模型在进程内只加载一次（见 retrieval/embedding.py）
+    Settings.embed_model = get_embedding_model(model_name)
+
+    loader = _load_numpy_store if VECTOR_BACKEND == "numpy" else _load_index
+    with _LOAD_LOCK:
+        versions, indices = zip(*[
+            loader(documents, Settings.embed_model, model_name, chunk_size, source)
+            for documents, _, _, source in requests
+        ])
+
+    results = [None] * len(requests)
+    pending = []
+    for i, (version, (_, query, top_k, _)) in enumerate(zip(versions, requests)):
+        normalized = normalize_query(query)
+        query_hash = hashlib.sha1(normalized.encode("utf-8")).hexdigest()
+        result_key = (version, query_hash, top_k, similarity_cutoff)
+        results[i] = RESULT_CACHE.get(result_key)
+        if results[i] is None:
+            pending.append((i, normalized, result_key))
+
+    if not pending:
+        return results
+
+    # 查询向量：先查缓存，未命中的查询去重后合并为一个 batch（batch size = 1 时开销主要是调用本身）
+    embeddings = {}
+    for _, normalized, _ in pending:
+        embedding = QUERY_EMBEDDING_CACHE.get((model_name, normalized))
+        if embedding is not None:
+            embeddings[normalized] = embedding
+
+    missing = list(dict.fromkeys(n for _, n, _ in pending if n not in embeddings))
+    if missing:
+        for normalized, embedding in zip(missing, Settings.embed_model.get_text_embedding_batch(missing)):
+            embeddings[normalized] = embedding
+            QUERY_EMBEDDING_CACHE.put((model_name, normalized), embedding)
+
+    # 稠密检索：每个查询得到 [(文本块 ID, 文本, 相似度), ...]，已应用相似度阈值
+    if VECTOR_BACKEND == "numpy":
+        dense = _search_numpy(requests, indices, pending, embeddings, similarity_cutoff)
+    else:
+        dense = _search_llama_index(requests, indices, pending, embeddings, similarity_cutoff)
+
+    for i, _, result_key in pending:
+        _, query, top_k, _ = requests[i]
+        hits = dense[i]
+
+        sparse = _SPARSE_POOL.get(versions[i]) if HYBRID_SEARCH else None
+        if sparse is not None:
+            hits = _fuse(hits, sparse, query, top_k)
+
+        # LongContextReorder：相关度最高的文本块放在上下文两端
+        ordered = long_context_reorder([(text, score) for _, text, score in hits])
+        # 与 ResponseMode.CONTEXT_ONLY 的输出格式保持一致
+        results[i] = "\n\n".join(text for text, _ in ordered)
+        RESULT_CACHE.put(result_key, results[i])
+
+    return results
+
+
+def _fuse(dense_hits, sparse, query, top_k) -> list:
+    """
+    稠密检索与 BM25 检索结果按倒数排名融合，返回融合得分最高的 top_k 个文本块
+    """
+    texts = {doc_id: text for doc_id, text, _ in dense_hits}
+    sparse_ids = []
+    for idx, _ in sparse.search(query, top_k):
+        doc_id = sparse.ids[idx]
+        texts.setdefault(doc_id, sparse.texts[idx])
+        sparse_ids.append(doc_id)
+
+    fused = reciprocal_rank_fusion([[doc_id for doc_id, _, _ in dense_hits], sparse_ids], k=RRF_K)
+    return [(doc_id, texts[doc_id], score) for doc_id, score in fused[:top_k]]
+
+
+def _search_llama_index(requests, indices, pending, embeddings, similarity_cutoff) -> dict:
+    postprocessor = SimilarityPostprocessor(similarity_cutoff=similarity_cutoff)
+
+    dense = {}
+    for i, normalized, _ in pending:
+        _, query, top_k, _ = requests[i]
+        query_bundle = QueryBundle(query_str=query, embedding=embeddings[normalized])
+        nodes = indices[i].as_retriever(similarity_top_k=top_k).retrieve(query_bundle)
+        nodes = postprocessor.postprocess_nodes(nodes, query_bundle=query_bundle)
+
+        dense[i] = [
+            (n.node.ref_doc_id or n.node.node_id, n.node.get_content(metadata_mode=MetadataMode.LLM), n.score or 0.0)
+            for n in nodes
+        ]
+    return dense
+
+
+def _search_numpy(requests, indices, pending, embeddings, similarity_cutoff) -> dict:
+    # 同一向量矩阵上的查询合并为一次矩阵乘法
+    groups = {}
+    for i, normalized, _ in pending:
+        groups.setdefault(id(indices[i]), []).append((i, normalized))
+
+    dense = {}
+    for group in groups.values():
+        store = indices[group[0][0]]
+        top_k = max(requests[i][2] for i, _ in group)
+        hits = store.query_batch(
+            [embeddings[normalized] for _, normalized in group],
+            top_k=top_k,
+            cutoff=similarity_cutoff,
+        )
+        for (i, _), row in zip(group, hits):
+            dense[i] = [
+                (store.chunks[idx]["id"], store.chunks[idx]["text"], score)
+                for idx, score in row[:requests[i][2]]
+            ]
+    return dense
+
+
+def Retrieval(documents: Sequence[Document] | Callable[[], Sequence[Document]] | Any,
+              query,
+              model_name=CONFIG_AND_SETTINGS["embedding_model"],
+              top_k: int = 10,
+              chunk_size: int = 512,
+              source=None) -> str:
+    """
+    Domain-agnostic knowledge retrieval function.
+    Used for retrieving plant disease, crop, and treatment knowledge
+    in the diagnosis pipeline.
+    The vector index is persisted under CACHE_DIR and only rebuilt when
+    the source content, embedding model or chunk size changes.
+    """
+    return BatchRetrieval(
+        [(documents, query, top_k, source)],
+        model_name=model_name,
+        chunk_size=chunk_size,
+    )[0]
 
 # Debug Only
 if __name__ == '__main__':
@@ -0,0 +1,157 @@
+'''
+中文字符 n-gram 倒排索引 + BM25 打分，用于补足稠密检索对农药名称、病害代码等精确词的召回。
+索引与向量索引一同持久化：
+- bm25.npz：词项、倒排表（文档下标 + 预先计算好的 BM25 权重）
+- bm25.json：索引版本与文本块表（id / text）
+'''
+import os
+import re
+import json
+import unicodedata
+import numpy as np
+
+NGRAM_SIZES = (2, 3)
+
+_NON_WORD = re.compile(r"[\W_]+")
+
+
+def ngrams(text: str, sizes=NGRAM_SIZES) -> list:
+    """
+    规范化（NFKC、小写、去除标点空白）后切分为字符 n-gram
+    """
+    text = _NON_WORD.sub("", unicodedata.normalize("NFKC", text).lower())
+    grams = []
+    for n in sizes:
+        grams.extend(text[i:i + n] for i in range(len(text) - n + 1))
+    return grams
+
+
+class NgramBM25Index:
+    """
+    字符 n-gram 倒排索引。每个倒排项保存 (文档下标, BM25 权重)，查询时只需对命中的倒排表做加法。
+
+    Args:
+        ids (list[str]): 文本块 ID
+        texts (list[str]): 文本块内容
+        k1 (float), b (float): BM25 参数
+    """
+
+    def __init__(self, ids: list, texts: list, k1: float = 1.5, b: float = 0.75):
+        self.ids = list(ids)
+        self.texts = list(texts)
+        self.postings = {}  # term -> (docs: int32[], weights: float32[])
+
+        if not self.texts:
+            return
+
+        doc_terms = []
+        for text in self.texts:
+            counts = {}
+            for g in ngrams(text):
+                counts[g] = counts.get(g, 0) + 1
+            doc_terms.append(counts)
+
+        lengths = np.array([sum(c.values()) for c in doc_terms], dtype=np.float32)
+        avgdl = max(float(lengths.mean()), 1.0)
+        n_docs = len(doc_terms)
+
+        raw = {}
+        for doc, counts in enumerate(doc_terms):
+            for term, tf in counts.items():
+                raw.setdefault(term, ([], []))
+                raw[term][0].append(doc)
+                raw[term][1].append(tf)
+
+        for term, (docs, tfs) in raw.items():
+            docs = np.array(docs, dtype=np.int32)
+            tfs = np.array(tfs, dtype=np.float32)
+            idf = np.log(1.0 + (n_docs - len(docs) + 0.5) / (len(docs) + 0.5))
+            norm = k1 * (1.0 - b + b * lengths[docs] / avgdl)
+            self.postings[term] = (docs, (idf * tfs * (k1 + 1.0) / (tfs + norm)).astype(np.float32))
+
+    def __len__(self):
+        return len(self.ids)
+
+    def search(self, query: str, top_k: int) -> list:
+        """
+        Returns:
+            list[tuple[int, float]]: (文档下标, BM25 得分)，按得分降序
+        """
+        if not self.ids:
+            return []
+
+        scores = np.zeros(len(self.ids), dtype=np.float32)
+        counts = {}
+        for g in ngrams(query):
+            counts[g] = counts.get(g, 0) + 1
+        for term, qtf in counts.items():
+            posting = self.postings.get(term)
+            if posting is not None:
+                np.add.at(scores, posting[0], posting[1] * qtf)
+
+        hit = np.flatnonzero(scores)
+        if len(hit) == 0:
+            return []
+        k = min(top_k, len(hit))
+        top = hit[np.argpartition(-scores[hit], k - 1)[:k]]
+        top = top[np.argsort(-scores[top], kind="stable")]
+        return [(int(i), float(scores[i])) for i in top]
+
+    # ==================================================
+    # 持久化
+    # ==================================================
+    def save(self, persist_dir: str, key: str):
+        os.makedirs(persist_dir, exist_ok=True)
+        terms = list(self.postings)
+        docs = [self.postings[t][0] for t in terms]
+        offsets = np.cumsum([0] + [len(d) for d in docs]).astype(np.int64)
+        np.savez(
+            os.path.join(persist_dir, "bm25.npz"),
+            terms=np.array(terms, dtype=str),
+            offsets=offsets,
+            docs=np.concatenate(docs) if docs else np.zeros(0, dtype=np.int32),
+            weights=np.concatenate([self.postings[t][1] for t in terms]) if terms else np.zeros(0, dtype=np.float32),
+        )
+        # json 最后写入，其中的 key 标志索引已完整写入
+        with open(os.path.join(persist_dir, "bm25.json"), "w", encoding="utf-8") as f:
+            json.dump({"key": key, "ids": self.ids, "texts": self.texts}, f, ensure_ascii=False)
+
+    @classmethod
+    def load(cls, persist_dir: str, key: str):
+        """
+        加载持久化索引。不存在或版本不一致时返回 None。
+        """
+        meta_path = os.path.join(persist_dir, "bm25.json")
+        if not os.path.isfile(meta_path):
+            return None
+        with open(meta_path, "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        if meta.get("key") != key:
+            return None
+
+        data = np.load(os.path.join(persist_dir, "bm25.npz"))
+        index = cls([], [])
+        index.ids, index.texts = meta["ids"], meta["texts"]
+        offsets, docs, weights = data["offsets"], data["docs"], data["weights"]
+        for i, term in enumerate(data["terms"].tolist()):
+            start, end = offsets[i], offsets[i + 1]
+            index.postings[term] = (docs[start:end], weights[start:end])
+        return index
+
+
+def reciprocal_rank_fusion(rankings: list, k: int = 60) -> list:
+    """
+    倒数排名融合（RRF）：score(d) = Σ 1 / (k + rank)
+
+    Args:
+        rankings (list[list]): 多路检索结果，每路为按相关度降序排列的文档 ID 列表
+        k (int): 平滑常数
+
+    Returns:
+        list[tuple[Any, float]]: (文档 ID, 融合得分)，按得分降序
+    """
+    fused = {}
+    for ranking in rankings:
+        for rank, doc_id in enumerate(ranking, start=1):
+            fused[doc_id] = fused.get(doc_id, 0.0) + 1.0 / (k + rank)
+    return sorted(fused.items(), key=lambda x: x[1], reverse=True)
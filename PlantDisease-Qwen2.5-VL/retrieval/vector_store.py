@@ -0,0 +1,245 @@
+'''
+基于 NumPy 内存映射的暴力向量检索后端，适用于数千文本块规模的小型知识库。
+- embeddings_<tag>.npy：归一化后的 float16 向量矩阵 (N, D)，以 mmap 方式打开，多进程共享同一份页缓存
+- chunks_<tag>.json：与矩阵行一一对应的文本块表（id / hash / text）
+- quant_<kind>[_<参数>]_<tag>.npz：可选的量化编码，文件名包含量化参数（见 retrieval/quantize.py 的 quant_name）
+tag 为索引版本，每个版本写入新文件（Windows 下无法覆盖正在被 mmap 的文件）。
+本模块只依赖 NumPy，不引入 llama_index 等重量级依赖。
+'''
+import os
+import json
+import glob
+import numpy as np
+
+from .quantize import QUANTIZERS, SCAN_BLOCK, build_quantizer, quant_name, recall_at_k
+
+
+def _paths(persist_dir: str, tag: str) -> tuple:
+    return (
+        os.path.join(persist_dir, f"embeddings_{tag}.npy"),
+        os.path.join(persist_dir, f"chunks_{tag}.json"),
+    )
+
+
+def _normalize(vectors: np.ndarray) -> np.ndarray:
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+class NumpyVectorStore:
+    """
+    内存映射的向量矩阵 + 文本块表
+
+    Args:
+        embeddings (np.ndarray): (N, D) 归一化 float16 向量，通常为 np.memmap
+        chunks (list[dict]): 与向量行对应的文本块，包含 "id", "hash", "text"
+        quantizer: 量化器（Int8Quantizer / ProductQuantizer），设置后先用量化分数粗排，再用原始向量精排
+        rerank (int): 粗排候选数量为 top_k * rerank
+    """
+
+    def __init__(self, embeddings: np.ndarray, chunks: list, quantizer=None, rerank: int = 4):
+        if len(embeddings) != len(chunks):
+            raise ValueError(f"向量数量({len(embeddings)})与文本块数量({len(chunks)})不一致")
+        self.embeddings = embeddings
+        self.chunks = chunks
+        self.quantizer = quantizer
+        self.rerank = rerank
+        self.reused = 0  # 最近一次构建时复用的向量数量
+
+    def __len__(self):
+        return len(self.chunks)
+
+    # ==================================================
+    # 构建 / 加载
+    # ==================================================
+    @classmethod
+    def load(cls, persist_dir: str, tag: str) -> "NumpyVectorStore":
+        embeddings_path, chunks_path = _paths(persist_dir, tag)
+        embeddings = np.load(embeddings_path, mmap_mode="r")
+        with open(chunks_path, "r", encoding="utf-8") as f:
+            chunks = json.load(f)
+        return cls(embeddings, chunks)
+
+    @classmethod
+    def build(cls, persist_dir: str, tag: str, chunks: list, embed_fn,
+              previous: "NumpyVectorStore" = None, batch_size: int = 64) -> "NumpyVectorStore":
+        """
+        构建并持久化向量矩阵。若提供 previous，哈希未变化的文本块直接复用旧向量，只对新增或变化的文本块向量化。
+
+        Args:
+            persist_dir (str): 保存目录
+            tag (str): 索引版本
+            chunks (list[dict]): 文本块表，包含 "id", "hash", "text"，可选 "embed_text"（用于向量化的文本）
+            embed_fn (callable): list[str] -> list[list[float]]
+            previous (NumpyVectorStore): 旧版本向量库
+            batch_size (int): 每批向量化的文本块数量
+        """
+        reuse = {}
+        if previous is not None:
+            reuse = {c["hash"]: i for i, c in enumerate(previous.chunks)}
+
+        todo = [i for i, c in enumerate(chunks) if c["hash"] not in reuse]
+        new_vectors = []
+        for start in range(0, len(todo), batch_size):
+            texts = [chunks[i].get("embed_text", chunks[i]["text"]) for i in todo[start:start + batch_size]]
+            new_vectors.append(_normalize(embed_fn(texts)))
+
+        dim = (
+            new_vectors[0].shape[1] if new_vectors
+            else previous.embeddings.shape[1] if previous is not None and len(previous)
+            else 0
+        )
+        matrix = np.zeros((len(chunks), dim), dtype=np.float16)
+        if new_vectors:
+            matrix[todo] = np.concatenate(new_vectors).astype(np.float16)
+        for i, c in enumerate(chunks):
+            if c["hash"] in reuse:
+                matrix[i] = previous.embeddings[reuse[c["hash"]]]
+
+        # 先写临时文件再改名，避免其他进程 mmap 到写了一半的文件
+        os.makedirs(persist_dir, exist_ok=True)
+        embeddings_path, chunks_path = _paths(persist_dir, tag)
+        with open(embeddings_path + ".tmp", "wb") as f:
+            np.save(f, matrix)
+        os.replace(embeddings_path + ".tmp", embeddings_path)
+
+        table = [{k: c[k] for k in ("id", "hash", "text")} for c in chunks]
+        with open(chunks_path, "w", encoding="utf-8") as f:
+            json.dump(table, f, ensure_ascii=False)
+
+        # 清理旧版本文件；仍被其他进程映射的文件删除失败时留待下次清理
+        for path in glob.glob(os.path.join(persist_dir, "*_*")):
+            name = os.path.splitext(os.path.basename(path))[0]
+            if name.split("_")[0] in ("embeddings", "chunks", "quant") and not name.endswith(f"_{tag}"):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+        store = cls.load(persist_dir, tag)
+        store.reused = len(chunks) - len(todo)
+        return store
+
+    # ==================================================
+    # 量化
+    # ==================================================
+    def quantize(self, kind: str, persist_dir: str, tag: str, rerank: int = 4, **kwargs) -> bool:
+        """
+        启用量化粗排。已有同版本、同参数的编码时直接加载，否则训练并保存。
+
+        Args:
+            kind (str): "int8" 或 "pq"
+            rerank (int): 精排候选倍数
+            **kwargs: 量化器参数，如 pq 的 m（子空间数量）、ks（聚类中心数量）
+
+        Returns:
+            bool: 是否为新训练的编码
+        """
+        self.rerank = rerank
+        path = os.path.join(persist_dir, f"quant_{quant_name(kind, **kwargs)}_{tag}.npz")
+        if os.path.isfile(path):
+            with np.load(path) as state:
+                self.quantizer = QUANTIZERS[kind].from_state({k: state[k] for k in state.files})
+            return False
+
+        self.quantizer = build_quantizer(kind, self.embeddings, **kwargs)
+        np.savez(path, **self.quantizer.state())
+        return True
+
+    def evaluate_recall(self, k: int = 10, n_queries: int = 200, queries=None,
+                        noise: float = 1.0, seed: int = 0) -> float:
+        """
+        计算量化检索相对 float 精确检索的 Recall@k。
+        直接以知识库中的向量作为查询时，精确结果的第一名总是它自身，召回率会偏高；
+        未提供真实查询（queries）时，以随机抽取的向量加上同等模长的高斯噪声作为查询（余弦相似度约 0.7）。
+        """
+        if self.quantizer is None or len(self) == 0:
+            return 1.0
+        if queries is None:
+            rng = np.random.default_rng(seed)
+            base = np.asarray(self.embeddings[np.sort(rng.choice(len(self), size=min(n_queries, len(self)),
+                                                                 replace=False))], dtype=np.float32)
+            queries = base + noise * _normalize(rng.normal(size=base.shape))
+        quantizer, self.quantizer = self.quantizer, None
+        try:
+            exact = [[i for i, _ in row] for row in self.query_batch(queries, k)]
+        finally:
+            self.quantizer = quantizer
+        approx = [[i for i, _ in row] for row in self.query_batch(queries, k)]
+        return recall_at_k(exact, approx, k)
+
+    # ==================================================
+    # 检索
+    # ==================================================
+    def query_batch(self, queries, top_k: int, cutoff: float = 0.0) -> list:
+        """
+        一次矩阵乘法完成多个查询的打分，argpartition 取 top-k，同时应用相似度阈值。
+
+        Args:
+            queries: (B, D) 查询向量
+            top_k (int): 每个查询返回的最大数量
+            cutoff (float): 相似度阈值
+
+        Returns:
+            list[list[tuple[int, float]]]: 每个查询的 (行号, 相似度)，按相似度降序
+        """
+        queries = _normalize(np.atleast_2d(queries))
+        if len(self) == 0:
+            return [[] for _ in range(len(queries))]
+
+        if self.quantizer is not None:
+            return self._query_quantized(queries, top_k, cutoff)
+
+        scores = self._exact_scores(queries)  # (B, N)
+        k = min(top_k, scores.shape[1])
+        top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+
+        results = []
+        for row, idx in zip(scores, top):
+            idx = idx[row[idx] >= cutoff]
+            idx = idx[np.argsort(-row[idx], kind="stable")]
+            results.append([(int(i), float(row[i])) for i in idx])
+        return results
+
+    def _exact_scores(self, queries: np.ndarray) -> np.ndarray:
+        # 按 SCAN_BLOCK 行分块转换为 float32，临时矩阵大小固定，mmap 的页缓存不会被整体复制到进程私有内存
+        out = np.empty((len(queries), len(self)), dtype=np.float32)
+        for start in range(0, len(self), SCAN_BLOCK):
+            block = np.asarray(self.embeddings[start:start + SCAN_BLOCK], dtype=np.float32)
+            out[:, start:start + SCAN_BLOCK] = queries @ block.T
+        return out
+
+    def _query_quantized(self, queries, top_k: int, cutoff: float) -> list:
+        # 粗排：量化分数取 top_k * rerank 个候选
+        approx = self.quantizer.scores(queries)
+        n = min(top_k * self.rerank, approx.shape[1])
+        shortlist = np.argpartition(-approx, n - 1, axis=1)[:, :n]
+
+        results = []
+        for q, cand in zip(queries, shortlist):
+            # 精排：只读取候选行的 float16 原始向量
+            cand = np.sort(cand)
+            exact = np.asarray(self.embeddings[cand], dtype=np.float32) @ q
+            keep = exact >= cutoff
+            cand, exact = cand[keep], exact[keep]
+            order = np.argsort(-exact, kind="stable")[:top_k]
+            results.append([(int(cand[i]), float(exact[i])) for i in order])
+        return results
+
+    def query(self, query, top_k: int, cutoff: float = 0.0) -> list:
+        return self.query_batch(query, top_k, cutoff)[0]
+
+
+def long_context_reorder(hits: list) -> list:
+    """
+    与 llama_index LongContextReorder 相同的重排：相关度最高的文本块放在上下文两端。
+    hits 为 (行号, 相似度) 列表。
+    """
+    ordered = []
+    for i, hit in enumerate(sorted(hits, key=lambda h: h[1])):
+        if i % 2 == 0:
+            ordered.insert(0, hit)
+        else:
+            ordered.append(hit)
+    return ordered
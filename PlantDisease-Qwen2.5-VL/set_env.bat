@@ -5,6 +5,7 @@ set MMPROJ_PATH=G:\huggingface\Qwen2.5-VL-7B-Instruct-GGUF\Qwen2.5-VL-7B-Instruc
 set gpu-layers=-1
 set keep=128
 set ctx-size=32768
+set parallel=1
 set temperature=0.1
 set top-k=4
 set top-p=0.8
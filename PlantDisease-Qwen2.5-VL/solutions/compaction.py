@@ -0,0 +1,123 @@
+"""
+Chat Compaction
+长对话的滚动摘要压缩：对话历史超过阈值后，较早的若干轮对话由模型生成的摘要替代，最近几轮保持原文。
+摘要在两轮对话之间于后台生成，不阻塞用户输入；下一轮开始时若摘要已就绪则替换，否则本轮照常进行。
+被摘要的对话中若带有当前图像，图像随摘要消息保留。
+摘要请求固定到对话 slot 以外的 slot，不覆盖对话前缀的 KV cache，也不会排在下一轮对话之前；
+llama-server 只有一个 slot 时不启用后台压缩。
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+
+from utils import CONFIG_AND_SETTINGS, LOGGER
+from solutions.llm_client import call_llama_server, extract_answer, LLM_SLOTS, CHAT_SLOT
+from solutions.token_budget import count_message_tokens, latest_images
+
+SUMMARY_PREFIX = "【此前对话摘要】\n"
+SUMMARY_ACK = "好的，我已了解此前的对话内容。"
+
+SUMMARY_PROMPT = (
+    "以下是用户与植物病害诊断助手的一段对话记录。"
+    "请将其压缩为简洁的摘要，保留作物种类、症状描述、诊断结论、用户提供的关键信息（地点、时间、环境、用药情况等）"
+    "以及已经给出的防治建议，省略寒暄与重复内容。摘要不超过{limit}字，直接输出摘要正文。\n\n"
+)
+
+# 摘要请求使用的 slot：对话 slot 以外的第一个 slot，只有一个 slot 时为 None
+SUMMARY_SLOT = next((s for s in range(LLM_SLOTS) if s != CHAT_SLOT), None)
+
+
+class ChatCompactor:
+    """
+    Args:
+        threshold (int): 历史消息超过该 token 数时开始压缩
+        keep_turns (int): 保持原文的最近对话轮数
+        summary_chars (int): 摘要长度上限（字）
+        slot (int): 摘要请求使用的 llama-server slot，为 None 时不压缩
+    """
+
+    def __init__(self,
+                 threshold: int = CONFIG_AND_SETTINGS.get("compaction_threshold_tokens", 8192),
+                 keep_turns: int = CONFIG_AND_SETTINGS.get("compaction_keep_turns", 4),
+                 summary_chars: int = CONFIG_AND_SETTINGS.get("compaction_summary_chars", 800),
+                 slot: int = SUMMARY_SLOT):
+        self.threshold = threshold
+        self.keep_turns = keep_turns
+        self.summary_chars = summary_chars
+        self.slot = slot
+        if slot is None:
+            LOGGER.warning("llama-server只有一个slot，后台生成摘要会覆盖对话的提示词缓存并排在下一轮对话之前，"
+                           "对话压缩已停用。如需使用，请将 server_config.yaml 的 parallel 设为 2 以上。")
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="compaction")
+        self._job = None  # (被摘要的消息对象, Future)
+
+    @staticmethod
+    def _turn_starts(messages: list) -> list:
+        # 历史消息为 messages[1:-1]，每轮从一条用户消息开始
+        return [i for i in range(1, len(messages) - 1) if messages[i]["role"] == "user"]
+
+    def schedule(self, messages: list):
+        """
+        一轮对话结束后调用：历史超过阈值时，在后台为较早的对话生成摘要
+        """
+        if self.slot is None or (self._job is not None and not self._job[1].done()):
+            return
+
+        starts = self._turn_starts(messages)
+        if len(starts) <= self.keep_turns:
+            return
+        history = sum(count_message_tokens(m) for m in messages[1:-1])
+        if history <= self.threshold:
+            return
+
+        cut = starts[-self.keep_turns] if self.keep_turns else len(messages) - 1
+        snapshot = messages[1:cut]
+        self._job = (snapshot, self._executor.submit(self._summarize, messages[0], list(snapshot)))
+        LOGGER.debug(f"对话历史约{history} token，正在后台压缩最早的{len(snapshot)}条消息。")
+
+    def apply(self, messages: list) -> list:
+        """
+        新一轮对话开始前调用：摘要已就绪且被摘要的消息仍位于历史开头时，原地替换为摘要
+        """
+        if self._job is None or not self._job[1].done():
+            return messages
+        snapshot, future = self._job
+        self._job = None
+
+        try:
+            summary = future.result()
+        except Exception as e:
+            LOGGER.warning(f"对话摘要生成失败，保留原始历史：{e}")
+            return messages
+
+        # 期间历史被裁剪或切换到简报模式时，快照已失效
+        if len(messages) < len(snapshot) + 2 or any(a is not b for a, b in zip(messages[1:], snapshot)):
+            return messages
+
+        # 当前图像位于被摘要的消息中时，随摘要消息保留（图像在前、文本在后）
+        img_index, img_parts = latest_images(messages)
+        images = img_parts if img_index is not None and img_index <= len(snapshot) else []
+        messages[1:1 + len(snapshot)] = [
+            {"role": "user", "content": images + [{"type": "text", "text": SUMMARY_PREFIX + summary}]},
+            {"role": "assistant", "content": SUMMARY_ACK},
+        ]
+        LOGGER.info(f"已将最早的{len(snapshot)}条对话消息压缩为摘要。")
+        return messages
+
+    def _summarize(self, system_message: dict, snapshot: list) -> str:
+        lines = []
+        for m in snapshot:
+            content = m["content"]
+            if isinstance(content, list):
+                # 图像不参与摘要，只保留文本
+                content = "\n".join(c["text"] for c in content if c["type"] == "text")
+            if content.startswith(SUMMARY_PREFIX):
+                lines.append(content)
+            elif content and content != SUMMARY_ACK:
+                role = "用户" if m["role"] == "user" else "助手"
+                lines.append(f"{role}：{extract_answer(content)}")
+
+        prompt = SUMMARY_PROMPT.format(limit=self.summary_chars) + "\n\n".join(lines)
+        return call_llama_server(
+            [system_message, {"role": "user", "content": [{"type": "text", "text": prompt}]}],
+            extra_params={"n_predict": self.summary_chars * 2, "id_slot": self.slot}
+        ).strip()
@@ -5,7 +5,6 @@ LangChain-based Prototype for Plant Disease Diagnosis
 
 import sys
 import os
-from langchain_community.embeddings import HuggingFaceEmbeddings
 from langchain.prompts.prompt import PromptTemplate
 from langchain_core.output_parsers import StrOutputParser
 from langchain_core.runnables import RunnablePassthrough
@@ -15,6 +14,7 @@ sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 from utils import CONFIG_AND_SETTINGS
 from engine.model import Qwen
 from retrieval.RAGHandler_langchain import load_file, FAISSWrapper
+from retrieval.embedding import get_embedding_model
 
 
 # ==================================================
@@ -61,9 +61,10 @@ def initialize_agent():
 
     # ===== 初始化模型与向量库 =====
     llm = Qwen()
-    embeddings = HuggingFaceEmbeddings(
-        model_name=embedding_model_dict[EMBEDDING_MODEL],
-        model_kwargs={"device": EMBEDDING_DEVICE}
+    embeddings = get_embedding_model(
+        embedding_model_dict[EMBEDDING_MODEL],
+        EMBEDDING_DEVICE,
+        backend="langchain"
     )
 
     docs = []
@@ -7,20 +7,17 @@ Based on Plant-Qwen2.5-VL (LoRA-adapted Qwen2.5-VL)
 
 import sys
 import os
-import json
 import time
-import re
-import requests
 from pathlib import Path
-from copy import copy
 from typing import List
+from concurrent.futures import ThreadPoolExecutor, Future
 from tqdm import tqdm
 
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
-from utils import CONFIG_AND_SETTINGS, SERVER_CONFIG, LOGGER
-from utils.img_handler import image_to_base64_data_uri
-from utils.info_extractor import extract_img_data
+from utils import CONFIG_AND_SETTINGS, LOGGER
+from utils.info_extractor import image_record, image_records
+from utils.roi import roi_views, roi_notes, ROI_ENABLED
 from utils.prompter import BasePrompter
 from utils.save import briefing2file, fullreport2file
 
@@ -31,72 +28,42 @@ from retrieval.plantRetrieval import (
     retrieve_treatment
 )
 from retrieval.retrieval import Retrieval
-from retrieval.RAGHandler import JSONSplitter, AutoSplitter
+from retrieval.RAGHandler import AutoSplitter
+from solutions.scheduler import Node, run_graph, SlotPool
+from solutions.llm_client import (
+    call_llama_server,
+    extract_answer,
+    http_stats,
+    LLM_SLOTS,
+    CHAT_SLOT,
+    BRIEFING_SLOT
+)
 
 # Prompt 前缀
 PREINFO = "农业背景知识：\n"
 PREQ = "诊断任务：\n"
 TIME = f"当前时间：{time.strftime('%Y-%m-%d %H:%M', time.localtime())}\n"
 
-
-# ============================
-# LLM 调用（Plant-Qwen2.5-VL）
-# ============================
-def call_llama_server(
-    messages,
-    server_url=f"http://localhost:{SERVER_CONFIG['PORT']}/v1/chat/completions",
-    stream=False,
-    extra_params=None,
-    use_tqdm=True
-):
-    payload = {
-        # 显式使用 LoRA 微调后的模型
-        "model": "plant-qwen2.5-vl",
-        "messages": messages,
-        "n_predict": 4096,
-        "stop": ["<|im_end|>"],
-        "stream": True if stream else False
-    }
-
-    if extra_params:
-        payload.update(extra_params)
-
-    response = requests.post(
-        server_url, json=payload, timeout=1000, stream=stream
-    )
-    response.raise_for_status()
-
-    if stream:
-        result = ""
-        for line in response.iter_lines():
-            line = line.decode("utf-8")
-            if not line.startswith("data: {"):
-                continue
-            data = json.loads(line[len("data:"):].strip())
-            content = data.get("choices", [{}])[0].get("delta", {}).get("content", "")
-            if content:
-                result += content
-                tqdm.write(content, end="", nolock=True) if use_tqdm else print(content, end="", flush=True)
-        return result
-    else:
-        return response.json()["choices"][0]["message"]["content"]
+# 进程内所有诊断流程共享同一个 slot 池
+_SLOT_POOL = SlotPool(LLM_SLOTS)
 
 
 # ============================
 # Message 构造工具
 # ============================
-def build_img_message(messages, img_path, clean=True):
-    img_msg = {
-        "type": "image_url",
-        "image_url": {
-            "url": image_to_base64_data_uri(img_path, prefix=True)
-        }
-    }
+def build_img_message(messages, img_path, clean=True, data_uri=None, mode="chat"):
+    """
+    data_uri: 预先编码好的图像 data URI（见 prefetch），为空时按 mode 的像素预算现场编码；
+              为列表时依次加入多张图片（病斑区域放大模式下的全图缩略图与放大图，见 utils/roi.py）
+    mode: 'briefing' / 'chat'，见 utils/img_handler.py 的 RESIZE_POLICY
+    """
+    uris = data_uri if isinstance(data_uri, list) else [data_uri or image_record(img_path).data_uri(mode)]
+    img_msgs = [{"type": "image_url", "image_url": {"url": uri}} for uri in uris]
     if clean:
         for m in messages:
             if m["role"] == "user":
                 m["content"] = [c for c in m["content"] if c["type"] != "image_url"]
-    messages[-1]["content"].append(img_msg)
+    messages[-1]["content"].extend(img_msgs)
     return messages
 
 
@@ -120,16 +87,165 @@ def build_assistant_message(messages, completion):
     return messages
 
 
-def extract_answer(text: str, tag="answer") -> str:
-    pattern = f"<{tag}>(.*?)</{tag}>"
-    match = re.search(pattern, text, re.DOTALL | re.IGNORECASE)
-    return match.group(1).strip() if match else text
+# ============================
+# 图像预处理（推测式预取）
+# ============================
+_PREFETCH_POOL = ThreadPoolExecutor(max_workers=1, thread_name_prefix="prefetch")
+
+
+PREFETCH_MODES = ("briefing", "chat")
+
+
+def prepare_images(messages, img_paths: List[Path], prefill: bool = False, records=None,
+                   modes=PREFETCH_MODES) -> dict:
+    """
+    在调用线程中同步完成 prefetch 的全部预处理，返回值与 prefetch 的结果相同。
+    批量诊断时各任务在自己的线程中调用，图像编码与病斑区域裁剪随任务并发执行，不经过单线程的预取线程池。
+
+    Args:
+        modes: 需要准备的模式，按可能性从高到低排列。交互式输入时还不知道用户会进入哪种模式，两种都准备；
+               批量诊断只需 "briefing"
+    """
+    return _prefetch_worker(_copy_messages(messages[:-1]), list(img_paths), prefill, records, tuple(modes))
+
+
+def _image_parts(uris) -> list:
+    # 病斑区域放大模式下一张图像对应多张输入图片
+    return [{"type": "image_url", "image_url": {"url": u}}
+            for v in uris for u in (v if isinstance(v, list) else [v])]
+
+
+def warmup_messages(history: list, uris, mode: str) -> list:
+    """
+    预填充请求的消息，与该模式实际发送的消息在图像之前逐字节相同：
+    - 简报模式：[系统提示词, 图像...]，历史消息在简报前被清除
+    - 对话模式：历史消息（build_img_message 会移除其中的旧图像）+ 本轮图像
+
+    Args:
+        history: 本轮用户消息之前的消息（含系统提示词）
+        uris: 按输入顺序排列的 data URI（或病斑区域放大模式下的 data URI 列表）
+    """
+    if mode == "briefing":
+        return [history[0], {"role": "user", "content": _image_parts(uris)}]
+    prefix = [
+        {**m, "content": [c for c in m["content"] if c["type"] != "image_url"]}
+        if m["role"] == "user" and isinstance(m["content"], list) else m
+        for m in history
+    ]
+    return prefix + [{"role": "user", "content": _image_parts(uris)}]
+
+
+def _prefill(history: list, data_uris: dict, modes: tuple):
+    """
+    不生成任何token，只让llama-server对消息前缀与图像做一次预填充，写入该模式之后实际使用的 slot 的prompt缓存：
+    简报模式为 BRIEFING_SLOT（简报流程的第一个阶段优先使用该 slot），对话模式为 CHAT_SLOT。
+    只有一个 slot 时，第二次预填充会覆盖第一次，因此只预填充最可能的模式（modes[0]）。
+    """
+    if LLM_SLOTS == 1:
+        modes = modes[:1]
+    for mode in modes:
+        slot = BRIEFING_SLOT if mode == "briefing" else CHAT_SLOT
+        try:
+            call_llama_server(
+                warmup_messages(history, data_uris[mode].values(), mode),
+                extra_params={"n_predict": 0, "cache_prompt": True, "id_slot": slot}
+            )
+        except Exception as e:
+            LOGGER.debug(f"预填充请求失败，已忽略：{e}")
+
+
+def _prefetch_worker(history: list, img_paths: List[Path], prefill: bool, records=None,
+                     modes=PREFETCH_MODES) -> dict:
+    records = records or image_records(img_paths)
+    # 预算相同的模式第二次直接命中缓存
+    data_uris = {
+        mode: {img_path: r.data_uri(mode) for img_path, r in zip(img_paths, records)}
+        for mode in modes
+    }
+    resize = {
+        mode: {img_path: r.resize_plan(mode) for img_path, r in zip(img_paths, records)}
+        for mode in modes
+    }
+    img_data = {r.filename: r.file_info() for r in records}
+    bbox_data = {r.filename: r.bbox for r in records}
+
+    # 病斑区域放大模式：简报模式发送全图缩略图与病斑放大图，代替原图
+    roi = {}
+    if ROI_ENABLED and "briefing" in modes:
+        for img_path, r in zip(img_paths, records):
+            try:
+                views = roi_views(r)
+            except Exception as e:
+                LOGGER.warning(f"病斑区域裁剪失败，按原图发送：{r.path}，错误：{e}")
+                views = None
+            if views:
+                roi[r.filename] = views
+                data_uris["briefing"][img_path] = [views["overview"]["data_uri"]] + [
+                    c["data_uri"] for c in views["crops"]
+                ]
+
+    if prefill:
+        _prefill(history, data_uris, modes)
+
+    return {"data_uris": data_uris, "resize": resize, "img_data": img_data, "bbox_data": bbox_data,
+            "records": records, "roi": roi}
+
+
+def prefetch(messages, img_paths: List[Path], prefill=CONFIG_AND_SETTINGS.get("prefetch_prefill", False),
+             records=None, modes=PREFETCH_MODES) -> Future:
+    """
+    图像路径通过检查后立即在后台开始预处理，与用户键入问题的时间重叠：
+    base64编码、图像元信息与病斑区域提取，以及可选的llama-server预填充。
+    records: 已获取的 ImageRecord 列表（批量诊断时在收集任务阶段获取），为空时按路径获取
+    modes: 准备的模式，按可能性从高到低排列（如把上一轮使用的模式放在前面）。
+           只有一个 slot 时只预填充 modes[0]
+
+    Returns:
+        Future: 结果为 {"data_uris": {mode: {path: uri}}, "resize": {mode: {path: resize_plan}},
+                        "img_data": dict, "bbox_data": dict, "records": [ImageRecord],
+                        "roi": {filename: roi_views}}
+                病斑区域放大模式下，data_uris["briefing"] 中对应图像的值为 [全图缩略图, 放大图...]
+    """
+    return _PREFETCH_POOL.submit(_prefetch_worker, _copy_messages(messages[:-1]), list(img_paths), prefill,
+                                 records, tuple(modes))
+
+
+# ============================
+# 对话模式
+# ============================
+def chat(messages, img_paths: List[Path], file_paths: List[Path] = None):
+    """
+    常规对话。若上传了知识库文档，则先从文档中检索与问题相关的内容，插入到本轮问题之前。
+    """
+    if file_paths:
+        question = messages[-1]["content"][-1]["text"]
+        knowledge = Retrieval(
+            lambda: AutoSplitter(list(file_paths)).split(),
+            question,
+            top_k=CONFIG_AND_SETTINGS.get("vector_search_top_k", 10),
+            source=file_paths
+        )
+        if knowledge:
+            messages = build_text_message(messages, PREINFO + knowledge, insert=-1, clean=False)
+
+    # 固定到对话 slot，历史前缀与预填充的图像留在同一个 slot 的缓存中
+    output = call_llama_server(messages, stream=True, use_tqdm=False,
+                               extra_params={"id_slot": CHAT_SLOT, "cache_prompt": True})
+    print()
+    build_assistant_message(messages, output)
+    return output
 
 
 # ============================
 # 多阶段植物病害诊断流程
 # ============================
-def briefing(messages, img_paths: List[Path], show_process=False):
+def _copy_messages(messages):
+    # 各阶段并发构造提示词，每个阶段使用独立的消息副本（图像 data URI 字符串共享，不复制）
+    return [{**m, "content": list(m["content"]) if isinstance(m["content"], list) else m["content"]}
+            for m in messages]
+
+
+def briefing(messages, img_paths: List[Path], show_process=False, prefetched=None, progress=True, report_name=None):
     """
     多阶段植物病害智能诊断：
     Stage 1: 作物与环境概述
@@ -137,114 +253,147 @@ def briefing(messages, img_paths: List[Path], show_process=False):
     Stage 3: 病害类型精细识别（RAG）
     Stage 4: 病害发展趋势分析
     Stage 5: 风险评估与防治建议
-    """
 
-    pbar = tqdm(total=5, desc="植物病害诊断中", ncols=100)
-    stream = (show_process == "stream")
-    show = (show_process == "stage")
+    各阶段按依赖关系调度（见 solutions/scheduler.py）：
+    Stage 1 与 Stage 2 互不依赖；作物知识检索在 Stage 1 完成后即开始，与 Stage 2 的生成重叠；
+    Stage 4 与防治知识检索、Stage 5 互不依赖。
+    llama-server 以 --parallel N 启动时，相互独立的阶段分配到不同 slot 并行生成。
 
-    messages_bak = copy(messages)
-    prompter = BasePrompter(img_path=img_paths)
+    提示词前缀复用：各阶段的消息都是 [系统提示词, 图像..., 本阶段文本]，前缀逐字节相同；
+    请求固定到本次诊断的 slot（id_slot）并开启 cache_prompt，后续阶段只需计算新增的文本 token。
 
-    # ===== Stage 1 作物与环境概述 =====
-    metadata = extract_img_data(img_paths)
-    crop_env_info = prompter.regroup(prompter.IMinfo_prompt())
-
-    stage_1_prompt = (
-        "请根据图像判断作物类型、生育阶段以及生长环境状况，"
-        "并对整体健康状态进行初步评估。"
-        "在<think> </think>中给出分析过程，"
-        "在<answer> </answer>中给出简要诊断概述。"
-    )
+    prefetched: prefetch 的结果，包含预先提取的图像元信息与病斑区域信息
+    progress: 是否显示进度条（批量诊断时由外层统一显示）
+    report_name: 报告文件名后缀，批量诊断时用于区分同一分钟内生成的多份报告
 
-    stage_1 = PREINFO + crop_env_info + TIME + PREQ + stage_1_prompt
-    messages_1 = build_text_message(messages, stage_1)
-    output_1 = call_llama_server(messages_1, stream=stream)
-    match_1 = extract_answer(output_1)
-
-    if show:
-        tqdm.write(f"\n[Stage 1]\n{output_1}")
-    pbar.update(1)
+    Returns:
+        str: 简报内容（Stage 5 的 answer）
+    """
 
-    # ===== Stage 2 病斑区域核查 =====
-    od_info = prompter.regroup(prompter.ODinfo_prompt())
-
-    stage_2_prompt = (
-        "图像中标注了一些疑似病害症状区域（ROI）。"
-        "请逐一判断这些区域是否为有效病斑，"
-        "并检查是否存在被遗漏的重要症状区域。"
-        "在<think> </think>中给出分析，"
-        "在<answer> </answer>中给出最终确认的病斑描述。"
+    slots = LLM_SLOTS
+    pbar = tqdm(total=5, desc="植物病害诊断中", ncols=100, disable=not progress)
+    # 多个阶段同时生成时逐token输出会相互交错，改为每个阶段完成后整段输出
+    stream = (show_process == "stream") and slots == 1
+    show = (show_process == "stage") or (show_process == "stream" and slots > 1)
+
+    prefetched = prefetched or {}
+    records = prefetched.get("records")
+    if records and any([r.refresh() for r in records]):
+        # 预取之后元数据或检测结果才生成 / 更新：提示词改用记录中的最新内容（已发送的图像与放大视图不变）
+        LOGGER.debug("预取后图像元数据或病斑检测结果已更新，提示词使用最新内容。")
+        prefetched = {**prefetched, "img_data": None, "bbox_data": None}
+    prompter = BasePrompter(
+        img_path=img_paths,
+        img_data=prefetched.get("img_data"),
+        bbox_data=prefetched.get("bbox_data"),
+        records=prefetched.get("records"),
+        roi=prefetched.get("roi")
     )
+    prompts = {}
+    stage_stats = {}
+
+    def llm_stage(n, build_prompt):
+        def run(slot=None, **deps):
+            prompt = build_prompt(**deps)
+            prompts[n] = prompt
+            stage_stats[n] = {"slot": slot}
+            # 图像在前、阶段文本在后，保证各阶段共享的前缀逐字节相同
+            output = call_llama_server(
+                build_text_message(_copy_messages(messages), prompt),
+                stream=stream,
+                extra_params={"id_slot": slot, "cache_prompt": True},
+                stats=stage_stats[n]
+            )
+            LOGGER.debug(
+                f"Stage {n}：slot {slot}，复用缓存 {stage_stats[n].get('cached_tokens')} token，"
+                f"新计算 {stage_stats[n].get('prompt_tokens')} token"
+            )
+            if show:
+                tqdm.write(f"\n[Stage {n}]\n{output}")
+            pbar.update(1)
+            return output
+        return run
 
-    stage_2 = PREINFO + od_info + PREQ + stage_2_prompt
-    messages_2 = build_text_message(messages, stage_2)
-    output_2 = call_llama_server(messages_2, stream=stream)
-    match_2 = extract_answer(output_2)
+    # ===== Stage 1 作物与环境概述 =====
+    def stage_1_prompt():
+        crop_env_info = prompter.regroup(prompter.IMinfo_prompt())
+        return PREINFO + crop_env_info + TIME + PREQ + (
+            "请根据图像判断作物类型、生育阶段以及生长环境状况，"
+            "并对整体健康状态进行初步评估。"
+            "在<think> </think>中给出分析过程，"
+            "在<answer> </answer>中给出简要诊断概述。"
+        )
 
-    if show:
-        tqdm.write(f"\n[Stage 2]\n{output_2}")
-    pbar.update(1)
+    # ===== Stage 2 病斑区域核查 =====
+    def stage_2_prompt():
+        od_info = prompter.regroup(prompter.ODinfo_prompt())
+        return PREINFO + od_info + PREQ + (
+            "图像中标注了一些疑似病害症状区域（ROI）。"
+            "请逐一判断这些区域是否为有效病斑，"
+            "并检查是否存在被遗漏的重要症状区域。"
+            "在<think> </think>中给出分析，"
+            "在<answer> </answer>中给出最终确认的病斑描述。"
+        )
 
     # ===== Stage 3 病害类型识别（RAG）=====
-    disease_knowledge = retrieve_disease(match_2, eager=True)
-    crop_knowledge = retrieve_crop(match_1)
-
-    stage_3_prompt = (
-        "结合图像症状、作物信息以及农业病害知识，"
-        "逐一判断可能的植物病害类型，并分析其发生原因与严重程度，"
-        "生成详细的病害诊断报告。"
-    )
-
-    stage_3 = PREINFO + crop_knowledge + disease_knowledge + PREQ + stage_3_prompt
-    messages_3 = build_text_message(messages, stage_3)
-    output_3 = call_llama_server(messages_3, stream=stream)
-    match_3 = extract_answer(output_3)
-
-    if show:
-        tqdm.write(f"\n[Stage 3]\n{output_3}")
-    pbar.update(1)
+    def stage_3_prompt(crop_knowledge, disease_knowledge):
+        return PREINFO + crop_knowledge + disease_knowledge + PREQ + (
+            "结合图像症状、作物信息以及农业病害知识，"
+            "逐一判断可能的植物病害类型，并分析其发生原因与严重程度，"
+            "生成详细的病害诊断报告。"
+        )
 
     # ===== Stage 4 病害发展趋势 =====
-    stage_4_prompt = (
-        "在前述诊断基础上，分析该病害在当前环境条件下的可能发展趋势，"
-        "评估其对作物产量和品质的潜在影响。"
-    )
-
-    stage_4 = PREINFO + match_3 + PREQ + stage_4_prompt
-    messages_4 = build_text_message(messages, stage_4)
-    output_4 = call_llama_server(messages_4, stream=stream)
-    match_4 = extract_answer(output_4)
-
-    if show:
-        tqdm.write(f"\n[Stage 4]\n{output_4}")
-    pbar.update(1)
+    def stage_4_prompt(stage_3):
+        return PREINFO + extract_answer(stage_3) + PREQ + (
+            "在前述诊断基础上，分析该病害在当前环境条件下的可能发展趋势，"
+            "评估其对作物产量和品质的潜在影响。"
+        )
 
     # ===== Stage 5 风险评估与防治建议 =====
-    treatment_knowledge = retrieve_treatment(match_3)
-
-    stage_5_prompt = (
-        "基于以上全部信息完成两步任务："
-        "第一步，在<think> </think>中系统评估当前病害风险等级；"
-        "第二步，在<answer> </answer>中给出科学、可执行的防治建议，"
-        "包括推荐的农艺措施或植保方案。"
-    )
-
-    stage_5 = PREINFO + treatment_knowledge + TIME + PREQ + stage_5_prompt
-    messages_5 = build_text_message(messages, stage_5)
-    output_5 = call_llama_server(messages_5, stream=stream)
-    match_5 = extract_answer(output_5)
-
-    if show:
-        tqdm.write(f"\n[Stage 5]\n{output_5}")
-    pbar.update(1)
+    def stage_5_prompt(treatment_knowledge):
+        return PREINFO + treatment_knowledge + TIME + PREQ + (
+            "基于以上全部信息完成两步任务："
+            "第一步，在<think> </think>中系统评估当前病害风险等级；"
+            "第二步，在<answer> </answer>中给出科学、可执行的防治建议，"
+            "包括推荐的农艺措施或植保方案。"
+        )
+
+    outputs = run_graph([
+        Node("stage_1", llm_stage(1, stage_1_prompt), llm=True),
+        Node("stage_2", llm_stage(2, stage_2_prompt), llm=True),
+        Node("crop_knowledge", lambda stage_1: retrieve_crop(extract_answer(stage_1)), deps=["stage_1"]),
+        Node("disease_knowledge", lambda stage_2: retrieve_disease(extract_answer(stage_2), eager=True),
+             deps=["stage_2"]),
+        Node("stage_3", llm_stage(3, stage_3_prompt), deps=["crop_knowledge", "disease_knowledge"], llm=True),
+        Node("stage_4", llm_stage(4, stage_4_prompt), deps=["stage_3"], llm=True),
+        Node("treatment_knowledge", lambda stage_3: retrieve_treatment(extract_answer(stage_3)), deps=["stage_3"]),
+        Node("stage_5", llm_stage(5, stage_5_prompt), deps=["treatment_knowledge"], llm=True),
+    ], llm_slots=slots, slots=_SLOT_POOL, prefer=[BRIEFING_SLOT])
 
     # ===== 保存结果 =====
-    briefing2file([match_5])
-    fullreport2file(
-        [stage_1, stage_2, stage_3, stage_4, stage_5],
-        [output_1, output_2, output_3, output_4, output_5]
-    )
+    # 报告按阶段顺序写入，与阶段的实际完成顺序无关
+    stages = [prompts[n] for n in range(1, 6)]
+    results = [outputs[f"stage_{n}"] for n in range(1, 6)]
+    summary = extract_answer(results[-1])
+    resize = prefetched.get("resize", {}).get("briefing") or {
+        r.path: r.resize_plan("briefing") for r in prompter.records
+    }
+    roi = prefetched.get("roi") or {}
+    notes = []
+    for p, plan in resize.items():
+        if Path(p).stem in roi:
+            notes += roi_notes(Path(p).name, roi[Path(p).stem])
+        else:
+            notes.append(f"{Path(p).name}：原图 {plan['original'][0]}x{plan['original'][1]} → "
+                         f"发送 {plan['sent'][0]}x{plan['sent'][1]}（约 {plan['vision_tokens']} 个视觉token）")
+    notes += [
+        f"Stage {n}：slot {st['slot']}，提示词复用缓存 {st.get('cached_tokens', '-')} token，"
+        f"新计算 {st.get('prompt_tokens', '-')} token，耗时 {st['elapsed_s']:.1f}s"
+        for n, st in sorted(stage_stats.items())
+    ]
+    briefing2file([summary], name=report_name)
+    fullreport2file(stages, results, name=report_name, notes=notes)
 
     pbar.close()
-    return
+    return summary
@@ -0,0 +1,169 @@
+"""
+LLM Client
+llama-server 的 HTTP 调用基础：请求体构造、keep-alive 连接池、503 / 连接重置的重试与退避、调用统计，
+以及模型输出的 <answer> 提取。
+只依赖 requests 与 utils 的配置，不引入 llama_index / 检索模块，
+上下文预算与对话压缩可以单独导入；诊断流程见 solutions/llama_server.py。
+"""
+
+import sys
+import os
+import time
+import re
+import random
+import requests
+from requests.adapters import HTTPAdapter
+from collections import deque
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils import CONFIG_AND_SETTINGS, SERVER_CONFIG, LOGGER
+from solutions.streaming import accumulate, ConsoleSink
+
+# llama-server 并行 slot（--parallel）
+LLM_SLOTS = max(1, int(SERVER_CONFIG.get("parallel", 1)))
+# 对话模式固定使用的 slot（多轮对话的历史前缀留在同一个 slot 的 KV cache 中）；简报模式优先使用 slot 0
+CHAT_SLOT = LLM_SLOTS - 1
+BRIEFING_SLOT = 0
+
+
+# ============================
+# HTTP 会话（连接池 + 重试）
+# ============================
+# 连接超时与读取超时分开设置：连接失败应尽快重试；读取超时为两次收到数据之间的最长间隔（长提示词的预填充可能很久才返回首个token）
+CONNECT_TIMEOUT = CONFIG_AND_SETTINGS.get("llm_connect_timeout", 5)
+READ_TIMEOUT = CONFIG_AND_SETTINGS.get("llm_read_timeout", 1000)
+MAX_RETRIES = CONFIG_AND_SETTINGS.get("llm_max_retries", 3)
+BACKOFF_BASE, BACKOFF_CAP = 0.5, 8.0
+
+# 进程内共享的 keep-alive 连接池，连接数与并行 slot 数匹配
+_SESSION = requests.Session()
+_SESSION.mount("http://", HTTPAdapter(pool_connections=1, pool_maxsize=LLM_SLOTS + 4))
+# 最近的调用统计（见 http_stats）
+CALL_STATS = deque(maxlen=1000)
+
+
+def _pool_connections(url) -> int:
+    # urllib3 连接池累计新建的连接数。请求前后不变说明复用了 keep-alive 连接（多线程并发时为近似值）
+    try:
+        return _SESSION.get_adapter(url).poolmanager.connection_from_url(url).num_connections
+    except Exception:
+        return 0
+
+
+def backoff_delay(attempt: int, retry_after: str = "") -> float:
+    # 优先遵循服务器给出的 Retry-After，否则为带随机抖动的指数退避（full jitter）
+    if retry_after.isdigit():
+        return min(float(retry_after), BACKOFF_CAP)
+    return random.uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * 2 ** attempt))
+
+
+def _post(url, payload, stream, stats):
+    """
+    发送请求，在 503（slot 繁忙 / 模型加载中）与连接被重置时重试。
+    只在收到任何生成内容之前重试，因此对诊断各阶段的调用是幂等的；读取超时与生成中途断开不重试。
+    """
+    for attempt in range(MAX_RETRIES + 1):
+        before = _pool_connections(url)
+        try:
+            response = _SESSION.post(url, json=payload, timeout=(CONNECT_TIMEOUT, READ_TIMEOUT), stream=stream)
+        except requests.exceptions.ConnectionError as e:
+            if attempt == MAX_RETRIES:
+                raise
+            delay = backoff_delay(attempt)
+            LOGGER.debug(f"llama-server连接异常，{delay:.1f}s后重试（{attempt + 1}/{MAX_RETRIES}）：{e}")
+        else:
+            stats["reused_connection"] = _pool_connections(url) == before
+            if response.status_code != 503 or attempt == MAX_RETRIES:
+                response.raise_for_status()
+                return response
+            delay = backoff_delay(attempt, response.headers.get("Retry-After", ""))
+            response.close()
+            LOGGER.debug(f"llama-server繁忙（503），{delay:.1f}s后重试（{attempt + 1}/{MAX_RETRIES}）")
+        stats["retries"] += 1
+        time.sleep(delay)
+
+
+def record_timings(stats: dict, timings):
+    """
+    从 llama-server 返回的 timings 中记录提示词 token 的缓存命中情况：
+    cached_tokens（cache_n，直接复用 slot 中 KV cache 的 token）与 prompt_tokens（prompt_n，本次实际计算的 token）
+    """
+    if timings:
+        stats["cached_tokens"] = timings.get("cache_n")
+        stats["prompt_tokens"] = timings.get("prompt_n")
+
+
+def http_stats() -> dict:
+    """最近调用的重试次数与连接复用情况"""
+    calls = list(CALL_STATS)
+    return {
+        "calls": len(calls),
+        "retries": sum(c["retries"] for c in calls),
+        "connection_reuse_rate": sum(c["reused_connection"] for c in calls) / len(calls) if calls else 0.0,
+        "mean_elapsed_s": sum(c["elapsed_s"] for c in calls) / len(calls) if calls else 0.0,
+    }
+
+
+# ============================
+# LLM 调用（Plant-Qwen2.5-VL）
+# ============================
+def build_payload(messages, stream=False, extra_params=None) -> dict:
+    payload = {
+        # 显式使用 LoRA 微调后的模型
+        "model": "plant-qwen2.5-vl",
+        "messages": messages,
+        "n_predict": 4096,
+        "stop": ["<|im_end|>"],
+        "stream": True if stream else False
+    }
+
+    if extra_params:
+        payload.update(extra_params)
+    return payload
+
+
+def call_llama_server(
+    messages,
+    server_url=f"http://localhost:{SERVER_CONFIG['PORT']}/v1/chat/completions",
+    stream=False,
+    extra_params=None,
+    use_tqdm=True,
+    stats=None,
+    sinks=None
+):
+    """
+    stats: 可选的 dict，调用结束后写入本次调用的统计（retries / reused_connection / elapsed_s，
+           以及服务器返回的 cached_tokens / prompt_tokens）
+    sinks: 流式模式下接收每个 token 的回调列表（见 solutions/streaming.py），默认输出到控制台
+    """
+    payload = build_payload(messages, stream, extra_params)
+
+    stats = {} if stats is None else stats
+    stats.update({"retries": 0, "reused_connection": False, "elapsed_s": 0.0})
+    start = time.perf_counter()
+
+    try:
+        response = _post(server_url, payload, stream, stats)
+
+        if stream:
+            if sinks is None:
+                sinks = [ConsoleSink(use_tqdm=use_tqdm)]
+            meta = {}
+            result = accumulate(response.iter_lines(), sinks, meta)
+            record_timings(stats, meta.get("timings"))
+            return result
+        else:
+            data = response.json()
+            record_timings(stats, data.get("timings"))
+            return data["choices"][0]["message"]["content"]
+    finally:
+        stats["elapsed_s"] = time.perf_counter() - start
+        CALL_STATS.append(dict(stats))
+
+
+
+def extract_answer(text: str, tag="answer") -> str:
+    pattern = f"<{tag}>(.*?)</{tag}>"
+    match = re.search(pattern, text, re.DOTALL | re.IGNORECASE)
+    return match.group(1).strip() if match else text
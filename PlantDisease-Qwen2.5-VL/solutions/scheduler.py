@@ -0,0 +1,163 @@
+"""
+Stage Graph Scheduler
+按依赖关系调度诊断流程中的 LLM 阶段与知识检索节点：
+- 相互独立的 LLM 调用分配到 llama-server 的不同 slot 上并行生成
+- CPU 侧的知识检索与 LLM 生成重叠执行
+"""
+
+import itertools
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+
+class Node:
+    """
+    流程图中的一个节点
+
+    Args:
+        name (str): 节点名称，同时作为结果字典的键
+        func (callable): 节点函数，以依赖节点的结果作为同名关键字参数调用；
+                         LLM 节点额外接收 slot 参数（分配到的 llama-server slot 编号）
+        deps (tuple): 依赖的节点名称
+        llm (bool): 是否为 LLM 节点。LLM 节点的并发数受 slot 数量限制
+    """
+
+    def __init__(self, name: str, func, deps=(), llm: bool = False):
+        self.name = name
+        self.func = func
+        self.deps = tuple(deps)
+        self.llm = llm
+
+
+class SlotPool:
+    """
+    llama-server slot 池。多个节点图共享同一个池时（如批量诊断），全部图的 LLM 并发数之和不超过 slot 数量。
+    slot 按预约（reserve）的先后顺序分配：调度线程按声明顺序预约，执行线程再凭预约号取 slot，
+    因此同时就绪的节点不会争抢，单 slot 时的执行顺序与声明顺序一致。
+    取 slot 时可以按优先顺序指定偏好的 slot：其中有空闲时优先分配，以命中已缓存的提示词前缀（KV cache）。
+    """
+
+    def __init__(self, n: int):
+        self._free = list(range(max(1, n)))
+        self._cond = threading.Condition()
+        self._queue = deque()
+        self._tickets = itertools.count()
+
+    def reserve(self) -> int:
+        """预约一个 slot，返回预约号"""
+        with self._cond:
+            ticket = next(self._tickets)
+            self._queue.append(ticket)
+            return ticket
+
+    def cancel(self, ticket: int):
+        """撤销尚未取得 slot 的预约"""
+        with self._cond:
+            if ticket in self._queue:
+                self._queue.remove(ticket)
+                self._cond.notify_all()
+
+    def acquire(self, prefer=(), ticket: int = None) -> int:
+        """
+        Args:
+            prefer: 偏好的 slot 序列，或返回该序列的函数（轮到该预约时才求值）
+            ticket (int): reserve 返回的预约号，为空时现场预约
+        """
+        if ticket is None:
+            ticket = self.reserve()
+        with self._cond:
+            while self._queue[0] != ticket or not self._free:
+                self._cond.wait()
+            self._queue.popleft()
+            for slot in (prefer() if callable(prefer) else prefer):
+                if slot in self._free:
+                    self._free.remove(slot)
+                    break
+            else:
+                slot = self._free.pop(0)
+            # 还有空闲 slot 时，下一个预约可以继续分配
+            self._cond.notify_all()
+            return slot
+
+    def release(self, slot: int):
+        with self._cond:
+            self._free.append(slot)
+            self._cond.notify_all()
+
+
+def run_graph(nodes: list, llm_slots: int = 1, cpu_workers: int = 2, slots: SlotPool = None,
+              prefer=()) -> dict:
+    """
+    执行节点图，返回 {节点名称: 结果}。任一节点失败时取消尚未开始的节点并抛出该异常。
+
+    Args:
+        nodes (list[Node]): 节点列表
+        llm_slots (int): llama-server 可用的并行 slot 数量
+        cpu_workers (int): CPU 节点的最大并发数
+        slots (SlotPool): 共享的 slot 池，为空时按 llm_slots 新建
+        prefer: 优先使用的 slot（如已预填充图像的 slot），排在该图已用过的 slot 之后
+
+    同一个图中的 LLM 节点优先使用该图已经用过的 slot（按首次使用顺序），
+    使各阶段共享的系统提示词与图像前缀不必在新的 slot 上重新预填充。
+    """
+    by_name = {node.name: node for node in nodes}
+    for node in nodes:
+        missing = [d for d in node.deps if d not in by_name]
+        if missing:
+            raise ValueError(f"节点 {node.name} 依赖了不存在的节点：{missing}")
+
+    # slot 池：LLM 节点开始前取出一个 slot，结束后归还
+    if slots is None:
+        slots = SlotPool(llm_slots)
+    cpu_gate = threading.Semaphore(max(1, cpu_workers))
+    used = []
+    used_lock = threading.Lock()
+
+    def preferred():
+        with used_lock:
+            return list(used) + [s for s in prefer if s not in used]
+
+    def execute(node: Node, kwargs: dict, ticket: int = None):
+        if node.llm:
+            slot = slots.acquire(prefer=preferred, ticket=ticket)
+            with used_lock:
+                if slot not in used:
+                    used.append(slot)
+            try:
+                return node.func(slot=slot, **kwargs)
+            finally:
+                slots.release(slot)
+        with cpu_gate:
+            return node.func(**kwargs)
+
+    results = {}
+    pending = list(nodes)
+    running = {}
+
+    with ThreadPoolExecutor(max_workers=max(1, llm_slots) + max(1, cpu_workers),
+                            thread_name_prefix="stage") as executor:
+        while pending or running:
+            # 提交所有依赖已满足的节点。LLM 节点在本线程按声明顺序预约 slot，保证单 slot 时与顺序执行一致
+            for node in [n for n in pending if all(d in results for d in n.deps)]:
+                pending.remove(node)
+                kwargs = {d: results[d] for d in node.deps}
+                ticket = slots.reserve() if node.llm else None
+                running[executor.submit(execute, node, kwargs, ticket)] = (node, ticket)
+
+            if not running:
+                raise ValueError(f"节点图存在循环依赖：{[n.name for n in pending]}")
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                node, _ = running.pop(future)
+                try:
+                    results[node.name] = future.result()
+                except BaseException:
+                    # 未开始的节点取消并撤销预约，已在等待 slot 的节点随后依次执行完毕
+                    for f, (_, ticket) in running.items():
+                        if f.cancel() and ticket is not None:
+                            slots.cancel(ticket)
+                    raise
+
+    return results
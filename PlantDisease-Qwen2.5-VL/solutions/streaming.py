@@ -0,0 +1,186 @@
+"""
+Streaming Helpers
+流式生成的解码与输出：
+- 只对携带文本内容的 SSE 帧做 JSON 解码（角色帧、结束帧、timings 帧直接跳过），优先使用 orjson
+- 生成文本以列表收集，结束时只拼接一次
+- token 输出通过可插拔的 sink 完成，控制台 sink 按行或按时间间隔批量刷新，而不是每个 token 写一次
+"""
+
+import sys
+import json
+import time
+from tqdm import tqdm
+
+try:
+    import orjson
+    _loads = orjson.loads
+except ImportError:
+    _loads = json.loads
+
+# llama-server 输出紧凑 JSON；同时兼容带空格的格式
+_CONTENT_MARKER = b'"content":"'
+_CONTENT_MARKER_SPACED = b'"content": "'
+
+
+def decode_delta(data: bytes):
+    """
+    解码一个 SSE 帧的 data 字段（bytes，不含 "data: " 前缀），返回增量文本。不含文本内容的帧返回 None。
+    """
+    if _CONTENT_MARKER not in data and _CONTENT_MARKER_SPACED not in data:
+        return None
+    frame = _loads(data)
+    choices = frame.get("choices")
+    if not choices:
+        return None
+    return (choices[0].get("delta") or {}).get("content") or None
+
+
+def decode_timings(data: bytes):
+    """
+    解码结束帧中 llama-server 附带的 timings（cache_n / prompt_n / predicted_n 等），其他帧返回 None
+    """
+    if b'"timings"' not in data:
+        return None
+    return _loads(data).get("timings")
+
+
+def accumulate(lines, sinks=(), meta=None) -> str:
+    """
+    从 SSE 行（requests.Response.iter_lines 的输出）中提取全部增量文本，逐个送入 sinks，返回完整文本。
+    meta: 可选的 dict，写入结束帧中的 timings
+    """
+    chunks = []
+    append = chunks.append
+    try:
+        for line in lines:
+            if not line.startswith(b"data: {"):
+                continue
+            content = decode_delta(line[6:])
+            if content:
+                append(content)
+                for sink in sinks:
+                    sink(content)
+            elif meta is not None:
+                timings = decode_timings(line[6:])
+                if timings:
+                    meta["timings"] = timings
+    finally:
+        for sink in sinks:
+            close = getattr(sink, "close", None)
+            if close:
+                close()
+    return "".join(chunks)
+
+
+# ==================================================
+# Token sinks
+# ==================================================
+class ConsoleSink:
+    """
+    控制台输出。token 先进入缓冲区，遇到换行或距上次刷新超过 flush_interval 秒时一次性写出。
+
+    Args:
+        use_tqdm (bool): 通过 tqdm.write 输出（存在进度条时不会打乱进度条）
+        flush_interval (float): 最长刷新间隔（秒），0 表示每个 token 都刷新
+    """
+
+    def __init__(self, use_tqdm: bool = True, flush_interval: float = 0.05):
+        self.use_tqdm = use_tqdm
+        self.flush_interval = flush_interval
+        self._buf = []
+        self._last = time.perf_counter()
+
+    def __call__(self, token: str):
+        self._buf.append(token)
+        if "\n" in token or time.perf_counter() - self._last >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        if self._buf:
+            text = "".join(self._buf)
+            self._buf.clear()
+            if self.use_tqdm:
+                tqdm.write(text, end="", nolock=True)
+            else:
+                sys.stdout.write(text)
+                sys.stdout.flush()
+        self._last = time.perf_counter()
+
+    def close(self):
+        self.flush()
+
+
+class CallbackSink:
+    """将每个 token 交给任意回调（如 WebUI 推送、写入文件）"""
+
+    def __init__(self, callback):
+        self.callback = callback
+
+    def __call__(self, token: str):
+        self.callback(token)
+
+
+# ==================================================
+# 微基准：回放 4096 token 的流式响应，比较客户端每个 token 的开销
+# ==================================================
+def _legacy_accumulate(lines) -> str:
+    # 重构前的实现：逐行 decode + json.loads，字符串累加
+    result = ""
+    for line in lines:
+        line = line.decode("utf-8")
+        if not line.startswith("data: {"):
+            continue
+        data = json.loads(line[len("data:"):].strip())
+        content = data.get("choices", [{}])[0].get("delta", {}).get("content", "")
+        if content:
+            result += content
+    return result
+
+
+def recorded_stream(n_tokens: int = 4096) -> list:
+    """
+    生成与 llama-server 输出格式一致的 SSE 行：角色帧、n_tokens 个内容帧、结束帧与 timings 帧、[DONE]
+    """
+    words = ["叶片", "出现", "褐色", "病斑，", "边缘", "呈", "黄色", "晕圈", "，", "初步", "判断", "为",
+             "苹果", "斑点", "落叶病", "。\n", "<think>", "</think>", "建议", "喷施", "代森锰锌"]
+
+    def frame(delta, finish=None, extra=None):
+        body = {"choices": [{"finish_reason": finish, "index": 0, "delta": delta}],
+                "created": 1730000000, "id": "chatcmpl-bench", "model": "plant-qwen2.5-vl",
+                "system_fingerprint": "b4000", "object": "chat.completion.chunk"}
+        body.update(extra or {})
+        return b"data: " + json.dumps(body, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+    lines = [frame({"role": "assistant", "content": None}), b""]
+    for i in range(n_tokens):
+        lines += [frame({"content": words[i % len(words)]}), b""]
+    lines += [frame({}, finish="stop", extra={"timings": {"prompt_n": 1024, "predicted_n": n_tokens}}), b""]
+    lines += [b"data: [DONE]", b""]
+    return lines
+
+
+def benchmark(n_tokens: int = 4096, repeat: int = 20) -> dict:
+    lines = recorded_stream(n_tokens)
+    assert _legacy_accumulate(lines) == accumulate(lines)
+
+    def best(fn):
+        times = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            fn(lines)
+            times.append(time.perf_counter() - start)
+        return min(times)
+
+    legacy = best(_legacy_accumulate)
+    current = best(accumulate)
+    return {
+        "tokens": n_tokens,
+        "decoder": _loads.__module__,
+        "legacy_us_per_token": legacy / n_tokens * 1e6,
+        "current_us_per_token": current / n_tokens * 1e6,
+        "speedup": legacy / current,
+    }
+
+
+if __name__ == "__main__":
+    print(benchmark())
@@ -0,0 +1,183 @@
+"""
+Token Budget
+对话模式的上下文预算管理。llama-server 在多模态输入下不启用 context shift，
+对话历史超过 slot 的上下文长度时请求会直接失败，因此每轮对话前先按预算裁剪历史消息。
+- 文本 token：优先使用 llama-server 的 /tokenize 接口计数，不可用时按字符估算
+- 图像 token：按发送分辨率估算（见 utils/img_handler.py 的 resize_plan，尺寸取自 ImageRecord）
+- 始终保留系统提示词与本轮消息（含当前图像），从最早的一轮对话开始丢弃
+"""
+
+import re
+import base64
+import hashlib
+import io
+from pathlib import Path
+from typing import List
+from PIL import Image
+
+from utils import CONFIG_AND_SETTINGS, SERVER_CONFIG, LOGGER
+from utils.cache import LRUCache
+from utils.info_extractor import image_record
+from utils.img_handler import smart_resize, estimate_vision_tokens, RESIZE_POLICY, PATCH_SIZE
+from solutions.llm_client import _SESSION, CONNECT_TIMEOUT, LLM_SLOTS
+
+# 每条消息的对话模板开销：<|im_start|>role\n ... <|im_end|>\n
+MESSAGE_OVERHEAD = 5
+# 为生成内容与检索到的知识预留的 token 数
+RESERVE_TOKENS = CONFIG_AND_SETTINGS.get("chat_reserve_tokens", 6144)
+# 超出预算时裁剪到预算的该比例，留出余量，避免之后每一轮都要裁剪（裁剪会使提示词前缀缓存失效）
+TRIM_RATIO = CONFIG_AND_SETTINGS.get("chat_trim_ratio", 0.75)
+
+TOKENIZE_URL = f"http://localhost:{SERVER_CONFIG['PORT']}/tokenize"
+
+# 文本 -> token 数，历史消息每轮都要计数，只在第一次请求服务器
+_TOKEN_COUNTS = LRUCache(max_bytes=4 * 1024 ** 2, sizeof=lambda v: 64)
+_CJK = re.compile(r"[　-鿿가-힯＀-￯]")
+
+
+def context_budget() -> int:
+    """
+    单个 slot 的上下文长度（ctx-size 在各 slot 间平分）减去预留量，可用 chat_token_budget 直接指定
+    """
+    budget = CONFIG_AND_SETTINGS.get("chat_token_budget")
+    if budget:
+        return int(budget)
+    return int(SERVER_CONFIG.get("ctx-size", 32768)) // LLM_SLOTS - RESERVE_TOKENS
+
+
+def count_text_tokens(text: str) -> int:
+    if not text:
+        return 0
+    key = hashlib.sha1(text.encode("utf-8")).digest()
+    count = _TOKEN_COUNTS.get(key)
+    if count is not None:
+        return count
+
+    try:
+        response = _SESSION.post(TOKENIZE_URL, json={"content": text}, timeout=(CONNECT_TIMEOUT, 30))
+        response.raise_for_status()
+        count = len(response.json()["tokens"])
+    except Exception as e:
+        LOGGER.debug(f"/tokenize 不可用，按字符估算 token 数：{e}")
+        # Qwen 词表中常用汉字约 1 token/字，其余文本约 4 字符/token；估算宁多勿少
+        cjk = len(_CJK.findall(text))
+        count = int(cjk * 1.1 + (len(text) - cjk) / 3.5) + 1
+    _TOKEN_COUNTS.put(key, count)
+    return count
+
+
+def _data_uri_tokens(url: str) -> int:
+    # 只解码 base64 开头的一段读取图像尺寸；读取失败时按对话模式的像素上限估算
+    policy = RESIZE_POLICY.get("chat", {})
+    try:
+        head = url.split(",", 1)[1][:131072]
+        with Image.open(io.BytesIO(base64.b64decode(head[:len(head) // 4 * 4]))) as img:
+            width, height = img.size
+        return estimate_vision_tokens(*smart_resize(
+            width, height, policy.get("min_pixels", 4 * PATCH_SIZE ** 2),
+            policy.get("max_pixels", 16384 * PATCH_SIZE ** 2)
+        ))
+    except Exception:
+        return policy.get("max_pixels", 1280 * PATCH_SIZE ** 2) // PATCH_SIZE ** 2 + 2
+
+
+def count_message_tokens(message: dict, image_tokens: dict = None) -> int:
+    """
+    Args:
+        image_tokens (dict): data URI -> 视觉 token 数（已知图像路径时预先按分辨率计算）
+    """
+    content = message["content"]
+    if isinstance(content, str):
+        return MESSAGE_OVERHEAD + count_text_tokens(content)
+
+    total = MESSAGE_OVERHEAD
+    for part in content:
+        if part["type"] == "text":
+            total += count_text_tokens(part["text"])
+        elif part["type"] == "image_url":
+            url = part["image_url"]["url"]
+            total += (image_tokens or {}).get(url) or _data_uri_tokens(url)
+    return total
+
+
+def latest_images(messages: list) -> tuple:
+    """
+    当前对话使用的图像：最近一条带图像的用户消息（build_img_message 输入新图像时会移除更早的图像）。
+
+    Returns:
+        (消息下标, 图像部分列表)，没有图像时为 (None, [])
+    """
+    for i in range(len(messages) - 1, 0, -1):
+        m = messages[i]
+        if m["role"] == "user" and isinstance(m["content"], list):
+            parts = [c for c in m["content"] if c["type"] == "image_url"]
+            if parts:
+                return i, parts
+    return None, []
+
+
+def carry_images(messages: list, index: int, parts: list):
+    """
+    将被移除的历史消息中的图像移到本轮用户消息的开头（图像在前、文本在后），对话仍然围绕这些图像进行
+    """
+    if index is None or index == len(messages) - 1 or not parts:
+        return
+    current = messages[-1]
+    if not isinstance(current["content"], list):
+        current["content"] = [{"type": "text", "text": current["content"]}]
+    current["content"][:0] = parts
+
+
+def keep_m_tokens(messages: list, img_paths: List[Path] = None, budget: int = None) -> list:
+    """
+    按 token 预算裁剪对话历史（原地修改并返回 messages）。
+    messages 结构为 [系统提示词, (用户, 助手)*, 本轮用户消息]，从最早的一轮（用户 + 助手）开始丢弃，
+    系统提示词、本轮消息与当前图像始终保留：图像所在的历史消息被丢弃时，图像移到本轮用户消息中。
+
+    Args:
+        img_paths: 本轮图像路径，用于按发送分辨率精确估算视觉 token
+        budget (int): token 预算，默认见 context_budget
+    """
+    budget = budget or context_budget()
+
+    image_tokens = {}
+    current = messages[-1]["content"] if isinstance(messages[-1]["content"], list) else []
+    urls = [c["image_url"]["url"] for c in current if c["type"] == "image_url"]
+    for url, img_path in zip(urls, img_paths or []):
+        try:
+            image_tokens[url] = image_record(img_path).resize_plan("chat")["vision_tokens"]
+        except Exception:
+            pass
+
+    counts = [count_message_tokens(m, image_tokens) for m in messages]
+    total = sum(counts)
+    if total <= budget:
+        return messages
+
+    # 当前图像随所在消息一起丢弃时仍要保留，其 token 数重新计入
+    img_index, img_parts = latest_images(messages)
+    img_tokens = sum(
+        count_message_tokens({"content": [p]}, image_tokens) - MESSAGE_OVERHEAD for p in img_parts
+    ) if img_index is not None and img_index < len(messages) - 1 else 0
+
+    # 历史消息位于 messages[1:-1]，按轮（到下一条用户消息为止）丢弃
+    target = int(budget * TRIM_RATIO)
+    start, end = 1, 1
+    while total > target and end < len(messages) - 1:
+        end += 1
+        while end < len(messages) - 1 and messages[end]["role"] != "user":
+            end += 1
+        total -= sum(counts[start:end])
+        if start <= (img_index or 0) < end:
+            total += img_tokens
+        start = end
+
+    dropped = end - 1
+    if dropped:
+        if img_index is not None and img_index < end:
+            carry_images(messages, img_index, img_parts)
+        del messages[1:end]
+        LOGGER.info(f"对话历史超出上下文预算（{budget} token），已移除最早的{dropped}条消息，当前约{total} token。")
+    if total > budget:
+        LOGGER.warning(f"本轮消息约{total} token，仍超出上下文预算（{budget} token），请减少输入内容或图像数量。")
+    return messages
@@ -0,0 +1,31 @@
+"""
+测试入口：配置文件按相对路径读取（cfg/config.yaml），因此切换到项目根目录并加入 sys.path。
+运行：在 PlantDisease-Qwen2.5-VL 目录下执行 python -m pytest -q tests
+依赖 llama_index / torch 等重量级依赖的模块在未安装时跳过对应测试。
+"""
+
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+os.chdir(ROOT)
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+
+@pytest.fixture
+def detection_dir(tmp_path, monkeypatch):
+    """
+    病斑检测结果目录（info_extractor.CACHE_DIR）指向临时目录，不写入项目的 .iaCache；
+    前后清空 ImageRecord 缓存
+    """
+    from utils import info_extractor
+
+    cache_dir = tmp_path / "cache"
+    cache_dir.mkdir()
+    monkeypatch.setattr(info_extractor, "CACHE_DIR", str(cache_dir))
+    info_extractor._RECORDS.clear()
+    yield cache_dir
+    info_extractor._RECORDS.clear()
@@ -0,0 +1,59 @@
+import os
+import time
+
+from utils import cache
+from utils.cache import LRUCache, DiskLRU
+
+
+def test_lru_cache_evicts_least_recently_used():
+    c = LRUCache(max_bytes=30, sizeof=len)
+    c.put("a", "x" * 10)
+    c.put("b", "x" * 10)
+    c.put("c", "x" * 10)
+    assert c.get("a") is not None  # a 变为最近使用
+    c.put("d", "x" * 10)
+    assert "b" not in c and "a" in c and "d" in c
+    assert c.nbytes == 30
+
+
+def test_disk_lru_evicts_by_access_not_write_order(tmp_path):
+    d = DiskLRU(str(tmp_path), max_bytes=30)
+    for key in "abc":
+        d.put(key, key * 10)
+    assert d.get("a") == "a" * 10
+    d.put("d", "d" * 10)
+    assert sorted(os.listdir(tmp_path)) == ["a.uri", "c.uri", "d.uri"]
+    assert d.nbytes == 30
+
+
+def test_disk_lru_scans_directory_once(tmp_path, monkeypatch):
+    calls = []
+    scandir = os.scandir
+    monkeypatch.setattr(cache.os, "scandir", lambda p: calls.append(p) or scandir(p))
+    d = DiskLRU(str(tmp_path), max_bytes=1000)
+    for i in range(20):
+        d.put(str(i), "x" * 10)
+        d.get(str(i))
+    assert len(calls) == 1
+
+
+def test_disk_lru_rebuilds_index_in_access_order(tmp_path):
+    d = DiskLRU(str(tmp_path), max_bytes=30)
+    for key in "abc":
+        d.put(key, key * 10)
+        time.sleep(0.01)
+    d.get("a")  # 命中时更新修改时间
+
+    # 新进程：按修改时间重建索引，a 最近被访问，b 最先淘汰
+    d2 = DiskLRU(str(tmp_path), max_bytes=30)
+    assert len(d2) == 3 and d2.nbytes == 30
+    d2.put("d", "d" * 10)
+    assert sorted(os.listdir(tmp_path)) == ["a.uri", "c.uri", "d.uri"]
+
+
+def test_disk_lru_missing_file_is_a_miss(tmp_path):
+    d = DiskLRU(str(tmp_path), max_bytes=100)
+    d.put("a", "a" * 10)
+    os.remove(tmp_path / "a.uri")
+    assert d.get("a") is None
+    assert "a" not in d and d.nbytes == 0
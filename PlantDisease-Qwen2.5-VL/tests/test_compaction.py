@@ -0,0 +1,82 @@
+import pytest
+
+from solutions import compaction, token_budget
+from solutions.compaction import ChatCompactor, SUMMARY_PREFIX, SUMMARY_ACK
+
+IMG = {"type": "image_url", "image_url": {"url": "data:image/jpeg;base64,AAAA"}}
+
+
+@pytest.fixture
+def calls(monkeypatch):
+    calls = []
+
+    def fake_call(messages, extra_params=None, **kwargs):
+        calls.append({"messages": messages, "extra_params": extra_params})
+        return "叶片出现褐色斑点，初步判断为叶斑病。"
+
+    monkeypatch.setattr(compaction, "call_llama_server", fake_call)
+    monkeypatch.setattr(token_budget, "count_text_tokens", len)
+    monkeypatch.setattr(token_budget, "_data_uri_tokens", lambda url: 100)
+    return calls
+
+
+def _conversation(turns):
+    messages = [{"role": "system", "content": "system"}]
+    for i in range(turns):
+        content = ([IMG] if i == 0 else []) + [{"type": "text", "text": f"问题{i} " + "x" * 100}]
+        messages.append({"role": "user", "content": content})
+        messages.append({"role": "assistant", "content": f"<answer>回答{i}</answer>"})
+    messages.append({"role": "user", "content": [{"type": "text", "text": "本轮问题"}]})
+    return messages
+
+
+def _compact(compactor, messages):
+    compactor.schedule(messages)
+    compactor._job[1].result(timeout=5)
+    return compactor.apply(messages)
+
+
+def test_summary_replaces_old_turns_and_keeps_image(calls):
+    compactor = ChatCompactor(threshold=100, keep_turns=2, slot=1)
+    messages = _conversation(5)
+    recent = messages[-5:]
+    _compact(compactor, messages)
+
+    assert len(messages) == 1 + 2 + 4 + 1
+    summary = messages[1]["content"]
+    assert summary[0] == IMG
+    assert summary[-1]["text"].startswith(SUMMARY_PREFIX)
+    assert messages[2] == {"role": "assistant", "content": SUMMARY_ACK}
+    assert messages[3:] == recent
+
+    # 摘要请求固定到对话以外的 slot，只包含文本
+    assert calls[0]["extra_params"]["id_slot"] == 1
+    sent = calls[0]["messages"][1]["content"]
+    assert all(c["type"] == "text" for c in sent)
+    assert "回答0" in sent[0]["text"]
+
+
+def test_no_image_carried_when_current_message_has_one(calls):
+    compactor = ChatCompactor(threshold=100, keep_turns=2, slot=1)
+    messages = _conversation(5)
+    messages[1]["content"] = [c for c in messages[1]["content"] if c["type"] != "image_url"]
+    messages[-1]["content"].insert(0, IMG)
+    _compact(compactor, messages)
+    assert all(c["type"] == "text" for c in messages[1]["content"])
+
+
+def test_stale_snapshot_is_discarded(calls):
+    compactor = ChatCompactor(threshold=100, keep_turns=2, slot=1)
+    messages = _conversation(5)
+    compactor.schedule(messages)
+    compactor._job[1].result(timeout=5)
+    del messages[1:3]  # 期间历史被裁剪
+    before = list(messages)
+    assert compactor.apply(messages) == before
+
+
+def test_below_threshold_or_single_slot_does_nothing(calls):
+    messages = _conversation(5)
+    ChatCompactor(threshold=10 ** 6, keep_turns=2, slot=1).schedule(messages)
+    ChatCompactor(threshold=100, keep_turns=2, slot=None).schedule(messages)
+    assert calls == []
@@ -0,0 +1,51 @@
+import os
+
+import numpy as np
+import pytest
+
+from utils import info_extractor
+from utils.info_extractor import load_detections, load_detection_table
+
+
+@pytest.fixture
+def cache_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(info_extractor, "CACHE_DIR", str(tmp_path))
+    return tmp_path
+
+
+def _write(path, text):
+    path.write_text(text, encoding="utf-8")
+    st = os.stat(path)
+    os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns + 1_000_000_000))
+
+
+def test_npz_cache_reused_and_invalidated(cache_dir, monkeypatch):
+    _write(cache_dir / "a.txt", "0 0.1 0.2 0.3 0.4\n")
+    labels, coords = load_detections("a")
+    assert labels.tolist() == [0] and coords.shape == (1, 4)
+    assert (cache_dir / "a.npz").exists()
+
+    parses = []
+    parse = info_extractor._parse_detections
+    monkeypatch.setattr(info_extractor, "_parse_detections", lambda p: parses.append(p) or parse(p))
+    load_detections("a")
+    assert parses == []
+
+    _write(cache_dir / "a.txt", "0 0.1 0.2 0.3 0.4\n2 0.5 0.5 0.6 0.6\n")
+    labels, _ = load_detections("a")
+    assert labels.tolist() == [0, 2] and len(parses) == 1
+
+
+def test_ragged_rows_padded_with_nan(cache_dir):
+    _write(cache_dir / "b.txt", "1 0.1 0.1 0.2 0.2\n3 0.1 0.1 0.2 0.1 0.2 0.2 0.1 0.2\n4 0.5\n")
+    labels, coords = load_detections("b")
+    assert labels.tolist() == [1, 3]
+    assert coords.shape == (2, 8) and np.isnan(coords[0, 4:]).all()
+
+
+def test_missing_results_and_table_offsets(cache_dir):
+    assert load_detections("missing") is None
+    _write(cache_dir / "c.txt", "0 1 1 2 2\n0 3 3 4 4\n")
+    table = load_detection_table(["missing", "c"], workers=2)
+    assert table["missing"].tolist() == [True, False]
+    assert table["offsets"].tolist() == [0, 0, 2]
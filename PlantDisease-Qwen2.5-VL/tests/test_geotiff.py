@@ -0,0 +1,78 @@
+import os
+
+import numpy as np
+import pytest
+
+rasterio = pytest.importorskip("rasterio")
+from rasterio.transform import from_origin
+
+from utils import geotiff
+
+
+def _write(path, width=600, height=400, value=1000):
+    data = np.full((3, height, width), value, dtype=np.uint16)
+    data[:, :, :50] = 0  # nodata 黑边
+    with rasterio.open(path, "w", driver="GTiff", width=width, height=height, count=3, dtype="uint16",
+                       crs="EPSG:32650", transform=from_origin(500000, 2500000, 0.05, 0.05), nodata=0) as ds:
+        ds.write(data)
+    return str(path)
+
+
+@pytest.fixture
+def ortho(tmp_path, monkeypatch):
+    monkeypatch.setattr(geotiff, "TILE_DIR", str(tmp_path / "tiles"))
+    monkeypatch.setattr(geotiff, "OVERVIEW_MAX_PIXELS", 60_000)
+    monkeypatch.setattr(geotiff, "TILE_SIZE", 128)
+    geotiff._OVERVIEWS.clear()
+    reads = []
+    read = geotiff._read_overview
+    monkeypatch.setattr(geotiff, "_read_overview", lambda ds, size: reads.append(size) or read(ds, size))
+    yield _write(tmp_path / "field.tif"), reads
+    geotiff._OVERVIEWS.clear()
+
+
+def test_overview_read_once_per_source(ortho):
+    path, reads = ortho
+    geotiff.overview_jpeg(path, (280, 196))
+    geotiff.overview_jpeg(path, (140, 84))
+    tiles = geotiff.plan_tiles(path, tile_size=256, overlap=32)
+    assert len(reads) == 1
+    assert tiles and all(t.metadata["center_coord"] for t in tiles)
+
+    # 进程内缓存清空后从磁盘读取
+    geotiff._OVERVIEWS.clear()
+    geotiff.plan_tiles(path, tile_size=256, overlap=32)
+    assert len(reads) == 1
+
+
+def test_overview_invalidated_when_source_changes(ortho):
+    path, reads = ortho
+    geotiff.overview_jpeg(path)
+    _write(path, value=3000)
+    st = os.stat(path)
+    os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns + 1_000_000_000))
+    geotiff.overview_jpeg(path)
+    assert len(reads) == 2
+
+
+def test_larger_than_cached_overview_reads_directly(ortho):
+    path, reads = ortho
+    geotiff.overview_jpeg(path, (560, 392))
+    assert len(reads) == 2 and reads[1] == (560, 392)
+
+
+def test_same_name_sources_cached_separately(ortho, tmp_path):
+    path, reads = ortho
+    os.makedirs(tmp_path / "b")
+    other = _write(tmp_path / "b" / "field.tif", value=3000)
+    tiles_a = geotiff.plan_tiles(path, tile_size=256, overlap=32)
+    tiles_b = geotiff.plan_tiles(other, tile_size=256, overlap=32)
+    assert len(reads) == 2
+    assert tiles_a[0].path.parent != tiles_b[0].path.parent
+
+    # 磁盘概览各自独立，另一幅同名影像不会使其失效
+    geotiff._OVERVIEWS.clear()
+    geotiff.plan_tiles(path, tile_size=256, overlap=32)
+    geotiff.plan_tiles(other, tile_size=256, overlap=32)
+    assert len(reads) == 2
+    assert tiles_a[0].materialize() != tiles_b[0].materialize()
@@ -0,0 +1,99 @@
+import json
+import os
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from utils.info_extractor import image_record, load_detections
+
+
+def _bump(path):
+    # 保证 mtime 变化（部分文件系统的时间精度较低）
+    st = os.stat(path)
+    os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns + 1_000_000_000))
+
+
+@pytest.fixture
+def image(tmp_path, detection_dir):
+    path = tmp_path / "leaf_test_record.png"
+    Image.new("RGB", (64, 48), (120, 160, 40)).save(path)
+    return path, str(detection_dir / "leaf_test_record.txt")
+
+
+def test_record_cached_until_image_changes(image):
+    path, _ = image
+    record = image_record(path)
+    assert image_record(path) is record
+    assert record.size == (64, 48)
+
+    Image.new("RGB", (32, 32)).save(path)
+    _bump(path)
+    changed = image_record(path)
+    assert changed is not record and changed.size == (32, 32)
+
+
+def test_metadata_change_refreshes_record(image):
+    path, _ = image
+    record = image_record(path)
+    assert record.metadata == {}
+
+    meta = {"capture_time": "2025-06-01 10:00", "center_coord": [113.3, 23.1], "crop_type": "水稻"}
+    with open(path.with_suffix(".json"), "w", encoding="utf-8") as f:
+        json.dump(meta, f, ensure_ascii=False)
+    assert image_record(path) is record
+    assert record.metadata["crop_type"] == "水稻"
+    assert record.file_info()["crop_type"] == "水稻"
+
+    meta["crop_type"] = "小麦"
+    with open(path.with_suffix(".json"), "w", encoding="utf-8") as f:
+        json.dump(meta, f, ensure_ascii=False)
+    _bump(path.with_suffix(".json"))
+    assert image_record(path).metadata["crop_type"] == "小麦"
+
+
+def test_detection_output_written_after_record_is_picked_up(image):
+    path, detection = image
+    record = image_record(path)
+    assert record.detections is None and record.bbox == {}
+
+    with open(detection, "w", encoding="utf-8") as f:
+        f.write("0 0.1 0.1 0.3 0.3\n")
+    image_record(path)
+    assert len(record.detections[0]) == 1
+
+    # 检测结果更新：.npz 缓存按文本文件的 mtime 失效，记录随之更新
+    with open(detection, "w", encoding="utf-8") as f:
+        f.write("0 0.1 0.1 0.3 0.3\n1 0.5 0.5 0.9 0.9\n")
+    _bump(detection)
+    image_record(path)
+    assert len(record.detections[0]) == 2
+    np.testing.assert_array_equal(record.detections[0], load_detections("leaf_test_record")[0])
+
+
+def test_revalidate_false_skips_checks(image):
+    path, detection = image
+    record = image_record(path)
+    with open(detection, "w", encoding="utf-8") as f:
+        f.write("0 0.1 0.1 0.3 0.3\n")
+    assert image_record(path, revalidate=False).detections is None
+    assert image_record(path).detections is not None
+    assert record.refresh() is False
+
+
+def test_metadata_capture_time_only_used_for_tiles(image):
+    path, _ = image
+    record = image_record(path)
+    mtime_time = record.capture_time
+
+    meta = {"capture_time": "2025-06-01 10:00", "center_coord": [113.3, 23.1], "crop_type": "水稻"}
+    with open(path.with_suffix(".json"), "w", encoding="utf-8") as f:
+        json.dump(meta, f, ensure_ascii=False)
+    assert image_record(path).capture_time == mtime_time
+
+    # GeoTIFF 分块（plan_tiles 写出的元数据）继承原影像的拍摄时间
+    meta.update(source_signature=[1, 2], window=[0, 0, 64, 48])
+    with open(path.with_suffix(".json"), "w", encoding="utf-8") as f:
+        json.dump(meta, f, ensure_ascii=False)
+    _bump(path.with_suffix(".json"))
+    assert image_record(path).capture_time == "2025-06-01 10:00"
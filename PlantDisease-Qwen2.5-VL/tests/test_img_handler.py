@@ -0,0 +1,53 @@
+import os
+
+from PIL import Image
+
+from utils import img_handler
+from utils.img_handler import _data_uri_key, file_signature, cached_data_uri
+
+
+def _image(path, size=(64, 48), color=(200, 30, 30)):
+    Image.new("RGB", size, color).save(path)
+    return path
+
+
+def test_data_uri_key_covers_every_encoding_parameter(tmp_path):
+    sig = file_signature(_image(tmp_path / "a.png"))
+    base = _data_uri_key(sig, False)
+    assert base == _data_uri_key(sig, False)
+    variants = [
+        _data_uri_key(sig, True),
+        _data_uri_key(sig, False, size=(56, 28)),
+        _data_uri_key(sig, False, size=(56, 28), box=(0, 0, 10, 10)),
+        _data_uri_key(sig, "roi", size=(56, 28)),
+        _data_uri_key((sig[0], sig[1] + 1, sig[2]), False),
+        _data_uri_key((sig[0], sig[1], sig[2] + 1), False),
+    ]
+    assert len({base, *variants}) == len(variants) + 1
+
+
+def test_cached_data_uri_invalidated_when_file_changes(tmp_path, monkeypatch):
+    monkeypatch.setattr(img_handler, "DATA_URI_DISK", img_handler.DiskLRU(str(tmp_path / "spill"), 1 << 20))
+    img_handler.DATA_URI_CACHE.clear()
+    path = _image(tmp_path / "a.png")
+    first = cached_data_uri(file_signature(path))
+    assert cached_data_uri(file_signature(path)) == first
+
+    _image(path, color=(10, 200, 10))
+    st = os.stat(path)
+    os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns + 1_000_000))
+    assert cached_data_uri(file_signature(path)) != first
+
+
+def test_cached_data_uri_served_from_disk_after_memory_eviction(tmp_path, monkeypatch):
+    monkeypatch.setattr(img_handler, "DATA_URI_DISK", img_handler.DiskLRU(str(tmp_path / "spill"), 1 << 20))
+    img_handler.DATA_URI_CACHE.clear()
+    path = _image(tmp_path / "a.png")
+    first = cached_data_uri(file_signature(path))
+    img_handler.DATA_URI_CACHE.clear()
+
+    def fail(*args, **kwargs):
+        raise AssertionError("不应重新编码")
+
+    monkeypatch.setattr(img_handler, "_encode_data_uri", fail)
+    assert cached_data_uri(file_signature(path)) == first
@@ -0,0 +1,55 @@
+import os
+
+import numpy as np
+
+from retrieval.quantize import ProductQuantizer, quant_name
+from retrieval.vector_store import NumpyVectorStore
+
+
+def _store(tmp_path, n=512, dim=32):
+    rng = np.random.default_rng(0)
+    chunks = [{"id": str(i), "hash": str(i), "text": str(i)} for i in range(n)]
+    return NumpyVectorStore.build(str(tmp_path), "v1", chunks, lambda texts: rng.normal(size=(len(texts), dim)))
+
+
+def test_quant_name_includes_parameters():
+    assert quant_name("int8") == "int8"
+    assert quant_name("pq", m=8) == "pq_m8_b8"
+    assert quant_name("pq", m=8) != quant_name("pq", m=16)
+    assert quant_name("pq", m=8, ks=16) == "pq_m8_b4"
+
+
+def test_changing_subspaces_retrains(tmp_path):
+    store = _store(tmp_path)
+    assert store.quantize("pq", str(tmp_path), "v1", m=8, ks=16) is True
+    assert store.quantize("pq", str(tmp_path), "v1", m=8, ks=16) is False
+    assert store.quantize("pq", str(tmp_path), "v1", m=16, ks=16) is True
+    assert store.quantizer.m == 16
+    assert os.path.isfile(tmp_path / "quant_pq_m8_b4_v1.npz")
+    assert os.path.isfile(tmp_path / "quant_pq_m16_b4_v1.npz")
+
+
+def test_recall_uses_perturbed_queries(tmp_path):
+    # 用知识库向量本身作查询时 Recall@1 接近 1；扰动后的查询能反映粗排的真实误差
+    store = _store(tmp_path)
+    store.quantize("pq", str(tmp_path), "v1", m=4, ks=16)
+    store.rerank = 1
+    recall = store.evaluate_recall(k=1, n_queries=100)
+
+    rng = np.random.default_rng(0)
+    rows = rng.choice(len(store), size=100, replace=False)
+    self_recall = store.evaluate_recall(k=1, queries=np.asarray(store.embeddings[rows], dtype=np.float32))
+    assert 0.0 <= recall < self_recall
+
+
+def test_pq_scores_match_per_query_lookup():
+    rng = np.random.default_rng(1)
+    vectors = rng.normal(size=(300, 16)).astype(np.float32)
+    pq = ProductQuantizer(m=4, ks=16).fit(vectors)
+    queries = rng.normal(size=(5, 16)).astype(np.float32)
+    scores = pq.scores(queries)
+
+    # 逐个查询、逐个向量解码后求内积
+    decoded = np.concatenate([pq.centroids[j][pq.codes[:, j]] for j in range(4)], axis=1)
+    np.testing.assert_allclose(scores, queries @ decoded.T, rtol=1e-5, atol=1e-5)
+    np.testing.assert_allclose(pq.scores(queries[2:3]), scores[2:3], rtol=1e-6)
@@ -0,0 +1,56 @@
+import os
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from utils.info_extractor import image_record
+from utils.roi import merge_regions, roi_views, detection_bounds
+
+
+def test_merge_regions_pads_merges_and_caps():
+    bounds = np.array([[100, 100, 120, 120], [125, 100, 140, 120], [800, 600, 820, 620]], dtype=float)
+    regions = merge_regions(bounds, 1000, 800, pad_ratio=0.25, min_crop=64, max_crops=4)
+    assert len(regions) == 2  # 前两个框外扩后相交
+    assert (regions[:, 2] - regions[:, 0] >= 64).all()
+    assert (regions[:, [0, 1]] >= 0).all() and (regions[:, 2] <= 1000).all() and (regions[:, 3] <= 800).all()
+
+    capped = merge_regions(bounds, 1000, 800, min_crop=64, max_crops=1)
+    assert len(capped) == 1
+
+
+def test_normalized_coordinates_scaled():
+    bounds = detection_bounds(np.array([[0.1, 0.2, 0.3, 0.4]]), 1000, 500)
+    np.testing.assert_allclose(bounds, [[100, 100, 300, 200]])
+
+
+@pytest.fixture
+def leaf(tmp_path, detection_dir):
+    path = tmp_path / "leaf_test_roi.jpg"
+    Image.new("RGB", (1200, 900), (90, 140, 60)).save(path)
+    return path, str(detection_dir / "leaf_test_roi.txt")
+
+
+def test_roi_views_follow_detection_updates(leaf):
+    path, detection = leaf
+    with open(detection, "w", encoding="utf-8") as f:
+        f.write("0 0.1 0.1 0.2 0.2\n")
+    first = roi_views(image_record(path), {"max_coverage": 0.6})
+    assert first and len(first["crops"]) == 1
+    assert first["vision_tokens"] < first["full_vision_tokens"]
+
+    with open(detection, "w", encoding="utf-8") as f:
+        f.write("0 0.1 0.1 0.2 0.2\n0 0.7 0.7 0.8 0.8\n")
+    st = os.stat(detection)
+    os.utime(detection, ns=(st.st_atime_ns, st.st_mtime_ns + 1_000_000_000))
+    second = roi_views(image_record(path), {"max_coverage": 0.6})
+    assert len(second["crops"]) == 2
+    assert {c["box"] for c in second["crops"]} != {c["box"] for c in first["crops"]}
+
+
+def test_roi_skipped_without_detections_or_when_coverage_high(leaf):
+    path, detection = leaf
+    assert roi_views(image_record(path)) is None
+    with open(detection, "w", encoding="utf-8") as f:
+        f.write("0 0.0 0.0 1.0 1.0\n")
+    assert roi_views(image_record(path)) is None
@@ -0,0 +1,102 @@
+import threading
+import time
+
+import pytest
+
+from solutions.scheduler import Node, SlotPool, run_graph
+
+
+def test_single_slot_runs_llm_nodes_in_declaration_order():
+    for _ in range(20):
+        order = []
+
+        def stage(name):
+            def func(slot, **_):
+                order.append(name)
+                time.sleep(0.001)
+                return name
+            return func
+
+        nodes = [Node("retrieve", lambda: "kb")]
+        nodes += [Node(f"stage_{i}", stage(f"stage_{i}"), deps=("retrieve",), llm=True) for i in range(1, 5)]
+        results = run_graph(nodes, llm_slots=1)
+        assert order == ["stage_1", "stage_2", "stage_3", "stage_4"]
+        assert results["stage_3"] == "stage_3"
+
+
+def test_parallel_slots_and_slot_reuse():
+    slots_seen = []
+    barrier = threading.Barrier(2, timeout=5)
+
+    def parallel(slot):
+        slots_seen.append(slot)
+        barrier.wait()  # 两个 slot 时两个阶段必须同时运行
+        return slot
+
+    def final(slot, a, b):
+        return slot
+
+    results = run_graph([
+        Node("a", parallel, llm=True),
+        Node("b", parallel, llm=True),
+        Node("final", final, deps=("a", "b"), llm=True),
+    ], llm_slots=2)
+    assert sorted(slots_seen) == [0, 1]
+    assert results["final"] in (0, 1)
+
+
+def test_shared_pool_serves_reservations_in_order():
+    pool = SlotPool(1)
+    held = pool.acquire()
+    tickets = [pool.reserve() for _ in range(3)]
+    order = []
+
+    def worker(t):
+        slot = pool.acquire(ticket=t)
+        order.append(t)
+        pool.release(slot)
+
+    threads = [threading.Thread(target=worker, args=(t,)) for t in reversed(tickets)]
+    for th in threads:
+        th.start()
+    time.sleep(0.05)
+    assert order == []
+    pool.release(held)
+    for th in threads:
+        th.join(5)
+    assert order == tickets
+
+
+def test_cancelled_reservation_does_not_block_queue():
+    pool = SlotPool(1)
+    first, second = pool.reserve(), pool.reserve()
+    pool.cancel(first)
+    assert pool.acquire(ticket=second) == 0
+
+
+def test_failure_propagates_and_pool_is_released():
+    pool = SlotPool(1)
+
+    def boom(slot):
+        raise RuntimeError("stage failed")
+
+    with pytest.raises(RuntimeError):
+        run_graph([
+            Node("a", boom, llm=True),
+            Node("b", lambda slot, a: a, deps=("a",), llm=True),
+        ], slots=pool)
+    assert pool.acquire() == 0
+
+
+def test_cycle_detected():
+    with pytest.raises(ValueError):
+        run_graph([Node("a", lambda b: b, deps=("b",)), Node("b", lambda a: a, deps=("a",))])
+
+
+def test_graph_prefers_given_slot():
+    pool = SlotPool(3)
+    results = run_graph([
+        Node("a", lambda slot: slot, llm=True),
+        Node("b", lambda slot, a: slot, deps=("a",), llm=True),
+    ], slots=pool, prefer=[2])
+    assert results == {"a": 2, "b": 2}
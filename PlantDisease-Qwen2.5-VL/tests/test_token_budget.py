@@ -0,0 +1,70 @@
+import pytest
+
+from solutions import token_budget
+from solutions.token_budget import keep_m_tokens, latest_images, MESSAGE_OVERHEAD
+
+IMG = "data:image/jpeg;base64,AAAA"
+
+
+@pytest.fixture(autouse=True)
+def fixed_counts(monkeypatch):
+    # 每个字符 1 token，每张图像 100 token，不请求 llama-server
+    monkeypatch.setattr(token_budget, "count_text_tokens", len)
+    monkeypatch.setattr(token_budget, "_data_uri_tokens", lambda url: 100)
+
+
+def _user(text, image=False):
+    content = [{"type": "image_url", "image_url": {"url": IMG}}] if image else []
+    return {"role": "user", "content": content + [{"type": "text", "text": text}]}
+
+
+def _conversation(turns, image_turn=0):
+    messages = [{"role": "system", "content": "s" * 10}]
+    for i in range(turns):
+        messages.append(_user("q" * 50, image=(i == image_turn)))
+        messages.append({"role": "assistant", "content": "a" * 50})
+    messages.append(_user("current"))
+    return messages
+
+
+def test_under_budget_is_untouched():
+    messages = _conversation(2)
+    before = [dict(m) for m in messages]
+    assert keep_m_tokens(messages, budget=10_000) == before
+
+
+def test_trim_keeps_system_current_and_images():
+    messages = _conversation(6, image_turn=0)
+    system, current = messages[0], messages[-1]
+    keep_m_tokens(messages, budget=400)
+
+    assert messages[0] is system and messages[-1] is current
+    assert len(messages) < 14
+    # 带图像的第一轮被丢弃，图像移到本轮消息的开头
+    assert messages[-1]["content"][0] == {"type": "image_url", "image_url": {"url": IMG}}
+    assert messages[-1]["content"][-1]["text"] == "current"
+    index, parts = latest_images(messages)
+    assert index == len(messages) - 1 and len(parts) == 1
+    total = sum(token_budget.count_message_tokens(m) for m in messages)
+    assert total <= 400
+
+
+def test_trim_drops_whole_turns():
+    messages = _conversation(6, image_turn=5)
+    keep_m_tokens(messages, budget=400)
+    roles = [m["role"] for m in messages[1:-1]]
+    assert roles[0] == "user" and roles == ["user", "assistant"] * (len(roles) // 2)
+    # 图像所在的轮次未被丢弃时不移动
+    assert latest_images(messages)[0] < len(messages) - 1
+
+
+def test_images_in_current_message_are_not_duplicated():
+    messages = _conversation(6, image_turn=0)
+    messages[-1] = _user("current", image=True)
+    keep_m_tokens(messages, budget=400)
+    assert sum(c["type"] == "image_url" for m in messages[1:] for c in m["content"]
+               if isinstance(m["content"], list)) == 1
+
+
+def test_message_overhead_counted():
+    assert token_budget.count_message_tokens({"content": "abc"}) == MESSAGE_OVERHEAD + 3
@@ -0,0 +1,42 @@
+import numpy as np
+
+from retrieval import vector_store
+from retrieval.vector_store import NumpyVectorStore
+
+
+def _store(tmp_path, n=300, dim=32, seed=0):
+    rng = np.random.default_rng(seed)
+    chunks = [{"id": str(i), "hash": str(i), "text": f"chunk {i}"} for i in range(n)]
+    return NumpyVectorStore.build(str(tmp_path), "v1", chunks, lambda texts: rng.normal(size=(len(texts), dim)))
+
+
+def test_blockwise_scores_match_full_matmul(tmp_path, monkeypatch):
+    store = _store(tmp_path)
+    assert isinstance(store.embeddings, np.memmap)
+    queries = np.random.default_rng(1).normal(size=(3, 32)).astype(np.float32)
+    queries /= np.linalg.norm(queries, axis=1, keepdims=True)
+
+    monkeypatch.setattr(vector_store, "SCAN_BLOCK", 64)
+    blockwise = store._exact_scores(queries)
+    full = queries @ np.asarray(store.embeddings, dtype=np.float32).T
+    np.testing.assert_allclose(blockwise, full, rtol=1e-5, atol=1e-6)
+
+    hits = store.query_batch(queries, top_k=5)
+    for row, q in zip(hits, full):
+        assert [i for i, _ in row] == list(np.argsort(-q, kind="stable")[:5])
+
+
+def test_query_does_not_copy_memmap(tmp_path, monkeypatch):
+    store = _store(tmp_path)
+    monkeypatch.setattr(vector_store, "SCAN_BLOCK", 64)
+    seen = []
+    original = np.asarray
+
+    def spy(a, *args, **kwargs):
+        if isinstance(a, np.memmap):
+            seen.append(len(a))
+        return original(a, *args, **kwargs)
+
+    monkeypatch.setattr(vector_store.np, "asarray", spy)
+    store.query(np.ones(32, dtype=np.float32), top_k=3)
+    assert seen and max(seen) <= 64
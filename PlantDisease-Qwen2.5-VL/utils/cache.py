@@ -0,0 +1,195 @@
+'''
+通用的线程安全 LRU 缓存，按条目数和字节数双重限制容量，并统计命中情况。
+DiskLRU 为同样按字节数限制容量的磁盘缓存（每个条目一个文件）。
+'''
+import os
+import sys
+import threading
+from collections import OrderedDict
+
+
+class LRUCache:
+    """
+    容量受限的 LRU 缓存
+
+    Args:
+        max_bytes (int): 缓存总字节数上限（按 sizeof 估算）
+        max_items (int): 条目数上限，None 表示不限制
+        sizeof (callable): 估算单个值所占字节数的函数，默认 sys.getsizeof
+    """
+
+    def __init__(self, max_bytes: int, max_items: int = None, sizeof=sys.getsizeof):
+        self.max_bytes = max_bytes
+        self.max_items = max_items
+        self.sizeof = sizeof
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.nbytes = 0
+
+        self._data = OrderedDict()  # key -> (value, size)
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return item[0]
+
+    def put(self, key, value):
+        size = self.sizeof(value)
+        # 单个值超过总容量时不缓存，避免把其他条目全部挤出
+        if size > self.max_bytes:
+            return
+
+        with self._lock:
+            old = self._data.pop(key, None)
+            if old is not None:
+                self.nbytes -= old[1]
+            self._data[key] = (value, size)
+            self.nbytes += size
+
+            while self._data and (
+                self.nbytes > self.max_bytes
+                or (self.max_items is not None and len(self._data) > self.max_items)
+            ):
+                _, (_, evicted) = self._data.popitem(last=False)
+                self.nbytes -= evicted
+                self.evictions += 1
+
+    def evict(self, predicate) -> int:
+        """
+        移除所有 predicate(key) 为真的条目，返回移除数量
+        """
+        with self._lock:
+            keys = [k for k in self._data if predicate(k)]
+            for k in keys:
+                self.nbytes -= self._data.pop(k)[1]
+            return len(keys)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.nbytes = 0
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._data
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "evictions": self.evictions,
+            "items": len(self._data),
+            "bytes": self.nbytes,
+        }
+
+
+class DiskLRU:
+    """
+    容量受限的磁盘 LRU 缓存，每个条目为目录下的一个文本文件 <key><suffix>。
+    文件大小与访问顺序保存在内存索引中，写入时不再遍历目录；命中时更新文件的修改时间，
+    下次启动扫描目录重建索引时仍按最近访问的顺序淘汰。
+    其他进程同时写入的文件不在本进程的索引中，由它们各自的索引或下次启动时的扫描计入容量。
+
+    Args:
+        directory (str): 缓存目录
+        max_bytes (int): 文件总字节数上限
+        suffix (str): 文件扩展名
+    """
+
+    def __init__(self, directory: str, max_bytes: int, suffix: str = ".uri", encoding: str = "ascii"):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.suffix = suffix
+        self.encoding = encoding
+        self.nbytes = 0
+
+        self._index = None  # key -> 文件大小，按访问顺序排列
+        self._lock = threading.Lock()
+
+    def _path(self, key) -> str:
+        return os.path.join(self.directory, f"{key}{self.suffix}")
+
+    def _load_index(self):
+        # 首次访问时扫描一次目录，按修改时间（即最近访问时间）排序
+        if self._index is not None:
+            return
+        self._index = OrderedDict()
+        try:
+            entries = [e for e in os.scandir(self.directory) if e.name.endswith(self.suffix) and e.is_file()]
+        except OSError:
+            entries = []
+        for entry, st in sorted(((e, e.stat()) for e in entries), key=lambda x: x[1].st_mtime_ns):
+            self._index[entry.name[:-len(self.suffix)]] = st.st_size
+            self.nbytes += st.st_size
+
+    def get(self, key, default=None):
+        path = self._path(key)
+        try:
+            with open(path, "r", encoding=self.encoding) as f:
+                value = f.read()
+        except OSError:
+            with self._lock:
+                if self._index is not None and key in self._index:
+                    self.nbytes -= self._index.pop(key)
+            return default
+
+        with self._lock:
+            self._load_index()
+            size = self._index.pop(key, None)
+            if size is None:
+                size = len(value.encode(self.encoding))
+                self.nbytes += size
+            self._index[key] = size
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return value
+
+    def put(self, key, value: str):
+        """写入文件，超出容量时删除最久未访问的文件。写入失败时抛出 OSError"""
+        data = value.encode(self.encoding)
+        os.makedirs(self.directory, exist_ok=True)
+        path = self._path(key)
+        with open(path + ".tmp", "wb") as f:
+            f.write(data)
+        os.replace(path + ".tmp", path)
+
+        with self._lock:
+            self._load_index()
+            old = self._index.pop(key, None)
+            if old is not None:
+                self.nbytes -= old
+            self._index[key] = len(data)
+            self.nbytes += len(data)
+
+            while self.nbytes > self.max_bytes and len(self._index) > 1:
+                evicted, size = self._index.popitem(last=False)
+                self.nbytes -= size
+                try:
+                    os.remove(self._path(evicted))
+                except OSError:
+                    pass
+
+    def __contains__(self, key):
+        with self._lock:
+            self._load_index()
+            return key in self._index
+
+    def __len__(self):
+        with self._lock:
+            self._load_index()
+            return len(self._index)
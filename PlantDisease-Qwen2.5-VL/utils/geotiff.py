@@ -0,0 +1,407 @@
+"""
+GeoTIFF Tiling
+大幅正射影像（GeoTIFF）的窗口化处理，内存占用只与输出尺寸 / 分块大小有关，与文件大小无关：
+- 整图发送时按目标尺寸读取降采样概览（有内部金字塔时由 GDAL 直接读取金字塔层）
+- 批量简报时按固定大小的窗口切分为分块，每个分块在处理到时才读取像素，写出 JPEG 与同名元数据 .json，
+  元数据中带有分块的地理范围与中心坐标（center_coord），随后与普通图像走相同的流程（见 find_metadata）
+PIL 无法解码的 TIFF（如 16 位多波段、BigTIFF）同样经由 rasterio 读取。
+需要 rasterio；未安装时 TIFF 仍按普通图像处理。
+"""
+
+import os
+import io
+import json
+import hashlib
+import datetime
+import threading
+from collections import defaultdict
+from contextlib import contextmanager
+from pathlib import Path
+import numpy as np
+from PIL import Image
+
+from utils import CONFIG_AND_SETTINGS, LOGGER, CACHE_DIR
+from utils.cache import LRUCache
+
+try:
+    import rasterio
+    from rasterio.enums import Resampling
+    from rasterio.warp import transform_bounds
+    from rasterio.windows import Window, bounds as window_bounds
+    RASTERIO_AVAILABLE = True
+except ImportError:
+    RASTERIO_AVAILABLE = False
+
+GEOTIFF_CONFIG = CONFIG_AND_SETTINGS.get("geotiff") or {}
+LARGE_RASTER_PIXELS = GEOTIFF_CONFIG.get("large_pixels", 50_000_000)
+TILE_SIZE = GEOTIFF_CONFIG.get("tile_size", 2048)
+TILE_OVERLAP = GEOTIFF_CONFIG.get("tile_overlap", 256)
+MIN_VALID = GEOTIFF_CONFIG.get("min_valid", 0.05)
+OVERVIEW_MAX_PIXELS = GEOTIFF_CONFIG.get("overview_max_pixels", 4 * 1024 ** 2)
+# GDAL 块缓存上限（MB）。默认按物理内存的 5% 增长，降采样读取没有金字塔的大幅影像时会缓存大量原始块
+GDAL_CACHE_MB = GEOTIFF_CONFIG.get("gdal_cache_mb", 64)
+TILE_DIR = os.path.join(CACHE_DIR, "tiles")
+JPEG_QUALITY = 95
+
+# 降采样概览缓存：(路径, mtime_ns, 大小) -> (数据, 掩膜, 拉伸参数)。
+# 没有金字塔的影像读取一次概览要解压整幅影像，整图发送（两种模式）与分块规划共用同一次读取；同时以 .npz 写入磁盘
+_OVERVIEWS = LRUCache(max_bytes=256 * 1024 ** 2, sizeof=lambda v: v[0].nbytes + v[1].nbytes)
+_OVERVIEW_LOCKS = defaultdict(threading.Lock)
+_OVERVIEW_LOCKS_GUARD = threading.Lock()
+
+
+@contextmanager
+def _open(img_path):
+    # 限定 GDAL 缓存后打开数据集
+    with rasterio.Env(GDAL_CACHEMAX=GDAL_CACHE_MB), rasterio.open(img_path) as ds:
+        yield ds
+
+
+def needs_rasterio(img_path) -> bool:
+    """
+    TIFF 是否需要经由 rasterio 读取：像素数超过 LARGE_RASTER_PIXELS，或 PIL 无法识别。只读取文件头。
+    """
+    if not RASTERIO_AVAILABLE or Path(img_path).suffix.lower() not in ('.tif', '.tiff'):
+        return False
+    try:
+        with _open(img_path) as ds:
+            if ds.width * ds.height > LARGE_RASTER_PIXELS:
+                return True
+    except Exception as e:
+        LOGGER.debug(f"rasterio无法读取{img_path}，按普通图像处理：{e}")
+        return False
+    try:
+        with Image.open(img_path) as img:
+            img.size
+        return False
+    except Exception:
+        return True
+
+
+def raster_size(img_path) -> tuple:
+    """
+    returns:
+        (width, height)，只读取文件头
+    """
+    if not RASTERIO_AVAILABLE:
+        raise ImportError("读取该TIFF需要安装rasterio")
+    with _open(img_path) as ds:
+        return ds.width, ds.height
+
+
+def _fit(width, height, max_pixels) -> tuple:
+    scale = min(1.0, (max_pixels / (width * height)) ** 0.5)
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+
+def _bands(ds) -> list:
+    # 前三个波段作为 RGB，单波段影像按灰度处理
+    return [1, 2, 3] if ds.count >= 3 else [1]
+
+
+def _to_rgb(data: np.ndarray, mask: np.ndarray, stretch) -> np.ndarray:
+    """
+    (波段, 高, 宽) 的原始数据 -> (高, 宽, 3) uint8。非 uint8 数据按 stretch 线性拉伸，nodata 置黑
+    """
+    if stretch is not None:
+        lo, hi = stretch
+        # 原地运算，分块只多占用一份 float32 副本
+        data = data.astype(np.float32)
+        data -= lo[:, None, None]
+        data *= (255 / np.maximum(hi - lo, 1e-6))[:, None, None]
+        np.clip(data, 0, 255, out=data)
+        np.nan_to_num(data, copy=False)
+    data = data.astype(np.uint8)
+    if data.shape[0] == 1:
+        data = np.repeat(data, 3, axis=0)
+    data[:, mask == 0] = 0
+    return np.ascontiguousarray(data.transpose(1, 2, 0))
+
+
+def _stretch(overview: np.ndarray, mask: np.ndarray):
+    # 整幅影像统一的拉伸参数（有效像素的 2%~98% 分位数），各分块颜色一致
+    if overview.dtype == np.uint8:
+        return None
+    valid = overview[:, mask > 0]
+    if not valid.size:
+        return None
+    lo, hi = np.percentile(valid, [2, 98], axis=1)
+    return lo.astype(np.float32), hi.astype(np.float32)
+
+
+def _read_overview(ds, size) -> tuple:
+    """
+    按 size 读取降采样概览，返回 ((波段, 高, 宽) 数据, (高, 宽) 有效像素掩膜)
+    """
+    width, height = size
+    bands = _bands(ds)
+    if ds.overviews(1):
+        # 有内部金字塔时 GDAL 直接读取合适的金字塔层
+        data = ds.read(bands, out_shape=(len(bands), height, width), resampling=Resampling.average)
+        mask = ds.dataset_mask(out_shape=(height, width), resampling=Resampling.nearest)
+        return data, mask
+
+    # 没有金字塔：按分块窗口读取原始分辨率数据后在内存中降采样（GDAL 的降采样读取对无金字塔的影像很慢），
+    # 每个数据块只解压一次，内存只与分块大小有关
+    data = np.zeros((len(bands), height, width), dtype=ds.dtypes[0])
+    mask = np.zeros((height, width), dtype=np.uint8)
+    sx, sy = width / ds.width, height / ds.height
+    for _, _, (col, row, w, h) in _windows(ds.width, ds.height, TILE_SIZE, 0):
+        x0, x1 = round(col * sx), round((col + w) * sx)
+        y0, y1 = round(row * sy), round((row + h) * sy)
+        if x1 <= x0 or y1 <= y0:
+            continue
+        window = Window(col, row, w, h)
+        data[:, y0:y1, x0:x1] = _box_mean(ds.read(bands, window=window), y1 - y0, x1 - x0)
+        valid = _box_mean(ds.dataset_mask(window=window)[None], y1 - y0, x1 - x0)[0]
+        mask[y0:y1, x0:x1] = np.where(valid >= 127.5, 255, 0)
+    return data, mask
+
+
+def _box_mean(data: np.ndarray, out_h: int, out_w: int) -> np.ndarray:
+    # (波段, 高, 宽) 按面积平均缩小到 (波段, out_h, out_w)
+    rows = np.linspace(0, data.shape[1], out_h + 1).astype(int)
+    cols = np.linspace(0, data.shape[2], out_w + 1).astype(int)
+    summed = np.add.reduceat(np.add.reduceat(data.astype(np.float32), rows[:-1], axis=1), cols[:-1], axis=2)
+    area = np.outer(np.diff(rows), np.diff(cols)).astype(np.float32)
+    return (summed / area).astype(data.dtype)
+
+
+def _source_dir(img_path) -> Path:
+    """
+    原影像的分块与概览缓存目录：TILE_DIR/<影像名>_<绝对路径哈希>，不同目录下的同名影像互不覆盖
+    """
+    img_path = os.path.abspath(img_path)
+    digest = hashlib.sha1(img_path.encode("utf-8")).hexdigest()[:12]
+    return Path(TILE_DIR) / f"{Path(img_path).stem}_{digest}"
+
+
+def _overview_path(img_path) -> str:
+    return str(_source_dir(img_path) / "overview.npz")
+
+
+def _cached_overview(ds, img_path) -> tuple:
+    """
+    OVERVIEW_MAX_PIXELS 尺寸的概览，每个影像版本只读取一次（内存 LRU + 磁盘 .npz，原影像变化后失效）。
+
+    Returns:
+        (数据, 掩膜, 拉伸参数)
+    """
+    stat = os.stat(img_path)
+    key = (os.path.abspath(img_path), stat.st_mtime_ns, stat.st_size)
+    with _OVERVIEW_LOCKS_GUARD:
+        lock = _OVERVIEW_LOCKS[key[0]]
+    with lock:
+        cached = _OVERVIEWS.get(key)
+        if cached is not None:
+            return cached
+
+        path = _overview_path(img_path)
+        source = np.array(key[1:], dtype=np.int64)
+        try:
+            with np.load(path) as f:
+                if np.array_equal(f["source"], source):
+                    stretch = (f["lo"], f["hi"]) if "lo" in f.files else None
+                    cached = (f["data"], f["mask"], stretch)
+        except Exception:
+            pass  # 缓存不存在或已损坏
+
+        if cached is None:
+            data, mask = _read_overview(ds, _fit(ds.width, ds.height, OVERVIEW_MAX_PIXELS))
+            stretch = _stretch(data, mask)
+            cached = (data, mask, stretch)
+            extra = {"lo": stretch[0], "hi": stretch[1]} if stretch is not None else {}
+            try:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+                with open(tmp_path, "wb") as f:
+                    np.savez(f, data=data, mask=mask, source=source, **extra)
+                os.replace(tmp_path, path)
+            except OSError as e:
+                LOGGER.debug(f"概览缓存写入失败，已忽略：{e}")
+
+        _OVERVIEWS.put(key, cached)
+        return cached
+
+
+def overview_jpeg(img_path, size=None, quality=JPEG_QUALITY) -> bytes:
+    """
+    按 size（为空时按 OVERVIEW_MAX_PIXELS）读取整幅影像的降采样概览并编码为 JPEG，不整幅读入内存。
+    不超过缓存概览尺寸时由缓存的概览缩小得到，不再读取影像。
+    """
+    with _open(img_path) as ds:
+        data, mask, stretch = _cached_overview(ds, img_path)
+        width, height = size or (data.shape[2], data.shape[1])
+        if width <= data.shape[2] and height <= data.shape[1]:
+            if (width, height) != (data.shape[2], data.shape[1]):
+                data = _box_mean(data, height, width)
+                mask = np.where(_box_mean(mask[None], height, width)[0] >= 127.5, 255, 0).astype(np.uint8)
+        else:
+            # 大于缓存概览时直接读取（拉伸参数仍与分块一致）
+            data, mask = _read_overview(ds, (width, height))
+        rgb = _to_rgb(data, mask, stretch)
+    return _jpeg(rgb, quality)
+
+
+def _jpeg(rgb: np.ndarray, quality=JPEG_QUALITY) -> bytes:
+    buffer = io.BytesIO()
+    Image.fromarray(rgb).save(buffer, format="JPEG", quality=quality, optimize=True, subsampling=0)
+    return buffer.getvalue()
+
+
+# ==================================================
+# 分块
+# ==================================================
+class GeoTile:
+    """
+    大幅影像中的一个分块。创建时只记录窗口与地理信息，materialize 时才读取像素。
+
+    Attributes:
+        source (str): 原始 GeoTIFF 路径
+        window (tuple): (col_off, row_off, width, height)，原图像素坐标
+        path (Path): 分块 JPEG 的路径（CACHE_DIR/tiles/<影像名>_<路径哈希>/<影像名>_r<行>_c<列>.jpg，见 _source_dir）
+        metadata (dict): 写入同名 .json 的元数据，含 center_coord、bounds 等
+    """
+
+    def __init__(self, source, window, path, metadata, stretch):
+        self.source = source
+        self.window = window
+        self.path = path
+        self.metadata = metadata
+        self._stretch = stretch
+
+    def __repr__(self):
+        return f"GeoTile({self.path.name}, window={self.window})"
+
+    def materialize(self) -> Path:
+        """
+        读取窗口像素，写出分块 JPEG 与元数据 .json，返回 JPEG 路径。原影像未变化时直接复用已写出的分块。
+        """
+        meta_path = self.path.with_suffix('.json')
+        try:
+            with open(meta_path, 'r', encoding='utf-8') as f:
+                written = json.load(f)
+        except (OSError, ValueError):
+            written = {}
+
+        if written.get("source_signature") != self.metadata["source_signature"] or not self.path.exists():
+            col, row, width, height = self.window
+            with _open(self.source) as ds:
+                window = Window(col, row, width, height)
+                data = ds.read(_bands(ds), window=window)
+                mask = ds.dataset_mask(window=window)
+            rgb = _to_rgb(data, mask, self._stretch)
+
+            os.makedirs(self.path.parent, exist_ok=True)
+            Image.fromarray(rgb).save(self.path, format="JPEG", quality=JPEG_QUALITY, optimize=True, subsampling=0)
+            written = {}
+
+        # 原影像的元数据文件修改后，只需重写分块的元数据
+        if written != self.metadata:
+            with open(meta_path, 'w', encoding='utf-8') as f:
+                json.dump(self.metadata, f, ensure_ascii=False, indent=2)
+        return self.path
+
+
+def is_tile_metadata(metadata: dict) -> bool:
+    """元数据是否由 plan_tiles 为分块写出（分块 JPEG 不含 EXIF，拍摄时间取自元数据）"""
+    return bool(metadata) and "source_signature" in metadata and "window" in metadata
+
+
+def _windows(width, height, tile_size, overlap):
+    step = max(1, tile_size - overlap)
+    rows = range(0, max(height - overlap, 1), step)
+    cols = range(0, max(width - overlap, 1), step)
+    for r, row in enumerate(rows):
+        for c, col in enumerate(cols):
+            yield r, c, (col, row, min(tile_size, width - col), min(tile_size, height - row))
+
+
+def _capture_time(ds, img_path, source_meta: dict) -> str:
+    if source_meta.get("capture_time"):
+        return source_meta["capture_time"]
+    tagged = ds.tags().get("TIFFTAG_DATETIME")
+    if tagged:
+        return tagged
+    return datetime.datetime.fromtimestamp(os.path.getmtime(img_path)).strftime("%Y-%m-%d %H:%M")
+
+
+def plan_tiles(img_path, tile_size: int = TILE_SIZE, overlap: int = TILE_OVERLAP,
+               min_valid: float = MIN_VALID, source_meta: dict = None) -> list:
+    """
+    将大幅影像划分为分块。只使用降采样概览（计算拉伸参数与各分块的有效像素比例，见 _cached_overview），
+    不读取原始分辨率像素。
+
+    Args:
+        source_meta (dict): 原影像的农业元数据（作物类型、生育期等），分块继承
+    Returns:
+        list[GeoTile]: 按行列顺序排列，有效像素比例低于 min_valid 的分块（如正射影像边缘的 nodata）已跳过
+    """
+    img_path = os.path.abspath(img_path)
+    source_meta = source_meta or {}
+    stat = os.stat(img_path)
+    stem = Path(img_path).stem
+    tile_dir = _source_dir(img_path)
+
+    tiles = []
+    with _open(img_path) as ds:
+        _, ov_mask, stretch = _cached_overview(ds, img_path)
+        sx, sy = ov_mask.shape[1] / ds.width, ov_mask.shape[0] / ds.height
+        capture_time = _capture_time(ds, img_path, source_meta)
+        crs = ds.crs
+        size = (ds.width, ds.height)
+
+        for r, c, (col, row, width, height) in _windows(*size, tile_size, overlap):
+            # 在概览上估算分块的有效像素比例
+            sub = ov_mask[int(row * sy):max(int((row + height) * sy), int(row * sy) + 1),
+                          int(col * sx):max(int((col + width) * sx), int(col * sx) + 1)]
+            if sub.size and np.count_nonzero(sub) / sub.size < min_valid:
+                continue
+
+            left, bottom, right, top = window_bounds(Window(col, row, width, height), ds.transform)
+            metadata = {
+                **source_meta,
+                "capture_time": capture_time,
+                "center_coord": None,
+                "source": img_path,
+                "source_signature": [stat.st_mtime_ns, stat.st_size],
+                "window": [col, row, width, height],
+                "crs": crs.to_string() if crs else None,
+                "crs_bounds": [left, bottom, right, top],
+            }
+            if crs:
+                # 地理范围与中心点统一为 WGS84 经纬度
+                west, south, east, north = transform_bounds(crs, "EPSG:4326", left, bottom, right, top)
+                metadata["bounds"] = [west, south, east, north]
+                metadata["center_coord"] = [(west + east) / 2, (south + north) / 2]
+
+            path = tile_dir / f"{stem}_r{r:03d}_c{c:03d}.jpg"
+            tiles.append(GeoTile(img_path, (col, row, width, height), path, metadata, stretch))
+
+    if not crs:
+        LOGGER.warning(f"{img_path}不含坐标参考系，分块元数据中没有地理坐标。")
+    LOGGER.info(f"{Path(img_path).name}：{size[0]}x{size[1]}，切分为{len(tiles)}个{tile_size}像素的分块"
+                f"（重叠{overlap}像素，已跳过无效区域）。")
+    return tiles
+
+
+def iter_tiles(img_path, **kwargs):
+    """
+    逐个生成分块 JPEG 的路径：每次只读取一个窗口，峰值内存与分块大小有关，与影像大小无关
+    """
+    for tile in plan_tiles(img_path, **kwargs):
+        yield tile.materialize()
+
+
+if __name__ == "__main__":
+    import sys
+    import time
+    import psutil
+    start = time.perf_counter()
+    process = psutil.Process()
+    peak = 0
+    n = 0
+    for _ in iter_tiles(sys.argv[1]):
+        n += 1
+        peak = max(peak, process.memory_info().rss)
+    print({"tiles": n, "elapsed_s": time.perf_counter() - start, "peak_rss_mb": peak / 1024 ** 2})
@@ -7,13 +7,32 @@ import base64
 import io
 import re
 import json
+import math
+import hashlib
 from pathlib import Path
 from typing import List, Dict
 from PIL import Image
 from utils import CONFIG_AND_SETTINGS, LOGGER, CACHE_DIR
+from utils.cache import LRUCache, DiskLRU
+from utils.geotiff import needs_rasterio, overview_jpeg, raster_size
 
 SUPPORTED_FORMATS = ['.jpg', '.jpeg', '.png', '.bmp', '.tif', '.tiff']
 MIME_MAP = ['jpeg', 'jpeg', 'png', 'bmp', 'tiff', 'tiff']
+JPEG_QUALITY = 95
+
+# base64 data URI 缓存：内存中按字节数限制容量，同时写入磁盘，跨进程 / 多次运行复用
+DATA_URI_CACHE = LRUCache(
+    max_bytes=int(CONFIG_AND_SETTINGS.get("image_cache_mb", 256) * 1024 ** 2),
+    sizeof=len
+)
+DATA_URI_DIR = os.path.join(CACHE_DIR, "data_uri")
+DATA_URI_DISK_BYTES = int(CONFIG_AND_SETTINGS.get("image_disk_cache_mb", 2048) * 1024 ** 2)
+DATA_URI_DISK = DiskLRU(DATA_URI_DIR, DATA_URI_DISK_BYTES, suffix=".uri")
+
+# Qwen2.5-VL 视觉编码：14 像素 patch，2x2 合并为 1 个视觉 token，即每个 token 覆盖 28x28 像素
+PATCH_SIZE = 28
+# 各模式的像素预算：{mode: {"min_pixels": int, "max_pixels": int}}，未配置的模式按原图发送
+RESIZE_POLICY = CONFIG_AND_SETTINGS.get("image_resize") or {}
 
 def handle_files(raw_path_input: List[str]) -> List[Path]:
     '''
@@ -83,29 +102,160 @@ def format_checker(img_path):
         raise AssertionError
     return filename, ext
 
-def compress_to_jpeg(img_path, quality=95):
+def smart_resize(width, height, min_pixels, max_pixels, factor=PATCH_SIZE):
+    '''
+    与 Qwen2.5-VL 预处理相同的缩放规则：宽高取 factor 的整数倍，总像素数落在 [min_pixels, max_pixels] 内，尽量保持宽高比。
+    returns:
+        (width, height)
+    '''
+    h_bar = max(factor, round(height / factor) * factor)
+    w_bar = max(factor, round(width / factor) * factor)
+    if h_bar * w_bar > max_pixels:
+        beta = math.sqrt(height * width / max_pixels)
+        h_bar = max(factor, math.floor(height / beta / factor) * factor)
+        w_bar = max(factor, math.floor(width / beta / factor) * factor)
+    elif h_bar * w_bar < min_pixels:
+        beta = math.sqrt(min_pixels / (height * width))
+        h_bar = math.ceil(height * beta / factor) * factor
+        w_bar = math.ceil(width * beta / factor) * factor
+    return w_bar, h_bar
+
+def estimate_vision_tokens(width, height, factor=PATCH_SIZE) -> int:
+    '''
+    估算图像占用的视觉 token 数（宽高需已对齐到 factor），另加 <|vision_start|>、<|vision_end|> 两个标记
+    '''
+    return (width // factor) * (height // factor) + 2
+
+def resize_plan(img_path, mode=None, size=None) -> dict:
+    '''
+    计算图像在指定模式（'briefing' / 'chat'）下实际发送的分辨率。只读取文件头，不解码像素。
+    size: 已知的原图尺寸（如 ImageRecord 中记录的尺寸），给出时不再打开文件
+    returns:
+        {"original": (w, h), "sent": (w, h), "vision_tokens": int}
+    '''
+    if size is None:
+        size = image_size(img_path)
+    policy = RESIZE_POLICY.get(mode) if mode else None
+    sent = smart_resize(*size, policy.get("min_pixels", 4 * PATCH_SIZE ** 2),
+                        policy.get("max_pixels", 16384 * PATCH_SIZE ** 2)) if policy else size
+    # 未缩放的图像由 llama-server 自行对齐到 28 像素网格
+    aligned = sent if policy else smart_resize(*size, 0, float('inf'))
+    return {"original": size, "sent": sent, "vision_tokens": estimate_vision_tokens(*aligned)}
+
+def image_size(img_path) -> tuple:
+    '''
+    只读取文件头获取 (width, height)。PIL 无法打开的 TIFF（超大或 16 位多波段）改由 rasterio 读取。
+    '''
+    try:
+        with Image.open(img_path) as img:
+            return img.size
+    except (Image.UnidentifiedImageError, Image.DecompressionBombError):
+        if os.path.splitext(str(img_path))[1].lower() not in ['.tif', '.tiff']:
+            raise
+        return raster_size(img_path)
+
+def compress_to_jpeg(img_path, quality=JPEG_QUALITY, size=None):
     with Image.open(img_path) as img:
-        img = img.convert("RGB")
-        # img.thumbnail((max_size, max_size))
-        buffer = io.BytesIO()
-        img.save(
-            buffer,
-            format="JPEG",
-            quality=quality,
-            optimize=True,
-            subsampling=0,
-            progressive=True
-        )
-        buffer.seek(0)
-        return buffer.read()
-
-def image_to_base64_data_uri(img_path, compress=False, prefix=False):
-    '''
-    将图像以 base64 编码的 data URI 传递给llama.cpp
+        return image_to_jpeg(img, quality, size)
+
+def image_to_jpeg(img, quality=JPEG_QUALITY, size=None):
+    '''
+    将已打开的 PIL 图像（可为裁剪结果）按 size 缩放后编码为 JPEG 字节
+    '''
+    img = img.convert("RGB")
+    if size and size != img.size:
+        img = img.resize(size, Image.Resampling.LANCZOS)
+    buffer = io.BytesIO()
+    img.save(
+        buffer,
+        format="JPEG",
+        quality=quality,
+        optimize=True,
+        subsampling=0,
+        progressive=True
+    )
+    buffer.seek(0)
+    return buffer.read()
+
+def file_signature(img_path) -> tuple:
+    '''
+    returns:
+        (绝对路径, mtime_ns, 文件大小, os.stat_result)。文件内容未变化时前三项不变，用作各级缓存的键。
     '''
+    path = os.path.abspath(img_path)
+    stat = os.stat(path)
+    return path, stat.st_mtime_ns, stat.st_size, stat
+
+def _data_uri_key(signature, compress, size=None, box=None) -> str:
+    # 图像文件未变化（路径、mtime、大小相同）且编码设置相同时，data URI 一定相同
+    path, mtime_ns, file_size = signature[:3]
+    region = f"|box={box}" if box is not None else ""
+    return hashlib.sha256(
+        f"{path}|{mtime_ns}|{file_size}|compress={compress}|quality={JPEG_QUALITY}|size={size}{region}".encode('utf-8')
+    ).hexdigest()
+
+def _cache_get(key):
+    data_uri = DATA_URI_CACHE.get(key)
+    if data_uri is None:
+        data_uri = _load_spilled(key)
+        if data_uri is not None:
+            DATA_URI_CACHE.put(key, data_uri)
+    return data_uri
+
+def _cache_put(key, data_uri):
+    _spill(key, data_uri)
+    DATA_URI_CACHE.put(key, data_uri)
+
+def _load_spilled(key):
+    return DATA_URI_DISK.get(key)
+
+def _spill(key, data_uri):
+    '''
+    写入磁盘缓存。超出容量时删除最久未使用的文件（见 utils/cache.py 的 DiskLRU）。
+    '''
+    try:
+        DATA_URI_DISK.put(key, data_uri)
+    except OSError as e:
+        LOGGER.debug(f"图像缓存写入磁盘失败，已忽略：{e}")
+
+def image_to_base64_data_uri(img_path, compress=False, prefix=False, mode=None):
+    '''
+    将图像以 base64 编码的 data URI 传递给llama.cpp。
+    mode: 'briefing' / 'chat'，按 RESIZE_POLICY 中该模式的像素预算缩放（见 resize_plan），为空时发送原图。
+    结果按 (绝对路径, mtime, 文件大小, 压缩与缩放设置) 缓存，同一图像重复使用时不再读取和编码。
+    '''
+    format_checker(img_path)
+    data_uri = cached_data_uri(file_signature(img_path), compress=compress, mode=mode)
+    return data_uri if prefix else data_uri.split(',', 1)[1]
+
+def cached_data_uri(signature, compress=False, mode=None, original_size=None) -> str:
+    '''
+    按文件签名（见 file_signature）查找或生成带前缀的 data URI，不再重复 stat。
+    original_size: 已知的原图尺寸，给出时计算缩放尺寸不再打开文件
+    '''
+    img_path = signature[0]
+    plan = resize_plan(img_path, mode, original_size) if mode in RESIZE_POLICY else None
+    size = plan["sent"] if plan and plan["sent"] != plan["original"] else None
+    key = _data_uri_key(signature, compress, size)
+
+    data_uri = _cache_get(key)
+    if data_uri is None:
+        data_uri = _encode_data_uri(img_path, compress, size)
+        _cache_put(key, data_uri)
+    return data_uri
+
+def _encode_data_uri(img_path, compress=False, size=None):
     _, ext = format_checker(img_path)
 
-    if compress and (ext not in ['.jpg', '.jpeg']):
+    if ext in ['.tif', '.tiff'] and needs_rasterio(img_path):
+        # 大幅 GeoTIFF 不整幅读入内存，按目标尺寸读取降采样概览
+        img_bytes = overview_jpeg(img_path, size)
+        ext = '.jpeg'
+    elif size:
+        # 缩放后统一以 JPEG 重新编码
+        img_bytes = compress_to_jpeg(img_path, size=size)
+        ext = '.jpeg'
+    elif compress and (ext not in ['.jpg', '.jpeg']):
         img_bytes = compress_to_jpeg(img_path)
     # $wxy: llama-server传入tif图像报错。暂时不清楚原因(不排除爆显存了)，先强制compress。
     elif ext in ['.tif', '.tiff']:
@@ -115,10 +265,10 @@ def image_to_base64_data_uri(img_path, compress=False, prefix=False):
         with open(img_path, "rb") as f:
             img_bytes = f.read()
 
+    return bytes_to_data_uri(img_bytes, ext)
+
+def bytes_to_data_uri(img_bytes, ext='.jpeg'):
     base64_data = base64.b64encode(img_bytes).decode('utf-8')
     # print("len:base64_data:",len(base64_data))
 
-    if prefix:
-        return f"data:image/{MIME_MAP[SUPPORTED_FORMATS.index(ext)][1:]};base64,{base64_data}"
-    else:
-        return base64_data
\ No newline at end of file
+    return f"data:image/{MIME_MAP[SUPPORTED_FORMATS.index(ext)][1:]};base64,{base64_data}"
\ No newline at end of file
@@ -1,16 +1,33 @@
 """
 Plant Disease Information Extractor
 用于提取植物病害诊断所需的图像与病斑信息
+
+每张图像的全部信息（尺寸、EXIF 拍摄时间、农业元数据、病斑区域、编码后的 data URI）
+集中在一个 ImageRecord 中，按 (路径, mtime, 文件大小) 缓存：同一图像只 stat 一次、只解析一次文件头。
+元数据（同名 .json/.txt）与病斑检测结果（CACHE_DIR/<文件名>.txt）另按各自的 (mtime, 大小) 校验，
+图像未变化而这些文件变化时只重新读取这些文件。
 """
 
 import os
+import time
+import threading
+import warnings
 import datetime
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
 from PIL import Image
-from PIL.ExifTags import TAGS
 
 from utils import CONFIG_AND_SETTINGS, LOGGER, CACHE_DIR
-from utils.img_handler import format_checker, find_metadata
+from utils.cache import LRUCache
+from utils.geotiff import raster_size, is_tile_metadata
+from utils.img_handler import format_checker, find_metadata, file_signature, resize_plan, cached_data_uri, SUPPORTED_FORMATS
+
+# EXIF：Exif 子 IFD 指针与 DateTimeOriginal 标签
+EXIF_IFD = 0x8769
+DATETIME_ORIGINAL = 0x9003
+# 读取文件头是 I/O 密集型（网络盘、大 TIFF），用线程池并行
+METADATA_WORKERS = CONFIG_AND_SETTINGS.get("metadata_workers", 8)
 
 
 # ==================================================
@@ -34,47 +51,148 @@ def extract_bbox_data(filenames: list, coord_acc: int = 2) -> dict:
             ...
         }
     """
+    table = load_detection_table(filenames)
+    offsets, labels, coords = table["offsets"], table["label"], table["coords"]
     bbox_data = {}
+    for i, filename in enumerate(filenames):
+        if table["missing"][i]:
+            LOGGER.warning(
+                f"未检测到病斑识别结果：'{os.path.join(CACHE_DIR, f'{filename}.txt')}'，将仅基于整图进行诊断。"
+            )
+        rows = slice(offsets[i], offsets[i + 1])
+        bbox_data[filename] = _group_by_label(labels[rows], coords[rows], coord_acc)
+    return bbox_data
+
+
+def _read_bbox(filename: str, coord_acc: int = 2) -> tuple:
+    """
+    读取单张图像的病斑检测结果。
+
+    Returns:
+        (detections, boxes): detections 为 load_detections 的返回值，boxes 为 {症状名: [坐标, ...]}
+    """
+    detections = load_detections(filename)
+    if detections is None:
+        LOGGER.warning(
+            f"未检测到病斑识别结果：'{os.path.join(CACHE_DIR, f'{filename}.txt')}'，将仅基于整图进行诊断。"
+        )
+        return None, {}
+    return detections, _group_by_label(*detections, coord_acc)
+
 
+def _group_by_label(labels, coords, coord_acc: int = 2) -> dict:
+    # 按症状类别分组，类别与检测框均保持文件中的先后顺序
     symptom_classes = CONFIG_AND_SETTINGS.get(
         "symptom_classes",
         {}
     )
+    # 坐标精度控制
+    coords = np.maximum(np.round(coords, coord_acc), 0.0)
 
-    for filename in filenames:
-        bbox_data[filename] = {}
-        result_path = os.path.join(CACHE_DIR, f"{filename}.txt")
+    boxes = {}
+    for label_id in dict.fromkeys(labels.tolist()):
+        rows = coords[labels == label_id]
+        label_name = symptom_classes.get(
+            label_id, f"未知症状_{label_id}"
+        )
+        if np.isnan(rows).any():
+            rows = [row[~np.isnan(row)].tolist() for row in rows]
+        else:
+            rows = rows.tolist()
+        boxes.setdefault(label_name, []).extend(rows)
+    return boxes
 
-        if not os.path.exists(result_path):
-            LOGGER.warning(
-                f"未检测到病斑识别结果：'{result_path}'，将仅基于整图进行诊断。"
-            )
-            continue
 
-        with open(result_path, "r", encoding="utf-8") as f:
-            for line in f:
-                parts = line.strip().split()
-                if len(parts) < 5:
-                    continue
+def load_detections(filename: str):
+    """
+    读取单张图像的病斑检测结果 CACHE_DIR/{filename}.txt（每行：类别编号 坐标...）。
+    文本只解析一次，结果以同名 .npz 缓存在旁边；文本文件的 mtime 或大小变化后重新解析。
 
-                label_id = int(parts[0])
-                coords = list(map(float, parts[1:]))
+    Returns:
+        (labels, coords): labels 为 int32 一维数组；coords 为 float64 二维数组，每行一个检测框，
+        各行坐标数不同（如水平框与旋转框混合）时以 NaN 补齐。结果文件不存在时返回 None。
+    """
+    result_path = os.path.join(CACHE_DIR, f"{filename}.txt")
+    try:
+        stat = os.stat(result_path)
+    except FileNotFoundError:
+        return None
 
-                # 坐标精度控制
-                coords = [
-                    max(round(c, coord_acc), 0.0) for c in coords
-                ]
+    cache_path = os.path.join(CACHE_DIR, f"{filename}.npz")
+    source = np.array([stat.st_mtime_ns, stat.st_size], dtype=np.int64)
+    try:
+        with np.load(cache_path) as cached:
+            if np.array_equal(cached["source"], source):
+                return cached["labels"], cached["coords"]
+    except Exception:
+        pass  # 缓存不存在或已损坏
 
-                label_name = symptom_classes.get(
-                    label_id, f"未知症状_{label_id}"
-                )
+    labels, coords = _parse_detections(result_path)
+    tmp_path = f"{cache_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        with open(tmp_path, "wb") as f:
+            np.savez(f, labels=labels, coords=coords, source=source)
+        os.replace(tmp_path, cache_path)
+    except OSError as e:
+        LOGGER.debug(f"检测结果缓存写入失败，已忽略：{e}")
+    return labels, coords
 
-                if label_name not in bbox_data[filename]:
-                    bbox_data[filename][label_name] = []
 
-                bbox_data[filename][label_name].append(coords)
+def _parse_detections(result_path: str) -> tuple:
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")  # 空文件
+        try:
+            rows = np.loadtxt(result_path, dtype=np.float64, ndmin=2, encoding="utf-8")
+        except ValueError:
+            # 各行列数不同，逐行切分后一次性转换，以 NaN 补齐
+            with open(result_path, "r", encoding="utf-8") as f:
+                parts = [line.split() for line in f]
+            parts = [p for p in parts if len(p) >= 5]
+            rows = np.full((len(parts), max(map(len, parts), default=5)), np.nan)
+            for i, p in enumerate(parts):
+                rows[i, :len(p)] = np.asarray(p, dtype=np.float64)
 
-    return bbox_data
+    # 少于 4 个坐标的行无效
+    if rows.shape[1] < 5:
+        rows = np.empty((0, 5))
+    rows = rows[np.count_nonzero(~np.isnan(rows), axis=1) >= 5]
+    return rows[:, 0].astype(np.int32), rows[:, 1:]
+
+
+def load_detection_table(filenames: list, workers: int = METADATA_WORKERS) -> dict:
+    """
+    批量读取多张图像的检测结果，合并为一张列式表（第 i 张图像的检测框为 offsets[i]:offsets[i+1] 行）。
+
+    Returns:
+        dict:
+        {
+            "filenames": list,
+            "offsets": int64[len(filenames) + 1],
+            "missing": bool[len(filenames)],   # 检测结果文件不存在
+            "label": int32[N],
+            "coords": float64[N, K]            # 坐标数不足 K 的行以 NaN 补齐
+        }
+    """
+    if workers > 1 and len(filenames) > 1:
+        with ThreadPoolExecutor(max_workers=min(workers, len(filenames)), thread_name_prefix="detections") as pool:
+            results = list(pool.map(load_detections, filenames))
+    else:
+        results = [load_detections(f) for f in filenames]
+
+    missing = np.array([r is None for r in results], dtype=bool)
+    results = [r if r is not None else (np.empty(0, np.int32), np.empty((0, 4))) for r in results]
+    counts = [len(labels) for labels, _ in results]
+    width = max((coords.shape[1] for _, coords in results), default=4)
+
+    coords = np.full((sum(counts), width), np.nan)
+    offsets = np.zeros(len(results) + 1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+    for i, (_, c) in enumerate(results):
+        coords[offsets[i]:offsets[i + 1], :c.shape[1]] = c
+
+    labels = np.concatenate([l for l, _ in results]) if results else np.empty(0, np.int32)
+    return {"filenames": list(filenames), "offsets": offsets, "missing": missing,
+            "label": labels.astype(np.int32, copy=False), "coords": coords}
 
 
 # ==================================================
@@ -101,55 +219,197 @@ def extract_img_data(img_paths: list) -> dict:
             }
         }
     """
-    img_data = {}
+    records = image_records(img_paths)
+    img_data = {record.filename: record.file_info() for record in records}
 
-    # 可选：从外部 metadata 文件读取农业语义信息
-    metadata_docs = find_metadata(img_paths)
+    LOGGER.debug(f"extract_img_data({img_paths}) => {img_data}")
+    return img_data
 
-    for idx, img_path in enumerate(img_paths):
-        filename, ext = format_checker(img_path)
-        file_info = {
-            "format": ext[1:]
-        }
 
-        # ===== 合并外部农业元数据（如有）=====
-        meta = metadata_docs[idx] if idx < len(metadata_docs) else {}
-        file_info["crop_type"] = meta.get("crop_type", "未知作物")
-        file_info["growth_stage"] = meta.get("growth_stage", "未知生育期")
-        file_info["environment"] = meta.get("environment", "自然环境")
+# ==================================================
+# 单张图像的统一记录
+# ==================================================
+def _stat_signature(path: str):
+    # (mtime_ns, 文件大小)，文件不存在时为 None
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return st.st_mtime_ns, st.st_size
 
-        # ===== 读取图像基础信息 =====
-        try:
-            with Image.open(img_path) as img:
-                file_info.update({
-                    "width": img.width,
-                    "height": img.height
-                })
-
-                # ===== EXIF 拍摄时间 =====
-                capture_time = None
-                if hasattr(img, "_getexif") and img._getexif():
-                    exif = {
-                        TAGS.get(k, "").lower(): v
-                        for k, v in img._getexif().items()
-                    }
-                    capture_time = exif.get("datetimeoriginal")
-
-                if not capture_time:
-                    mtime = os.path.getmtime(img_path)
-                    capture_time = datetime.datetime.fromtimestamp(
-                        mtime
-                    ).strftime("%Y-%m-%d %H:%M")
-
-                file_info["capture_time"] = capture_time
 
+class ImageRecord:
+    """
+    单张图像的全部派生信息，由 image_record 构建并缓存，不要直接实例化。
+
+    Attributes:
+        path (str): 绝对路径
+        filename (str), ext (str): 不含后缀的文件名与小写后缀
+        signature (tuple): (绝对路径, mtime_ns, 文件大小)，文件变化后记录失效
+        sidecars (tuple): 元数据与检测结果文件的签名（见 sidecar_paths），变化后重新读取这些文件
+        width (int), height (int): 原图尺寸，读取失败时为 None
+        capture_time (str): EXIF 拍摄时间，缺失时为文件修改时间；GeoTIFF 分块为元数据中继承自原影像的拍摄时间
+        metadata (dict): 外部农业元数据（见 find_metadata）
+        detections (tuple): 病斑检测结果 (labels, coords) 数组（见 load_detections），无结果时为 None
+        bbox (dict): 按症状类别分组的检测框（见 extract_bbox_data）
+    """
+
+    def __init__(self, signature):
+        self.path, mtime_ns, file_size, stat = signature
+        self.signature = signature[:3]
+        self.filename, self.ext = format_checker(self.path)
+        self.width = self.height = None
+        self._exif_time = None
+        self._mtime_time = datetime.datetime.fromtimestamp(stat.st_mtime).strftime("%Y-%m-%d %H:%M")
+        self._header_ok = True
+        self._lock = threading.Lock()
+        self._load_sidecars(self.sidecar_signature())
+        self._read_header()
+
+    def sidecar_paths(self) -> tuple:
+        """元数据候选文件（与 find_metadata 的查找顺序相同）与检测结果文件"""
+        stem = os.path.splitext(self.path)[0]
+        return stem + ".json", stem + ".txt", os.path.join(CACHE_DIR, f"{self.filename}.txt")
+
+    def sidecar_signature(self) -> tuple:
+        return tuple(_stat_signature(p) for p in self.sidecar_paths())
+
+    def _load_sidecars(self, sidecars: tuple):
+        # 先 stat 再读取：读取期间文件再次变化时，下一次校验签名不一致，会再读取一次
+        self.sidecars = sidecars
+        self.metadata = find_metadata([Path(self.path)])[0]
+        self.detections, self.bbox = _read_bbox(self.filename)
+
+    def refresh(self) -> bool:
+        """
+        元数据或检测结果文件变化时重新读取（图像本身未变化，不再解析文件头）。
+
+        Returns:
+            bool: 是否重新读取
+        """
+        sidecars = self.sidecar_signature()
+        if sidecars == self.sidecars:
+            return False
+        with self._lock:
+            if sidecars != self.sidecars:
+                self._load_sidecars(sidecars)
+        return True
+
+    def _read_header(self):
+        # 只解析文件头与 EXIF IFD，不解码像素
+        try:
+            with Image.open(self.path) as img:
+                self.width, self.height = img.size
+                exif = img.getexif()
+                self._exif_time = exif.get_ifd(EXIF_IFD).get(DATETIME_ORIGINAL) if exif else None
         except Exception as e:
-            LOGGER.error(
-                f"图像信息读取失败：{img_path}，错误：{e}"
-            )
-            file_info.setdefault("capture_time", "未知时间")
+            # 超大或 PIL 无法解码的 GeoTIFF（如 16 位多波段）改由 rasterio 读取文件头（见 utils/geotiff.py）
+            try:
+                if self.ext not in ('.tif', '.tiff'):
+                    raise
+                self.width, self.height = raster_size(self.path)
+            except Exception:
+                LOGGER.error(f"图像信息读取失败：{self.path}，错误：{e}")
+                self._header_ok = False
 
-        img_data[filename] = file_info
+    @property
+    def capture_time(self) -> str:
+        if not self._header_ok:
+            return "未知时间"
+        if self._exif_time:
+            return self._exif_time
+        # 分块 JPEG 的修改时间是切分时间，使用元数据中继承自原影像的拍摄时间（见 utils/geotiff.py）
+        if is_tile_metadata(self.metadata) and self.metadata.get("capture_time"):
+            return self.metadata["capture_time"]
+        return self._mtime_time
 
-    LOGGER.debug(f"extract_img_data({img_paths}) => {img_data}")
-    return img_data
+    @property
+    def size(self):
+        return (self.width, self.height) if self.width else None
+
+    def file_info(self) -> dict:
+        """
+        extract_img_data 中单张图像的条目
+        """
+        info = {
+            "format": self.ext[1:],
+            "crop_type": self.metadata.get("crop_type", "未知作物"),
+            "growth_stage": self.metadata.get("growth_stage", "未知生育期"),
+            "environment": self.metadata.get("environment", "自然环境"),
+        }
+        if self.width:
+            info.update({"width": self.width, "height": self.height})
+        info["capture_time"] = self.capture_time
+        return info
+
+    def resize_plan(self, mode=None) -> dict:
+        return resize_plan(self.path, mode, self.size)
+
+    def data_uri(self, mode=None, compress=False) -> str:
+        """
+        带前缀的 data URI。编码结果保存在 img_handler 的 data URI 缓存中（有容量上限），记录本身只保留签名。
+        """
+        return cached_data_uri(self.signature, compress=compress, mode=mode, original_size=self.size)
+
+
+# 绝对路径 -> ImageRecord；记录很小，按条目数限制
+_RECORDS = LRUCache(max_bytes=float("inf"), max_items=CONFIG_AND_SETTINGS.get("image_record_cache", 20000))
+
+
+def image_record(img_path, revalidate: bool = True) -> ImageRecord:
+    """
+    获取图像的 ImageRecord。图像文件未变化时返回缓存的记录；元数据或检测结果文件变化时先重新读取这些文件。
+
+    Args:
+        revalidate (bool): False 时已有记录直接返回，不再 stat（只用于刚刚建立记录、紧接着再次获取的场合，
+                           如收集任务时统计元数据；执行诊断前应校验，检测结果可能在此期间才生成）
+    """
+    path = os.path.abspath(img_path)
+    record = _RECORDS.get(path)
+    if record is not None and not revalidate:
+        return record
+
+    signature = file_signature(path)
+    if record is not None and record.signature == signature[:3]:
+        record.refresh()
+        return record
+
+    record = ImageRecord(signature)
+    _RECORDS.put(path, record)
+    return record
+
+
+def image_records(img_paths: list, revalidate: bool = True, workers: int = METADATA_WORKERS) -> list:
+    """
+    按输入顺序返回各图像的 ImageRecord。图像较多时在线程池中并行读取文件头。
+    """
+    if workers <= 1 or len(img_paths) <= 1:
+        return [image_record(p, revalidate) for p in img_paths]
+    with ThreadPoolExecutor(max_workers=min(workers, len(img_paths)), thread_name_prefix="img_header") as pool:
+        return list(pool.map(lambda p: image_record(p, revalidate), img_paths))
+
+
+def scan_images(directory, workers: int = METADATA_WORKERS) -> tuple:
+    """
+    扫描目录（不递归）中的全部图像并建立 ImageRecord，只读取文件头与 EXIF，不解码像素。
+
+    Returns:
+        (records, stats): records 按文件名排序；stats 为 {"files", "elapsed_s", "files_per_s"}
+    """
+    start = time.perf_counter()
+    with os.scandir(directory) as entries:
+        paths = sorted(os.path.abspath(e.path) for e in entries
+                       if e.is_file() and os.path.splitext(e.name)[1].lower() in SUPPORTED_FORMATS)
+    records = image_records(paths, workers=workers)
+    elapsed = time.perf_counter() - start
+    stats = {"files": len(records), "elapsed_s": elapsed, "files_per_s": len(records) / elapsed if elapsed else 0.0}
+    LOGGER.info(f"已读取{directory}中{len(records)}张图像的信息，耗时{elapsed:.2f}s（{stats['files_per_s']:.0f}张/s，{workers}线程）。")
+    return records, stats
+
+
+if __name__ == "__main__":
+    import sys
+    directory = sys.argv[1] if len(sys.argv) > 1 else "."
+    for n in (1, METADATA_WORKERS):
+        _RECORDS.clear()
+        print(scan_images(directory, workers=n)[1])
@@ -6,7 +6,8 @@ Plant Disease Visual Prompter
 import os
 import re
 
-from utils.info_extractor import extract_bbox_data, extract_img_data
+from utils.info_extractor import image_records
+from utils.roi import roi_prompt
 
 
 class BasePrompter:
@@ -15,10 +16,18 @@ class BasePrompter:
 
     Args:
         img_path (list): 输入图像路径列表
+        img_data (dict): 预先提取的图像元信息（extract_img_data 的返回值），为空时由 records 生成
+        bbox_data (dict): 预先提取的病斑区域信息（extract_bbox_data 的返回值），为空时由 records 生成
+        records (list): 各图像的 ImageRecord，为空时按需获取（见 utils/info_extractor.py 的 image_record）
+        roi (dict): 病斑区域放大模式下各图像的视图（utils/roi.py 的 roi_views 的返回值），以文件名为键
     """
 
-    def __init__(self, img_path=None):
+    def __init__(self, img_path=None, img_data=None, bbox_data=None, records=None, roi=None):
         self.img_path = img_path or []
+        self.img_data = img_data
+        self.bbox_data = bbox_data
+        self._records = records
+        self.roi = roi or {}
         self.prompt = None
 
         # 图像文件名（不含后缀）
@@ -27,6 +36,12 @@ class BasePrompter:
             for img in self.img_path
         ]
 
+    @property
+    def records(self):
+        if self._records is None:
+            self._records = image_records(self.img_path)
+        return self._records
+
     # ==================================================
     # 病斑 / 症状区域信息（ROI Prompt）
     # ==================================================
@@ -35,11 +50,15 @@ class BasePrompter:
         构造病斑或异常症状区域的描述提示词
         """
         prompt = ""
-        metadata = extract_bbox_data(self.filenames)
+        metadata = self.bbox_data if self.bbox_data is not None else {r.filename: r.bbox for r in self.records}
         count = 1
+        # 当前图像在全部输入图片中的序号（放大模式下一张图像对应多张输入图片）
+        position = 1
 
         for filename in self.filenames:
             bbox_info = metadata.get(filename, {})
+            views = self.roi.get(filename)
+            first, position = position, position + (1 + len(views["crops"]) if views else 1)
 
             # 若该图像未检测到任何症状区域
             if not bbox_info or all(len(v) == 0 for v in bbox_info.values()):
@@ -57,6 +76,8 @@ class BasePrompter:
 
             # 去掉末尾分号
             prompt = prompt.rstrip("；")
+            if views:
+                prompt += "；" + roi_prompt(views, first)
             prompt += f"<OD{count}>"
             count += 1
 
@@ -70,7 +91,7 @@ class BasePrompter:
         构造作物类型、生长环境及拍摄条件的提示词
         """
         prompt = ""
-        metadata = extract_img_data(self.img_path)
+        metadata = self.img_data if self.img_data is not None else {r.filename: r.file_info() for r in self.records}
         count = 1
 
         for filename in self.filenames:
@@ -0,0 +1,192 @@
+"""
+ROI Crop & Zoom
+病斑区域放大模式：根据病斑检测框裁剪出疑似病斑区域（外扩并合并相邻区域），连同一张低分辨率的全图缩略图，
+代替原图发送给模型。视觉 token 大幅减少，病斑处的有效分辨率反而更高。
+放大图与原图坐标的对应关系随结果返回，写入提示词与完整报告。
+"""
+
+import numpy as np
+from PIL import Image
+
+from utils import CONFIG_AND_SETTINGS, LOGGER
+from utils.geotiff import LARGE_RASTER_PIXELS
+from utils.img_handler import (
+    smart_resize,
+    estimate_vision_tokens,
+    image_to_jpeg,
+    bytes_to_data_uri,
+    _data_uri_key,
+    _cache_get,
+    _cache_put,
+    PATCH_SIZE
+)
+
+ROI_CONFIG = CONFIG_AND_SETTINGS.get("roi_zoom") or {}
+ROI_ENABLED = bool(ROI_CONFIG.get("enabled", False))
+
+
+def detection_bounds(coords: np.ndarray, width: int, height: int) -> np.ndarray:
+    """
+    将检测框坐标（x1, y1, x2, y2, ... 的点序列，NaN 补齐）转换为外接矩形 (x0, y0, x1, y1)。
+    坐标全部不超过 1 时视为归一化坐标，按图像尺寸换算为像素。
+    """
+    xs, ys = coords[:, 0::2], coords[:, 1::2]
+    bounds = np.stack([np.nanmin(xs, axis=1), np.nanmin(ys, axis=1),
+                       np.nanmax(xs, axis=1), np.nanmax(ys, axis=1)], axis=1)
+    if bounds.size and np.nanmax(bounds) <= 1.0:
+        bounds *= [width, height, width, height]
+    return bounds
+
+
+def _components(boxes: np.ndarray) -> np.ndarray:
+    # 相交的矩形属于同一连通分量：每个矩形反复取相交矩形中最小的分量编号，直到不再变化
+    overlap = (
+        (boxes[:, None, 0] <= boxes[None, :, 2]) & (boxes[None, :, 0] <= boxes[:, None, 2])
+        & (boxes[:, None, 1] <= boxes[None, :, 3]) & (boxes[None, :, 1] <= boxes[:, None, 3])
+    )
+    labels = np.arange(len(boxes))
+    while True:
+        merged = np.where(overlap, labels[None, :], len(boxes)).min(axis=1)
+        if np.array_equal(merged, labels):
+            return labels
+        labels = merged[merged]
+
+
+def merge_regions(bounds: np.ndarray, width: int, height: int,
+                  pad_ratio: float = 0.25, min_crop: int = 224, max_crops: int = 4) -> np.ndarray:
+    """
+    外扩检测框并合并相交的区域，得到最多 max_crops 个裁剪区域。
+    每个框向外扩展 pad_ratio 倍长边（保留周围的健康组织作对照），且边长不小于 min_crop；
+    区域数超过 max_crops 时逐步放宽合并距离，让相邻的区域先合并。
+
+    Returns:
+        int 数组 (N, 4)，每行为 (x0, y0, x1, y1)，按面积从大到小排列
+    """
+    bounds = bounds[np.isfinite(bounds).all(axis=1)]
+    if not len(bounds):
+        return np.empty((0, 4), dtype=int)
+
+    center = (bounds[:, :2] + bounds[:, 2:]) / 2
+    half = (bounds[:, 2:] - bounds[:, :2]) / 2
+    half = np.maximum(half + half.max(axis=1, keepdims=True) * pad_ratio, min(min_crop, width, height) / 2)
+    # 外扩后超出图像的部分平移回图像内，保持区域大小
+    lo = np.clip(center - half, 0, None)
+    hi = np.clip(lo + 2 * half, None, [width, height])
+    lo = np.clip(hi - 2 * half, 0, None)
+    regions = np.concatenate([lo, hi], axis=1)
+
+    gap = 0.0
+    while True:
+        labels = _components(regions + [-gap, -gap, gap, gap])
+        ids = np.unique(labels)
+        regions = np.array([
+            np.concatenate([regions[labels == i, :2].min(axis=0), regions[labels == i, 2:].max(axis=0)])
+            for i in ids
+        ])
+        if len(regions) <= max_crops:
+            break
+        gap = max(gap * 2, min_crop / 2)
+
+    regions = np.round(regions).astype(int)
+    area = (regions[:, 2] - regions[:, 0]) * (regions[:, 3] - regions[:, 1])
+    return regions[np.argsort(-area, kind="stable")]
+
+
+def roi_views(record, config: dict = None):
+    """
+    为一张图像生成病斑区域放大图与全图缩略图（编码结果与普通图像共用 data URI 缓存）。
+    没有检测结果、或裁剪区域合计超过原图面积的 max_coverage 时返回 None，此时按原图发送。
+
+    Args:
+        record (ImageRecord): 见 utils/info_extractor.py
+
+    Returns:
+        dict:
+        {
+            "original": (w, h),
+            "overview": {"sent": (w, h), "data_uri": str},
+            "crops": [{"box": (x0, y0, x1, y1), "sent": (w, h), "zoom": float, "data_uri": str}, ...],
+            "vision_tokens": int,           # 全部视图合计
+            "full_vision_tokens": int       # 按原图发送时
+        }
+    """
+    config = ROI_CONFIG if config is None else config
+    if record.detections is None or not record.width:
+        return None
+    width, height = record.width, record.height
+    if width * height > LARGE_RASTER_PIXELS:
+        return None  # 大幅影像不整幅解码，先切分为分块（见 utils/geotiff.py），再对各分块放大
+    _, coords = record.detections
+    if not len(coords):
+        return None
+
+    regions = merge_regions(
+        detection_bounds(coords, width, height), width, height,
+        pad_ratio=config.get("pad_ratio", 0.25),
+        min_crop=config.get("min_crop", 224),
+        max_crops=config.get("max_crops", 4)
+    )
+    covered = ((regions[:, 2] - regions[:, 0]) * (regions[:, 3] - regions[:, 1])).sum()
+    if not len(regions) or covered > config.get("max_coverage", 0.6) * width * height:
+        return None
+
+    overview = smart_resize(width, height, 4 * PATCH_SIZE ** 2, config.get("overview_max_pixels", 100352))
+    views = [(None, overview)]
+    for box in regions.tolist():
+        crop_w, crop_h = box[2] - box[0], box[3] - box[1]
+        views.append((tuple(box), smart_resize(crop_w, crop_h, config.get("crop_min_pixels", 50176),
+                                               config.get("crop_max_pixels", 200704))))
+
+    keys = [_data_uri_key(record.signature, "roi", size, box) for box, size in views]
+    uris = [_cache_get(key) for key in keys]
+    if any(uri is None for uri in uris):
+        # 原图只解码一次，裁剪出全部缺失的视图
+        with Image.open(record.path) as img:
+            img.load()
+            for i, (box, size) in enumerate(views):
+                if uris[i] is None:
+                    uris[i] = bytes_to_data_uri(image_to_jpeg(img.crop(box) if box else img, size=size))
+                    _cache_put(keys[i], uris[i])
+
+    crops = [
+        {"box": box, "sent": size, "zoom": round(size[0] / (box[2] - box[0]), 2), "data_uri": uri}
+        for (box, size), uri in zip(views[1:], uris[1:])
+    ]
+    result = {
+        "original": (width, height),
+        "overview": {"sent": overview, "data_uri": uris[0]},
+        "crops": crops,
+        "vision_tokens": sum(estimate_vision_tokens(*size) for _, size in views),
+        "full_vision_tokens": record.resize_plan("briefing")["vision_tokens"],
+    }
+    LOGGER.debug(f"{record.filename}：病斑区域放大模式，{len(crops)}张放大图，"
+                 f"视觉token {result['full_vision_tokens']} → {result['vision_tokens']}")
+    return result
+
+
+def roi_prompt(views: dict, position: int) -> str:
+    """
+    描述各视图在输入图片中的位置及其对应的原图区域
+
+    Args:
+        position (int): 该图像的全图缩略图在全部输入图片中的序号（从 1 开始）
+    """
+    parts = [f"该图像以第{position}~{position + len(views['crops'])}张输入图片发送，第{position}张为全图缩略图"]
+    for k, crop in enumerate(views["crops"], start=position + 1):
+        x0, y0, x1, y1 = crop["box"]
+        parts.append(f"第{k}张为原图区域[{x0}, {y0}, {x1}, {y1}]的{crop['zoom']}倍放大图")
+    return "，".join(parts)
+
+
+def roi_notes(name: str, views: dict) -> list:
+    """
+    完整报告中的视图说明：放大图与原图坐标的对应关系
+    """
+    (w, h), (ow, oh) = views["original"], views["overview"]["sent"]
+    notes = [f"{name}：病斑区域放大模式，原图 {w}x{h} → 全图缩略图 {ow}x{oh} + {len(views['crops'])}张放大图，"
+             f"视觉token {views['full_vision_tokens']} → {views['vision_tokens']}"]
+    for k, crop in enumerate(views["crops"], start=1):
+        x0, y0, x1, y1 = crop["box"]
+        notes.append(f"    放大图{k}：原图区域 ({x0}, {y0})-({x1}, {y1}) → 发送 "
+                     f"{crop['sent'][0]}x{crop['sent'][1]}（{crop['zoom']}倍）")
+    return notes
@@ -6,11 +6,16 @@ import sys, os
 import time
 from utils import CONFIG_AND_SETTINGS, LOGGER
 
-def briefing2file(str_list, file_type='.txt'):
+def _file_name(kind, name, file_type):
+    # name：可选后缀（如图像文件名），避免同一分钟内生成的多份报告相互覆盖
+    stamp = time.strftime('%y%m%d%H%M', time.localtime())
+    return f"{kind}_{stamp}_{name}{file_type}" if name else f"{kind}_{stamp}{file_type}"
+
+def briefing2file(str_list, file_type='.txt', name=None):
     file_dir = CONFIG_AND_SETTINGS['briefings_dir']
     os.makedirs(file_dir, exist_ok=True)
 
-    file_path = os.path.join(file_dir, f"briefing_{time.strftime('%y%m%d%H%M', time.localtime())}{file_type}")
+    file_path = os.path.join(file_dir, _file_name("briefing", name, file_type))
 
     try:
         with open(file_path, 'w', encoding='utf-8') as f:
@@ -21,14 +26,21 @@ def briefing2file(str_list, file_type='.txt'):
     else:
         LOGGER.info(f"\n简报已保存到{os.path.abspath(file_path)}")
 
-def fullreport2file(prompt_list, answer_list, file_type='.txt'):
+def fullreport2file(prompt_list, answer_list, file_type='.txt', name=None, notes=None):
+    '''
+    notes: 写在报告开头的运行信息，如各图像原始分辨率与实际发送分辨率、各阶段提示词缓存命中情况
+    '''
     file_dir = CONFIG_AND_SETTINGS['fullreports_dir']
     os.makedirs(file_dir, exist_ok=True)
 
-    file_path = os.path.join(file_dir, f"fullreport_{time.strftime('%y%m%d%H%M', time.localtime())}{file_type}")
+    file_path = os.path.join(file_dir, _file_name("fullreport", name, file_type))
 
     try:
         with open(file_path, 'w', encoding='utf-8') as f:
+            if notes:
+                f.write("·运行信息：\n")
+                f.write('\n'.join(str(n) for n in notes) + '\n\n')
+
             for i, prompt in enumerate(prompt_list):
                 f.write("·提示词：\n")
                 f.write(str(prompt) + '\n\n')